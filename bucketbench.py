@@ -0,0 +1,95 @@
+#!/usr/bin/python
+
+# Times the bucketing behind the bucket stats (message sizes, thread
+# lengths and the whole count cube) on synthetic data, with and without
+# numpy, against the old scan over the bucket edges for each item.
+#
+# To run:
+# ./bucketbench.py [item_count ...]
+# The counts default to 1000000 and 10000000.
+
+import array
+import random
+import sys
+import time
+
+from itertools import izip
+
+import stats.base
+import stats.bucket
+import stats.cube
+
+class FakeMessageInfo(object):
+  def __init__(self):
+    self.size = 0
+    self.date = None
+
+  def GetDate(self):
+    return self.date
+
+def ScanBuckets(values, edges):
+  # What the stats used to do for each message or thread
+  buckets = [0] * len(edges)
+  for value in values:
+    for i in reversed(xrange(0, len(edges))):
+      if value >= edges[i]:
+        buckets[i] += 1
+        break
+  return buckets
+
+def Time(label, count, function):
+  start = time.time()
+  result = function()
+  print "%-28s n=%-9d %7.2fs" % (label, count, time.time() - start)
+  return result
+
+def RunCube(dates, sizes):
+  cube = stats.cube.CountCube()
+  message_info = FakeMessageInfo()
+  for date, size in izip(dates, sizes):
+    message_info.date = date
+    message_info.size = size
+    cube.Accumulate(message_info)
+  cube.FinishAccumulating()
+  return cube.GetSizeCounts()
+
+def UseNumpy(numpy):
+  stats.base.numpy = numpy
+  stats.cube.numpy = numpy
+
+random.seed(0)
+numpy = stats.base.numpy
+counts = [int(c) for c in sys.argv[1:]] or [1000000, 10000000]
+size_edges = stats.cube.SIZE_BUCKETS
+length_edges = stats.bucket.ThreadSizeBucketStat._SIZE_BUCKETS
+
+for count in counts:
+  # A few thousand distinct dates is enough, and keeps memory down
+  now = time.time()
+  all_dates = [time.localtime(now - random.randint(0, 10 * 365 * 86400))
+      for i in xrange(5000)]
+  dates = [random.choice(all_dates) for i in xrange(count)]
+  sizes = array.array("l",
+      (int(random.lognormvariate(9, 1.5)) for i in xrange(count)))
+  lengths = array.array("l",
+      (int(random.paretovariate(1.2)) for i in xrange(count)))
+
+  expected = Time("sizes, scan", count,
+      lambda: ScanBuckets(sizes, size_edges))
+  Time("thread lengths, scan", count,
+      lambda: ScanBuckets(lengths, length_edges))
+
+  for label, module in [("numpy", numpy), ("no numpy", None)]:
+    if label == "numpy" and numpy is None: continue
+    UseNumpy(module)
+    result = Time("sizes, %s" % label, count,
+        lambda: stats.base.CountBuckets(sizes, size_edges))
+    assert result == expected
+    Time("thread lengths, %s" % label, count,
+        lambda: stats.base.CountBuckets(lengths, length_edges))
+    result = Time("count cube, %s" % label, count,
+        lambda: RunCube(dates, sizes))
+    assert result == expected
+    UseNumpy(numpy)
+
+  del dates, sizes, lengths
@@ -0,0 +1,89 @@
+"""
+Transparent access to compressed mail archives
+
+Files ending in .gz, .bz2 or .xz are decompressed as they are read, so
+they never have to be unpacked to disk first. When the matching command
+line tool is installed, decompression runs in a separate process that
+feeds the reader through a pipe; otherwise the file is decompressed
+in-process.
+"""
+
+import bz2
+import gzip
+import subprocess
+
+from distutils.spawn import find_executable
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+_BUFFER_SIZE = 1 << 16
+
+# Extension -> (command line tool, in-process file class)
+_DECOMPRESSORS = {
+    ".gz": ("gzip", gzip.GzipFile),
+    ".bz2": ("bzip2", bz2.BZ2File),
+    ".xz": ("xz", lzma and lzma.LZMAFile),
+}
+
+
+class _PipeFile(object):
+    "A read-only file fed by a decompression process"
+
+    def __init__(self, command, path):
+        self.__process = subprocess.Popen(
+                [command, "-dc", path],
+                stdout=subprocess.PIPE,
+                bufsize=_BUFFER_SIZE)
+
+    def read(self, size=-1):
+        return self.__process.stdout.read(size)
+
+    def readline(self, size=-1):
+        return self.__process.stdout.readline(size)
+
+    def close(self):
+        self.__process.stdout.close()
+        returncode = self.__process.wait()
+
+        # A negative code means we closed the pipe before the end (SIGPIPE)
+        if returncode > 0:
+            raise IOError("decompression failed with exit code %d" % returncode)
+
+
+def _GetExtension(path):
+    for extension in _DECOMPRESSORS:
+        if path.endswith(extension):
+            return extension
+    return None
+
+
+def IsCompressed(path):
+    "Return True if path names a compressed file we know how to read"
+    return _GetExtension(path) is not None
+
+
+def Open(path, use_process=True):
+    """
+    Open path for reading, decompressing it on the fly if needed
+
+    The returned object supports read(), readline() and close().
+    """
+    extension = _GetExtension(path)
+    if extension is None:
+        return open(path, "rb")
+
+    command, file_class = _DECOMPRESSORS[extension]
+
+    if use_process and find_executable(command):
+        return _PipeFile(command, path)
+
+    if file_class is None:
+        raise RuntimeError("No decompressor available for %s" % path)
+
+    return file_class(path, "rb")
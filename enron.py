@@ -1,30 +1,60 @@
 #!/usr/bin/python
 
-# Simple program to take a directory from the Enron corpus 
+# Simple program to take a directory from the Enron corpus
 # (http://www.cs.cmu.edu/~enron/) and generate an mbox file from it (in the
 # Enron corpus, the messages are stored as individual files and don't begin
 # with a From: line, but otherwise seem to be RFC 2822 messages)
 #
+# Messages may also be stored compressed (.gz, .bz2 or .xz); they are
+# decompressed on the fly, in-process. Messages are streamed line by line,
+# in pieces of at most _MAX_LINE_BYTES, so neither bodies nor overlong lines
+# are ever held in memory.
+#
 # To run:
 # ./enron.py directory_path
 # The mbox file will be sent to stdout
 
-import email
 import os
 import os.path
 import sys
+import time
+
+import compressed
+
+# Longer lines are read in several pieces
+_MAX_LINE_BYTES = 64 * 1024
 
 directory = sys.argv[1]
+out = sys.stdout
 
 for root, dirs, file_names in os.walk(directory):
   for file_name in file_names:
     file_path = os.path.join(root, file_name)
-    
-    message_file = file(file_path, "r")
-    message_text = message_file.read()
+
+    # Messages are small, a decompression process for each would cost more
+    # than it saves
+    message_file = compressed.Open(file_path, use_process=False)
+
+    out.write("From nobody %s\n" % time.ctime())
+
+    # Header lines are passed through untouched, body lines starting with
+    # "From " are escaped so that they are not taken as separators. Only the
+    # first piece of a line is looked at, the rest is passed through.
+    in_header = True
+    line_start = True
+    line = "\n"
+    for line in iter(lambda: message_file.readline(_MAX_LINE_BYTES), ""):
+      if line_start:
+        if in_header:
+          if line.strip() == "":
+            in_header = False
+        elif line.startswith("From "):
+          out.write(">")
+      out.write(line)
+      line_start = line.endswith("\n")
+
     message_file.close()
-    
-    msg = email.message_from_string(message_text)
-    
-    print msg.as_string(unixfrom=True)
-    print ""
\ No newline at end of file
+
+    if not line.endswith("\n"):
+      out.write("\n")
+    out.write("\n")
@@ -0,0 +1,222 @@
+#!/usr/bin/python
+
+# Builds a synthetic Mail.app mailbox package, with .emlx files and a
+# matching "Envelope Index" SQLite database, then reads it with and without
+# the index and checks that both give the same message infos, with the Cc
+# and Bcc recipients and List-Ids of the .emlx headers. Also counts the
+# .emlx files each way opens: none from the index when List-Ids are
+# skipped, which then have to be missing.
+#
+# To run:
+# ./envelopecheck.py [message_count [package_path]]
+# The count defaults to 2000, the package goes to a temporary directory
+# (which is removed afterwards) unless a path is given.
+
+import __builtin__
+import email.header
+import email.utils
+import logging
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+
+import mail
+
+_ACCOUNT = "ABCD1234-0000-1111-2222-333344445555"
+_STORE = "DEADBEEF-0000-1111-2222-333344445555"
+_MAILBOXES = ["INBOX.mbox", "Sent.mbox", "Lists.mbox"]
+
+_SCHEMA = """
+CREATE TABLE messages (ROWID INTEGER PRIMARY KEY, global_message_id INTEGER,
+    sender INTEGER, subject_prefix TEXT, subject INTEGER, date_sent INTEGER,
+    date_received INTEGER, mailbox INTEGER, size INTEGER);
+CREATE TABLE message_global_data (ROWID INTEGER PRIMARY KEY,
+    message_id_header TEXT);
+CREATE TABLE subjects (ROWID INTEGER PRIMARY KEY, subject TEXT);
+CREATE TABLE addresses (ROWID INTEGER PRIMARY KEY, address TEXT,
+    comment TEXT);
+CREATE TABLE recipients (ROWID INTEGER PRIMARY KEY, message INTEGER,
+    type INTEGER, address INTEGER, position INTEGER);
+"""
+
+def MakePeople():
+  people = []
+  for i in xrange(200):
+    if i % 10 == 0:
+      name = u"Jos\xe9 %d" % i
+    else:
+      name = u"Person %d" % i
+    people.append((name, "user%d@example%d.com" % (i, i % 7)))
+  return people
+
+def FormatHeaderAddress(name, address):
+  try:
+    name = name.encode("ascii")
+  except UnicodeError:
+    name = email.header.Header(name, "utf-8").encode()
+  return email.utils.formataddr((name, address))
+
+def BuildPackage(root, message_count):
+  random.seed(0)
+  people = MakePeople()
+  lists = ["<list%d.lists.example.org>" % i for i in xrange(5)]
+
+  os.makedirs(os.path.join(root, "MailData"))
+  db = sqlite3.connect(os.path.join(root, "MailData", "Envelope Index"))
+  db.executescript(_SCHEMA)
+
+  address_ids = {}
+  def GetAddressId(name, address):
+    if address not in address_ids:
+      address_ids[address] = len(address_ids) + 1
+      db.execute("INSERT INTO addresses VALUES (?, ?, ?)",
+                 (address_ids[address], address, name))
+    return address_ids[address]
+
+  for rowid in xrange(1, message_count + 1):
+    date = random.randint(1104537600, 1420070400)
+    sender = random.choice(people)
+    recipients = random.sample(people, random.randint(1, 6))
+    # (recipients.type, header name, addresses), some spelled in capitals
+    fields = [(0, "To", recipients[:2])]
+    if recipients[2:4]:
+      fields.append((1, random.choice(["Cc", "CC"]), recipients[2:4]))
+    if recipients[4:]:
+      fields.append((2, "Bcc", recipients[4:]))
+    message_id = "<m%d@example.com>" % rowid
+    prefix = random.random() < 0.4 and "Re: " or ""
+    subject = "Topic %d" % random.randint(0, message_count / 5)
+
+    header = [
+      "From: " + FormatHeaderAddress(*sender),
+      "Subject: " + prefix + subject,
+      "Date: " + email.utils.formatdate(
+          date, localtime=random.random() < 0.5),
+      "Message-ID: " + message_id,
+    ]
+    for type, name, addresses in fields:
+      header.append(name + ": " + ", ".join(
+          FormatHeaderAddress(*r) for r in addresses))
+    if random.random() < 0.3:
+      header.append("List-Id: " + random.choice(lists))
+    text = "\n".join(header) + "\n\n" + "x" * random.randint(0, 5000) + "\n"
+
+    mailbox = random.randint(0, len(_MAILBOXES) - 1)
+    directory = os.path.join(root, _ACCOUNT, _MAILBOXES[mailbox], _STORE,
+                             "Data", str(rowid % 10), "Messages")
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+    emlx = open(os.path.join(directory, "%d.emlx" % rowid), "w")
+    emlx.write("%d\n%s" % (len(text), text))
+    emlx.write('<?xml version="1.0"?>\n<plist><dict></dict></plist>\n')
+    emlx.close()
+
+    db.execute("INSERT INTO subjects VALUES (?, ?)", (rowid, subject))
+    db.execute("INSERT INTO message_global_data VALUES (?, ?)",
+               (rowid, message_id))
+    db.execute("INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+               (rowid, rowid, GetAddressId(*sender), prefix, rowid, date,
+                date + 60, mailbox, len(text)))
+    for type, name, addresses in fields:
+      for position, recipient in enumerate(addresses):
+        db.execute("INSERT INTO recipients (message, type, address, position) "
+                   "VALUES (?, ?, ?, ?)",
+                   (rowid, type, GetAddressId(*recipient), position))
+
+  db.commit()
+  db.close()
+
+def ReadPackage(root, **options):
+  """(message infos by Message-ID, number of .emlx files opened)"""
+  opened = [0]
+  def CountingOpen(path, *args):
+    if path.endswith(".emlx"):
+      opened[0] += 1
+    return __builtin__.open(path, *args)
+
+  mail.open = CountingOpen
+  try:
+    package = mail.MailBoxPackageInfo(root, **options)
+    message_infos = {}
+    for mailbox in list(package.GetMailboxes()):
+      package.SelectMailbox(mailbox)
+      for message_info in package.GetMessageInfos():
+        message_infos[message_info.message_id] = message_info
+  finally:
+    del mail.open
+
+  return message_infos, opened[0]
+
+def Describe(message_info, with_list_id=True):
+  return (
+    message_info.size,
+    tuple(message_info.GetDate()),
+    message_info.GetSender(),
+    sorted(message_info.GetRecipients()),
+    message_info.subject,
+    message_info.normalized_subject,
+    with_list_id and message_info.GetListId() or None,
+  )
+
+def Compare(label, expected, actual, with_list_id):
+  differences = 0
+  for message_id in sorted(set(expected) | set(actual)):
+    if message_id not in expected or message_id not in actual:
+      differences += 1
+      print "  %s: only read one way" % message_id
+      continue
+
+    expected_info = Describe(expected[message_id], with_list_id)
+    actual_info = Describe(actual[message_id], with_list_id)
+    if expected_info != actual_info:
+      differences += 1
+      if differences <= 10:
+        print "  %s:\n    %r\n    %r" % (message_id, expected_info, actual_info)
+
+  print "%-24s %d messages, %d differences" % (label, len(actual), differences)
+  return differences
+
+logging.basicConfig(level=logging.WARNING)
+
+message_count = len(sys.argv) > 1 and int(sys.argv[1]) or 2000
+if len(sys.argv) > 2:
+  root = sys.argv[2]
+  keep = True
+else:
+  root = os.path.join(tempfile.mkdtemp(), "V3")
+  keep = False
+
+try:
+  BuildPackage(root, message_count)
+
+  emlx_infos, emlx_opened = ReadPackage(root, use_envelope_index=False)
+  index_infos, index_opened = ReadPackage(root)
+  skip_infos, skip_opened = ReadPackage(root, read_list_ids=False)
+
+  print ".emlx files opened: %d without the index, %d with it, " \
+      "%d with it and no List-Ids" % (emlx_opened, index_opened, skip_opened)
+
+  differences = Compare("index", emlx_infos, index_infos, True)
+  differences += Compare("index, no List-Ids", emlx_infos, skip_infos, False)
+  if not [m for m in emlx_infos.values() if m.GetListId() != (None, None)]:
+    print "  No List-Ids were read"
+    differences += 1
+  if not [m for m in emlx_infos.values() if len(m.GetRecipientIds()) > 2]:
+    print "  No Cc or Bcc recipients were read"
+    differences += 1
+  for message_info in skip_infos.values():
+    if message_info.GetListId() != (None, None):
+      print "  List-Id read from the index alone"
+      differences += 1
+      break
+  if skip_opened:
+    print "  The index alone opened .emlx files"
+    differences += 1
+finally:
+  if not keep:
+    shutil.rmtree(os.path.dirname(root))
+
+sys.exit(differences and 1 or 0)
@@ -0,0 +1,129 @@
+"""
+Compiled --filter_out and --me matching
+
+Both only depend on a message's addresses and their names, so they are
+worked out once for each address of the messageinfo.AddressTable rather
+than for each message. The result is a byte of verdict flags per address
+ID, which messages then look up by the IDs of their addresses. In the
+approximate mode, addresses have no IDs, and are matched for each message.
+"""
+
+import re
+
+# Verdict flags of an address
+FILTERED_FROM = 1 << 0
+FILTERED_TO = 1 << 1
+FILTERED_LIST = 1 << 2
+IS_ME = 1 << 3
+
+_OPERATOR_FLAGS = {
+    "from": FILTERED_FROM,
+    "to": FILTERED_TO,
+    "list": FILTERED_LIST,
+}
+
+
+class AddressMatcher(object):
+    """
+    The --filter_out filters ("operator:substring,...") and --me addresses
+    ("address,..."), compiled
+
+    The substrings of each operator are matched by a single regular
+    expression, against the lowercased name and address; "me" addresses are
+    looked up in a set.
+    """
+
+    def __init__(self, filter_param=None, me_param=None):
+        operator_values = {}
+        if filter_param:
+            for raw_filter in filter_param.split(","):
+                operator, value = raw_filter.strip().split(":", 1)
+                if operator not in _OPERATOR_FLAGS:
+                    raise AssertionError("unknown operator: %s" % operator)
+                operator_values.setdefault(operator, []).append(value.lower())
+
+        self.__patterns = []
+        for operator, values in operator_values.items():
+            pattern = re.compile(
+                "|".join(re.escape(value) for value in values))
+            self.__patterns.append((_OPERATOR_FLAGS[operator], pattern))
+
+        self.__me_addresses = set()
+        if me_param:
+            self.__me_addresses = set(address.lower().strip()
+                                      for address in me_param.split(","))
+
+    def GetVerdict(self, name, address):
+        "The verdict flags of an address"
+        verdict = 0
+        if self.__patterns:
+            name = name and name.lower() or ""
+            address = address.lower()
+            for flag, pattern in self.__patterns:
+                if pattern.search(name) or pattern.search(address):
+                    verdict |= flag
+
+        if address in self.__me_addresses:
+            verdict |= IS_ME
+
+        return verdict
+
+    def GetVerdicts(self, address_table):
+        "The verdict flags of each address in address_table, by ID"
+        verdicts = bytearray(len(address_table))
+        for address_id in xrange(0, len(address_table)):
+            verdicts[address_id] = self.GetVerdict(
+                *address_table.GetNameAddress(address_id))
+        return verdicts
+
+    def GetMessageVerdicts(self, message_info):
+        """
+        Like GetMessageVerdicts(), matching the message's addresses, for
+        messages whose addresses aren't numbered
+        """
+        sender_verdict = list_verdict = recipient_verdicts = 0
+
+        name, address = message_info.GetSender()
+        if address is not None:
+            sender_verdict = self.GetVerdict(name, address)
+
+        name, address = message_info.GetListId()
+        if address is not None:
+            list_verdict = self.GetVerdict(name, address)
+
+        for name, address in message_info.GetRecipients():
+            recipient_verdicts |= self.GetVerdict(name, address)
+
+        return sender_verdict, list_verdict, recipient_verdicts
+
+
+def GetMessageVerdicts(message_info, verdicts):
+    """
+    The verdict flags of the message's sender, of its list and of its
+    recipients (or-ed together), looked up by address ID in verdicts
+    """
+    sender_verdict = list_verdict = recipient_verdicts = 0
+
+    sender_id = message_info.GetSenderId()
+    if sender_id is not None:
+        sender_verdict = verdicts[sender_id]
+
+    list_address_id = message_info.GetListAddressId()
+    if list_address_id is not None:
+        list_verdict = verdicts[list_address_id]
+
+    for recipient_id in message_info.GetRecipientIds():
+        recipient_verdicts |= verdicts[recipient_id]
+
+    return sender_verdict, list_verdict, recipient_verdicts
+
+
+def IsFilteredOut(message_verdicts):
+    """
+    Whether a filter matches the message's sender, a recipient or its list,
+    given its GetMessageVerdicts()
+    """
+    sender_verdict, list_verdict, recipient_verdicts = message_verdicts
+    return bool(sender_verdict & FILTERED_FROM or
+                list_verdict & FILTERED_LIST or
+                recipient_verdicts & FILTERED_TO)
@@ -0,0 +1,221 @@
+#!/usr/bin/python
+
+# Checks --server_threads against local threading. A stand-in IMAP server
+# is started on localhost, serving the messages of an mbox file (or of a
+# synthetic one) and answering UID THREAD REFERENCES with the threads
+# jwzthreading.thread() finds. mail.Mail then fetches the messages and the
+# server's threads, and the threads built from those are compared with
+# thread_forest() on the same messages. This is done twice: with the
+# THREAD data on the response line, and sent as a literal.
+#
+# To run:
+# ./imapcheck.py [mbox_path]
+# Without a path, 2000 synthetic messages are served.
+
+import email
+import email.utils
+import imaplib
+import logging
+import mailbox
+import random
+import SocketServer
+import sys
+import tempfile
+import threading
+import time
+
+import jwzthreading
+import mail
+
+def MakeMbox(count):
+  random.seed(0)
+  messages = []
+  for i in xrange(count):
+    header = [
+      "From: user%d@example.com" % random.randint(0, 50),
+      "To: user%d@example.com" % random.randint(0, 50),
+      "Date: " + email.utils.formatdate(1230768000 + i * 3600),
+    ]
+    # Some messages without a Message-ID, and some sharing one
+    if random.random() < 0.95:
+      header.append("Message-ID: <m%d@example.com>" %
+                    random.randint(0, count * 9 / 10))
+
+    subject = "Topic %d" % random.randint(0, count / 4)
+    if i and random.random() < 0.6:
+      parent = random.randint(max(0, i - 100), i - 1)
+      header.append("References: <m%d@example.com>" % parent)
+      subject = "Re: " + subject
+    header.append("Subject: " + subject)
+
+    messages.append("From user@example.com %s\n%s\n\nBody\n" % (
+        time.asctime(time.gmtime(1230768000 + i * 3600)), "\n".join(header)))
+  return "".join(messages)
+
+class StandInServer(SocketServer.StreamRequestHandler):
+  """Just enough of IMAP4rev1 for mail.Mail, with one INBOX mailbox"""
+
+  # (uid, header, size) of each message, set before serving
+  messages = []
+  literal_threads = False
+
+  def WriteLine(self, line):
+    self.wfile.write(line + "\r\n")
+
+  def handle(self):
+    self.WriteLine("* OK stand-in ready")
+    while True:
+      line = self.rfile.readline()
+      if not line:
+        return
+
+      parts = line.split()
+      tag, command, args = parts[0], parts[1].upper(), parts[2:]
+      if command == "CAPABILITY":
+        self.WriteLine("* CAPABILITY IMAP4rev1 THREAD=REFERENCES")
+      elif command == "LIST":
+        self.WriteLine('* LIST (\\HasNoChildren) "/" "INBOX"')
+      elif command in ("SELECT", "EXAMINE"):
+        self.WriteLine("* %d EXISTS" % len(self.messages))
+      elif command == "UID" and args[0].upper() == "SEARCH":
+        self.WriteLine("* SEARCH " +
+                       " ".join(uid for uid, header, size in self.messages))
+      elif command == "UID" and args[0].upper() == "FETCH":
+        self.WriteFetch(set(args[1].split(",")))
+      elif command == "UID" and args[0].upper() == "THREAD":
+        threads = self.GetThreads()
+        if self.literal_threads:
+          self.wfile.write("* THREAD {%d}\r\n%s\r\n" % (len(threads), threads))
+        else:
+          self.WriteLine("* THREAD " + threads)
+      elif command == "LOGOUT":
+        self.WriteLine("* BYE")
+        self.WriteLine(tag + " OK LOGOUT completed")
+        return
+      self.WriteLine(tag + " OK %s completed" % command)
+
+  def WriteFetch(self, uids):
+    for uid, header, size in self.messages:
+      if uid not in uids:
+        continue
+      date = email.utils.parsedate_tz(
+          email.message_from_string(header).get("Date"))
+      internal_date = time.strftime("%d-%b-%Y %H:%M:%S +0000",
+                                    time.gmtime(email.utils.mktime_tz(date)))
+      self.wfile.write(
+          '* %s FETCH (UID %s FLAGS () INTERNALDATE "%s" RFC822.SIZE %d '
+          'RFC822.HEADER {%d}\r\n%s)\r\n' % (
+              uid, uid, internal_date, size, len(header), header))
+
+  def GetThreads(self):
+    thread_messages = []
+    for uid, header, size in self.messages:
+      try:
+        thread_message = jwzthreading.make_message(
+            email.message_from_string(header))
+      except ValueError:
+        continue
+      thread_message.message = uid
+      thread_messages.append(thread_message)
+
+    def Format(container):
+      if container.message is None:
+        return "".join("(%s)" % Format(child) for child in container.children)
+
+      text = container.message.message
+      if len(container.children) == 1:
+        text += " " + Format(container.children[0])
+      elif container.children:
+        text += " " + "".join("(%s)" % Format(child)
+                              for child in container.children)
+      return text
+
+    return "".join("(%s)" % Format(container) for container in
+                   jwzthreading.thread(thread_messages).values())
+
+def LoadMessages(path):
+  messages = []
+  for uid, message in enumerate(mailbox.mbox(path)):
+    text = message.as_string()
+    header = text.split("\n\n", 1)[0].replace("\n", "\r\n") + "\r\n\r\n"
+    messages.append((str(uid + 1), header, len(text)))
+  return messages
+
+def Describe(forest):
+  """The threads of forest, by subject, as nested (Message-ID, children)"""
+  def DescribeNode(node):
+    message = forest.get_message(node)
+    return (message and message.message_id,
+            [DescribeNode(child) for child in forest.children(node)])
+
+  return dict((subject, DescribeNode(node))
+              for subject, node in forest.subject_table.iteritems())
+
+def Check():
+  imap = mail.Mail("127.0.0.1", False, "user", "password",
+                   server_threads=True)
+  imap.SelectMailbox("INBOX")
+  message_infos = imap.GetMessageInfos()
+  trees = imap.GetThreads()
+  imap.Logout()
+
+  thread_messages = []
+  for message_info in message_infos:
+    if message_info.message_id is None:
+      continue
+    thread_message = jwzthreading.Message()
+    thread_message.message_id = message_info.message_id
+    thread_message.references = message_info.references
+    thread_message.subject = message_info.subject
+    thread_message.normalized_subject = message_info.normalized_subject
+    thread_message.message_info = message_info
+    thread_messages.append(thread_message)
+
+  index_of = dict((thread_message.message_info.GetUid(), index)
+                  for index, thread_message in enumerate(thread_messages))
+  server = Describe(
+      jwzthreading.forest_from_trees(thread_messages, trees, index_of))
+  local = Describe(jwzthreading.thread_forest(thread_messages))
+
+  differences = [subject for subject in set(server) | set(local)
+                 if server.get(subject) != local.get(subject)]
+  print "%d messages, %d server threads, %d local threads, %d differ" % (
+      len(message_infos), len(server), len(local), len(differences))
+  for subject in differences[:3]:
+    print "  %r:\n    server %r\n    local  %r" % (
+        subject, server.get(subject), local.get(subject))
+  return len(differences)
+
+logging.basicConfig(level=logging.WARNING)
+
+if len(sys.argv) > 1:
+  StandInServer.messages = LoadMessages(sys.argv[1])
+else:
+  mbox_file = tempfile.NamedTemporaryFile(suffix=".mbox")
+  mbox_file.write(MakeMbox(2000))
+  mbox_file.flush()
+  StandInServer.messages = LoadMessages(mbox_file.name)
+
+SocketServer.TCPServer.allow_reuse_address = True
+server = SocketServer.TCPServer(("127.0.0.1", 0), StandInServer)
+serving = threading.Thread(target=server.serve_forever)
+serving.daemon = True
+serving.start()
+
+# mail.Mail always connects to the default port
+_IMAP4 = imaplib.IMAP4
+
+class StandInIMAP4(_IMAP4):
+  def __init__(self, host):
+    _IMAP4.__init__(self, host, server.server_address[1])
+
+imaplib.IMAP4 = StandInIMAP4
+
+differences = 0
+for literal_threads in (False, True):
+  StandInServer.literal_threads = literal_threads
+  print literal_threads and "THREAD data as a literal:" or "THREAD data inline:"
+  differences += Check()
+
+server.shutdown()
+sys.exit(differences and 1 or 0)
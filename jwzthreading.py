@@ -17,16 +17,30 @@ To use:
   message.  You'll probably want to sort these children by date, subject,
   or some other criterion.
 
+  For large mailboxes, call thread_forest() instead.  It threads the
+  messages the same way, but returns a ThreadForest that keeps the
+  trees in flat integer arrays rather than one Container per message.
+  A ThreadState does the same, but can be saved and updated with the
+  messages that arrived since, re-threading only what they affect.
+
 Copyright (c) 2003-2010, A.M. Kuchling.
 
 This code is under a BSD-style license; see the LICENSE file for details.
 
 """
 
+import cPickle
+import os
 import re
+import tempfile
+from array import array
 from collections import deque
+from itertools import izip
 
-__all__ = ['Message', 'make_message', 'thread']
+__all__ = ['Message', 'make_message', 'get_message_ids',
+           'normalize_subject', 'thread',
+           'ThreadForest', 'Thread', 'ThreadState', 'thread_forest',
+           'forest_from_trees']
 
 class Container:
     """Contains a tree of messages.
@@ -72,7 +86,7 @@ class Container:
         self.children.remove(child)
         child.parent = None
 
-    def has_descendant (self, ctr, seen=[]):
+    def has_descendant (self, ctr):
         """(Container): bool
 
         Returns true if 'ctr' is a descendant of this Container.
@@ -80,18 +94,17 @@ class Container:
         # To avoid recursing indefinitely, we'll do a depth-first search;
         # 'seen' tracks the containers we've already seen, and 'stack'
         # is a deque containing containers that we need to look at.
-        seen.append(self)
-
-        for c in self.children:
-            if c in seen:
-                continue
+        seen = set([self])
+        stack = deque([self])
 
-            if c is ctr:
-                return True
+        while stack:
+            for c in stack.pop().children:
+                if c is ctr:
+                    return True
 
-            r = c.has_descendant(ctr, seen)
-            if r:
-                return True
+                if c not in seen:
+                    seen.add(c)
+                    stack.append(c)
 
         return False
 
@@ -120,40 +133,64 @@ class Container:
 
 
 
-    def purge(self, prev=None):
-        if prev is None:
-            prev = {self: True}
-        else:
-            prev[self] = True
+    def purge(self):
+        """Removes the links that close loops in this tree."""
+        seen = set([self])
+        stack = [self]
 
-        for c in self.children:
-            if c in prev:
-                print_container(c, 0, True)
-                self.remove_child(c)
-            else:
-                c.purge(prev)
+        while stack:
+            node = stack.pop()
+            for c in node.children[:]:
+                if c in seen:
+                    print_container(c, 0, True)
+                    node.remove_child(c)
+                else:
+                    seen.add(c)
+                    stack.append(c)
 
+    def __len__(self):
+        """Returns the number of containers in this tree.
 
-    def __len__(self, prev=None):
-        if prev is None:
-            prev = {self: True}
-        else:
-            prev[self] = True
-
-        count = 1
-        for c in self.children:
-            if c in prev:
-                #print "BUG: LOOP DETECTED"
-                #print_container(c, 10, True)
-                # TODO: Fix this hack
-                self.remove_child(c)
-            else:
-                count += c.__len__(prev)
-        return count
+        This walks the whole tree, so callers that need the size more
+        than once should keep the result.
+        """
+        seen = set([self])
+        stack = [self]
+
+        while stack:
+            for c in stack.pop().children:
+                if c not in seen:
+                    seen.add(c)
+                    stack.append(c)
+
+        return len(seen)
 
 def uniq(alist):
-    set = {}
-    return [set.setdefault(e,e) for e in alist if e not in set.keys()]
+    seen = set()
+    result = []
+    for e in alist:
+        if e not in seen:
+            seen.add(e)
+            result.append(e)
+    return result
+
+def is_ancestor(ctr, node):
+    """(Container, Container): bool
+
+    Returns true if 'ctr' is 'node' itself or one of its ancestors.
+    Only parent links are followed, so this costs at most the depth
+    of 'node'.
+    """
+    # A container without children can't be anybody else's ancestor
+    if not ctr.children:
+        return ctr is node
+
+    while node is not None:
+        if node is ctr:
+            return True
+        node = node.parent
+
+    return False
 
 msgid_pat = re.compile('<([^>]+)>')
 restrip_pat = re.compile("""(
@@ -161,32 +198,72 @@ restrip_pat = re.compile("""(
 \s*)+
 """, re.I | re.VERBOSE)
 
-def make_message (msg):
-    """(msg:rfc822.Message) : Message
-    Create a Message object for threading purposes from an RFC822
-    message.
+# Interned subjects, and the interned stripped forms
+_subjects = {}
+_normalized_subjects = {}
+
+def normalize_subject (subject):
+    """(str) : (str, str)
+
+    Returns the subject and its form without 're:' and '[list]'
+    prefixes, both interned.  Each distinct subject is only stripped
+    once, so callers that see the same subjects again (threading, or
+    stats that count subjects) can compare and hash the shared strings.
     """
-    new = Message(msg)
+    pair = _subjects.get(subject)
+    if pair is None:
+        normalized = restrip_pat.sub('', subject)
+        normalized = _normalized_subjects.setdefault(normalized, normalized)
+        pair = _subjects[subject] = (subject, normalized)
+    return pair
 
-    m = msgid_pat.search(msg.get("Message-ID", ""))
-    if m is None:
-        raise ValueError("Message does not contain a Message-ID: header")
+def get_normalized_subject (msg):
+    """(Message) : str
 
-    new.message_id = m.group(1)
+    Returns the stripped subject of msg, normalizing it the first time.
+    """
+    if msg.normalized_subject is None:
+        msg.subject, msg.normalized_subject = normalize_subject(msg.subject)
+    return msg.normalized_subject
+
+def get_message_ids (msg):
+    """(msg:rfc822.Message) : (str, (str))
+    Returns the ID from the Message-ID: header of an RFC822 message, or
+    None if there is none, and a tuple of the unique message IDs from
+    its References: and In-Reply-To: headers.
+    """
+    m = msgid_pat.search(msg.get("Message-ID", ""))
+    message_id = m and m.group(1)
 
     # Get list of unique message IDs from the References: header
     refs = msg.get("References", "")
-    new.references = msgid_pat.findall(refs)
-    new.references = uniq(new.references)
-    new.subject = msg.get('Subject', "No subject")
+    references = uniq(msgid_pat.findall(refs))
 
     # Get In-Reply-To: header and add it to references
     in_reply_to = msg.get("In-Reply-To", "")
     m = msgid_pat.search(in_reply_to)
     if m:
         msg_id = m.group(1)
-        if msg_id not in new.references:
-            new.references.append(msg_id)
+        if msg_id not in references:
+            references.append(msg_id)
+
+    return message_id, tuple(references)
+
+def make_message (msg):
+    """(msg:rfc822.Message) : Message
+    Create a Message object for threading purposes from an RFC822
+    message.
+    """
+    new = Message(msg)
+
+    message_id, references = get_message_ids(msg)
+    if message_id is None:
+        raise ValueError("Message does not contain a Message-ID: header")
+
+    new.message_id = message_id
+    new.references = list(references)
+    new.subject, new.normalized_subject = normalize_subject(
+        msg.get('Subject', "No subject"))
 
     return new
 
@@ -196,21 +273,27 @@ class Message (object):
     Instance attributes:
     .subject : str
       Subject line of the message.
+    .normalized_subject : str
+      Subject line without 're:' prefixes, as set by normalize_subject().
+      Left as None, it is filled in when the message is threaded.
     .message_id : str
       Message ID as retrieved from the Message-ID header.
     .references : [str]
-      List of message IDs from the In-Reply-To and References headers.
+      List (or tuple) of message IDs from the In-Reply-To and References
+      headers.
     .message : any
       Can contain information for the caller's use (e.g. an RFC-822 message object).
 
     """
-    __slots__ = ['message', 'message_id', 'references', 'subject', 'message_info']
+    __slots__ = ['message', 'message_id', 'references', 'subject',
+                 'normalized_subject', 'message_info']
 
     def __init__(self, msg=None):
         self.message = msg
         self.message_id = None
         self.references = []
         self.subject = None
+        self.normalized_subject = None
 	self.message_info = None
 
     def __repr__ (self):
@@ -218,49 +301,56 @@ class Message (object):
 
 def prune_container (container):
     """(container:Container) : [Container]
-    Recursively prune a tree of containers, as described in step 4
-    of the algorithm.  Returns a list of the children that should replace
+    Prune a tree of containers, as described in step 4 of the
+    algorithm.  Returns a list of the children that should replace
     this container.
+
+    The tree is walked iteratively, so very deep threads can't hit
+    the recursion limit.
     """
 
-    # Prune children, assembling a new list of children
-    new_children = []
-
-    ##old_children = container.children[:]
-
-    for ctr in container.children[:]:
-        L = prune_container(ctr)
-        new_children.extend(L)
-        container.remove_child(ctr)
-
-    for c in new_children:
-        container.add_child(c)
-
-    ##if new_children != old_children:
-    ##    print 'Children for ' + repr(container) + 'Changed'
-    ##    print 'OLD children:'
-    ##    for ctr in old_children:
-    ##        print_container(ctr, 0, True)
-    ##    print 'NEW children:'
-    ##    for ctr in container.children[:]:
-    ##        print_container(ctr, 0, True)
-
-    if (container.message is None and
-        len(container.children) == 0):
-        # 4.A: nuke empty containers
-        return []
-    elif (container.message is None and
-          (len(container.children)==1 or
-           container.parent is not None)):
-        # 4.B: promote children
-        L = container.children[:]
-        ##print "Promoting "+repr(len(container.children))+" children"
-        for c in L:
-            container.remove_child(c)
-        return L
-    else:
-        # Leave this node in place
-        return [container]
+    # List the containers so that every child comes before its parent
+    order = []
+    seen = set()
+    stack = [container]
+    while stack:
+        ctr = stack.pop()
+        if ctr not in seen:
+            seen.add(ctr)
+            order.append(ctr)
+            stack.extend(ctr.children)
+    order.reverse()
+
+    replacements = {}
+    for ctr in order:
+        # Prune children, assembling a new list of children
+        new_children = []
+        for c in ctr.children:
+            new_children.extend(replacements.pop(c, ()))
+            c.parent = None
+        ctr.children = []
+
+        for c in new_children:
+            ctr.add_child(c)
+
+        if (ctr.message is None and
+            len(ctr.children) == 0):
+            # 4.A: nuke empty containers
+            replacements[ctr] = []
+        elif (ctr.message is None and
+              (len(ctr.children)==1 or
+               ctr.parent is not None)):
+            # 4.B: promote children
+            L = ctr.children
+            for c in L:
+                c.parent = None
+            ctr.children = []
+            replacements[ctr] = L
+        else:
+            # Leave this node in place
+            replacements[ctr] = [ctr]
+
+    return replacements[container]
 
 
 def thread (msglist):
@@ -274,6 +364,8 @@ def thread (msglist):
     """
 
     id_table = {}
+    # All containers, in the order they were created
+    containers = []
     for msg in msglist:
         # 1A
         this_container = id_table.get(msg.message_id, None)
@@ -283,6 +375,7 @@ def thread (msglist):
             this_container = Container()
             this_container.message = msg
             id_table[msg.message_id] = this_container
+            containers.append(this_container)
 
         # 1B
         prev = None
@@ -293,13 +386,14 @@ def thread (msglist):
                 container = Container()
                 container.message_id = ref
                 id_table[ref] = container
+                containers.append(container)
 
             if prev is not None:
                 #If they are already linked, don't change the existing links.
                 if container.parent is not None:
                     pass
                 # Don't add link if it would create a loop
-                elif container is this_container or prev.has_descendant(container) or container.has_descendant(container):
+                elif container is this_container or is_ancestor(container, prev):
                     pass
                 else:
                     prev.add_child(container)
@@ -310,18 +404,20 @@ def thread (msglist):
         #1C
         if prev is not None:
             ##print "Setting parent of "+repr(this_container)+", to last reference: " + repr (prev)
-            prev.add_child(this_container)
+            # Again, don't add link if it would create a loop
+            if not is_ancestor(this_container, prev):
+                prev.add_child(this_container)
         else:
             if(this_container.parent):
                 this_container.parent.remove_child(this_container)
         
 
     # 2. Find root set
-    root_set = [container for container in id_table.values()
+    root_set = [container for container in containers
                 if container.parent is None]
     
     # 3. Delete id_table
-    del id_table
+    del id_table, containers
 
     # 4. Prune empty containers
     for container in root_set:
@@ -347,12 +443,10 @@ def thread (msglist):
     subject_table = {}
     for container in root_set:
         if container.message:
-            subj = container.message.subject
+            subj = get_normalized_subject(container.message)
         else:
-            c = container.children[0]
-            subj = container.children[0].message.subject
+            subj = get_normalized_subject(container.children[0].message)
 
-        subj = restrip_pat.sub('', subj)
         if subj == "":
             continue
 
@@ -367,29 +461,36 @@ def thread (msglist):
 
     # 5C
     for container in root_set:
+        # Already merged into another thread
+        if container.parent is not None:
+            continue
+
         if container.message:
-            subj = container.message.subject
+            subj = get_normalized_subject(container.message)
         else:
-            subj = container.children[0].message.subject
+            subj = get_normalized_subject(container.children[0].message)
 
-        subj = restrip_pat.sub('', subj)
         ctr = subject_table.get(subj)
         if ctr is None or ctr is container:
             continue
+        # The subject table must keep pointing at the root of the merged
+        # thread, since it is what we return
         if ctr.is_dummy() and container.is_dummy():
-            for c in ctr.children:
-                container.add_child(c)
+            for c in container.children[:]:
+                ctr.add_child(c)
         elif ctr.is_dummy() or container.is_dummy():
             if ctr.is_dummy():
                 ctr.add_child(container)
             else:
                 container.add_child(ctr)
+                subject_table[subj] = container
         elif len(ctr.message.subject) < len(container.message.subject):
             # ctr has fewer levels of 're:' headers
             ctr.add_child(container)
         elif len(ctr.message.subject) > len(container.message.subject):
             # container has fewer levels of 're:' headers
             container.add_child(ctr)
+            subject_table[subj] = container
         else:
             new = Container()
             new.add_child(ctr)
@@ -399,6 +500,760 @@ def thread (msglist):
     return subject_table
 
 
+class ThreadForest(object):
+    """Holds the trees built by thread_forest() in flat integer arrays.
+
+    Every Message-ID (and every dummy added while grouping by subject)
+    is a node numbered from 0.  Instead of a Container object per node,
+    the links of node i are kept in parallel arrays, with -1 meaning
+    "none":
+
+      .parent[i], .first_child[i], .last_child[i],
+      .prev_sibling[i], .next_sibling[i]
+
+    .message[i] is the index of the node's Message in .messages, or -1
+    for a dummy node.
+
+    Instance attributes:
+      .messages : [Message]
+        The message store that .message indexes into.
+      .id_table : {string:int}
+        Maps each Message-ID to its node.
+      .subject_table : {string:int}
+        Maps subjects to the root node of each thread.
+      .lengths : {int:int}
+        Caches the results of thread_length().
+    """
+
+    def __init__(self, messages):
+        self.messages = messages
+        self.parent = array('i')
+        self.first_child = array('i')
+        self.last_child = array('i')
+        self.prev_sibling = array('i')
+        self.next_sibling = array('i')
+        self.message = array('i')
+        self.id_table = {}
+        self.subject_table = {}
+        self.lengths = {}
+
+    def __getstate__(self):
+        # The messages belong to the run that threaded them
+        state = self.__dict__.copy()
+        state['messages'] = []
+        return state
+
+    def node_count(self):
+        return len(self.parent)
+
+    def new_node(self, message=-1):
+        node = len(self.parent)
+        for links in (self.parent, self.first_child, self.last_child,
+                      self.prev_sibling, self.next_sibling):
+            links.append(-1)
+        self.message.append(message)
+        return node
+
+    def is_dummy(self, node):
+        return self.message[node] == -1
+
+    def get_message(self, node):
+        index = self.message[node]
+        if index == -1:
+            return None
+        return self.messages[index]
+
+    def children(self, node):
+        child = self.first_child[node]
+        while child != -1:
+            yield child
+            child = self.next_sibling[child]
+
+    def add_child(self, node, child):
+        if self.parent[child] != -1:
+            self.remove_child(self.parent[child], child)
+
+        last = self.last_child[node]
+        if last == -1:
+            self.first_child[node] = child
+        else:
+            self.next_sibling[last] = child
+        self.prev_sibling[child] = last
+        self.last_child[node] = child
+        self.parent[child] = node
+
+    def remove_child(self, node, child):
+        prev = self.prev_sibling[child]
+        next = self.next_sibling[child]
+        if prev == -1:
+            self.first_child[node] = next
+        else:
+            self.next_sibling[prev] = next
+        if next == -1:
+            self.last_child[node] = prev
+        else:
+            self.prev_sibling[next] = prev
+        self.parent[child] = self.prev_sibling[child] = \
+            self.next_sibling[child] = -1
+
+    def is_ancestor(self, node, other):
+        """(int, int): bool
+
+        Returns true if 'node' is 'other' itself or one of its
+        ancestors, like is_ancestor() does for Containers.
+        """
+        if self.first_child[node] == -1:
+            return node == other
+
+        while other != -1:
+            if other == node:
+                return True
+            other = self.parent[other]
+
+        return False
+
+    def thread_length(self, node):
+        """(int): int
+
+        Returns the number of nodes in the tree rooted at 'node'.
+        """
+        count = self.lengths.get(node)
+        if count is None:
+            count = 0
+            stack = [node]
+            while stack:
+                count += 1
+                stack.extend(self.children(stack.pop()))
+            self.lengths[node] = count
+        return count
+
+    def prune(self, root):
+        """(int) : [int]
+        Prune the tree rooted at 'root' as described in step 4 of the
+        algorithm, like prune_container() does for Containers.  Returns
+        a list of the nodes that should replace 'root'.
+        """
+
+        # List the nodes so that every child comes before its parent
+        order = []
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            order.append(node)
+            stack.extend(self.children(node))
+        order.reverse()
+
+        replacements = {}
+        for node in order:
+            # Detach the children, collecting what replaces each of them
+            new_children = []
+            child = self.first_child[node]
+            while child != -1:
+                new_children.extend(replacements.pop(child))
+                next = self.next_sibling[child]
+                self.parent[child] = self.prev_sibling[child] = \
+                    self.next_sibling[child] = -1
+                child = next
+            self.first_child[node] = self.last_child[node] = -1
+
+            for child in new_children:
+                self.add_child(node, child)
+
+            if (self.message[node] == -1 and
+                len(new_children) == 0):
+                # 4.A: nuke empty containers
+                replacements[node] = []
+            elif (self.message[node] == -1 and
+                  (len(new_children) == 1 or
+                   self.parent[node] != -1)):
+                # 4.B: promote children
+                for child in new_children:
+                    self.remove_child(node, child)
+                replacements[node] = new_children
+            else:
+                # Leave this node in place
+                replacements[node] = [node]
+
+        return replacements[root]
+
+    def get_subject(self, node):
+        """(int) : string
+
+        Returns the subject of the message at 'node', or of its first
+        child's message for a dummy node.
+        """
+        if self.message[node] == -1:
+            node = self.first_child[node]
+        return self.messages[self.message[node]].subject
+
+    def get_normalized_subject(self, node):
+        """(int) : string
+
+        Like get_subject(), but returns the stripped subject.
+        """
+        if self.message[node] == -1:
+            node = self.first_child[node]
+        return get_normalized_subject(self.messages[self.message[node]])
+
+
+class Thread(object):
+    """One thread of a ThreadForest, with the attributes the stats
+    used to read from root Containers.
+
+    Instance attributes:
+      .forest : ThreadForest
+      .node : int
+        Root node of the thread.
+      .subject : str
+      .length : int
+        Number of nodes in the thread, counted once when created.
+    """
+    __slots__ = ['forest', 'node', 'subject', 'length']
+
+    def __init__(self, forest, node, subject):
+        self.forest = forest
+        self.node = node
+        self.subject = subject
+        self.length = forest.thread_length(node)
+
+    @property
+    def message(self):
+        return self.forest.get_message(self.node)
+
+    def is_dummy(self):
+        return self.forest.is_dummy(self.node)
+
+    def __repr__(self):
+        return '<%s %d: %r>' % (self.__class__.__name__, self.node,
+                                self.message)
+
+
+def _fingerprint(msg):
+    return hash((msg.message_id, tuple(msg.references), msg.subject))
+
+
+class ThreadState(object):
+    """Threading state that can be saved and brought up to date with new
+    messages, instead of threading every message again on each run.
+
+    Two ThreadForests share the same node numbers:
+
+      .links : ThreadForest
+        The trees built by step 1, which are never pruned.  Its
+        .id_table maps each Message-ID to its node.
+      .forest : ThreadForest
+        The pruned trees grouped by subject, as thread_forest() returns
+        them.
+
+    The roots of .links are tracked by the subject they are grouped
+    under:
+
+      .pruned_roots : {int:int}
+        Maps a root of .links to the node that replaces it after pruning.
+      .root_subjects : {int:string}
+        Maps a root of .links to the stripped subject of its pruned node.
+      .subject_roots : {string:set}
+        The roots of .links grouped under each stripped subject.
+      .subject_dummies : {string:[int]}
+        The dummy nodes added while grouping each subject.
+      .fingerprints : array
+        A hash of the Message-ID, references and subject of each message
+        of the last update, in order.
+
+    Grouping by subject never mixes two subjects, so new messages only
+    require the roots they reach to be pruned again, and the subjects of
+    those roots to be grouped again.
+    """
+
+    def __init__(self):
+        self.links = ThreadForest([])
+        self.forest = ThreadForest([])
+        self.forest.id_table = self.links.id_table
+        self.pruned_roots = {}
+        self.root_subjects = {}
+        self.subject_roots = {}
+        self.subject_dummies = {}
+        self.free_nodes = []
+        self.fingerprints = array('l')
+
+    @classmethod
+    def load(cls, path):
+        f = open(path, 'rb')
+        try:
+            return cPickle.load(f)
+        finally:
+            f.close()
+
+    def save(self, path):
+        # Write next to the old state and rename, so that an interrupted
+        # run never leaves a truncated file behind
+        temp_fd, temp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(path)))
+        temp_fp = os.fdopen(temp_fd, 'wb')
+        cPickle.dump(self, temp_fp, cPickle.HIGHEST_PROTOCOL)
+        temp_fp.close()
+        os.rename(temp_path, path)
+
+    def update(self, msglist):
+        """([Message]) : ThreadForest
+
+        Threads msglist, which holds every message of this run, old and
+        new.  When it starts with the messages of the last update (the
+        same Message-IDs, references and subjects), in the same order,
+        those are only pointed at their place in msglist; the
+        new ones after them go through step 1, and only the roots they
+        reach are pruned and grouped again.  Otherwise (messages were
+        deleted, filtered out or came back, or the order changed), the
+        links made by step 1 can't be taken back, and everything is
+        threaded again.  Either way the threads are those of threading
+        msglist from scratch.  Returns .forest, with msglist as its
+        message store.
+        """
+
+        links = self.links
+        forest = self.forest
+        id_table = links.id_table
+        links.messages = forest.messages = msglist
+
+        if links.node_count() == 0:
+            for index, msg in enumerate(msglist):
+                self._link(msg, index, None)
+
+            # Nothing to reuse: prune every root and group every subject
+            for name in ('parent', 'first_child', 'last_child',
+                         'prev_sibling', 'next_sibling', 'message'):
+                setattr(forest, name, array('i', getattr(links, name)))
+
+            subjects = set()
+            for node in xrange(links.node_count()):
+                if links.parent[node] == -1:
+                    subjects.add(self._add_root(node, False))
+            subjects.discard(None)
+            for subj in subjects:
+                self._group(subj, None)
+
+            self._set_fingerprints(msglist)
+            return forest
+
+        fingerprints = self.fingerprints
+        old_count = len(fingerprints)
+        if len(msglist) < old_count:
+            return self._rebuild(msglist)
+        for index in xrange(old_count):
+            if _fingerprint(msglist[index]) != fingerprints[index]:
+                return self._rebuild(msglist)
+
+        # Point the messages we already know at this run's store
+        for index in xrange(old_count):
+            node = id_table[msglist[index].message_id]
+            links.message[node] = forest.message[node] = index
+
+        touched = set()
+        for index in xrange(old_count, len(msglist)):
+            self._link(msglist[index], index, touched)
+
+        # Forget what the affected roots contributed, then prune them
+        # again
+        roots = self._find_roots(touched)
+        subjects = set()
+        for node in touched | roots:
+            subjects.add(self._drop_root(node))
+        for node in roots:
+            subjects.add(self._add_root(node, True))
+        subjects.discard(None)
+
+        for subj in subjects:
+            self._group(subj, roots)
+
+        self._set_fingerprints(msglist)
+        return forest
+
+    def _rebuild(self, msglist):
+        self.__init__()
+        return self.update(msglist)
+
+    def _set_fingerprints(self, msglist):
+        self.fingerprints = array('l', [_fingerprint(msg) for msg in msglist])
+
+    def _new_node(self, message=-1):
+        self.links.new_node(message)
+        return self.forest.new_node(message)
+
+    def _link(self, msg, index, touched):
+        """Step 1 for a single message.  Nodes whose links change are
+        added to 'touched', unless it is None.
+        """
+        links = self.links
+        id_table = links.id_table
+        parent = links.parent
+        changed = []
+
+        # 1A
+        this_node = id_table.get(msg.message_id, None)
+        if this_node is not None:
+            links.message[this_node] = self.forest.message[this_node] = index
+        else:
+            this_node = self._new_node(index)
+            id_table[msg.message_id] = this_node
+        changed.append(this_node)
+
+        # 1B
+        prev = -1
+        for ref in msg.references:
+            node = id_table.get(ref, None)
+            if node is None:
+                node = self._new_node()
+                id_table[ref] = node
+                changed.append(node)
+
+            if prev != -1:
+                #If they are already linked, don't change the existing links.
+                if parent[node] != -1:
+                    pass
+                # Don't add link if it would create a loop
+                elif node == this_node or links.is_ancestor(node, prev):
+                    pass
+                else:
+                    links.add_child(prev, node)
+                    changed.append(prev)
+                    changed.append(node)
+
+            prev = node
+
+        #1C
+        if prev != -1:
+            if not links.is_ancestor(this_node, prev):
+                changed.append(parent[this_node])
+                changed.append(prev)
+                links.add_child(prev, this_node)
+        elif parent[this_node] != -1:
+            changed.append(parent[this_node])
+            links.remove_child(parent[this_node], this_node)
+
+        if touched is not None:
+            touched.update(changed)
+            touched.discard(-1)
+
+    def _find_roots(self, nodes):
+        """({int}) : {int}
+
+        Returns the roots of .links above the given nodes.
+        """
+        parent = self.links.parent
+        root_of = {}
+        for node in nodes:
+            path = []
+            while node not in root_of and parent[node] != -1:
+                path.append(node)
+                node = parent[node]
+            root = root_of.get(node, node)
+            root_of[node] = root
+            for node in path:
+                root_of[node] = root
+
+        return set(root_of[node] for node in nodes)
+
+    def _drop_root(self, root):
+        """(int) : string
+
+        Forgets the pruned node of a former root of .links, returning its
+        subject, or None if it wasn't tracked.
+        """
+        if root not in self.pruned_roots:
+            return None
+
+        del self.pruned_roots[root]
+        subj = self.root_subjects.pop(root)
+        if subj:
+            self.subject_roots[subj].discard(root)
+        return subj
+
+    def _add_root(self, root, copy):
+        """(int, bool) : string
+
+        Prunes the tree of .links rooted at 'root' into .forest, first
+        copying its links over when 'copy' is set.  Returns the stripped
+        subject of the pruned node, or None if nothing was left.
+        """
+        links = self.links
+        forest = self.forest
+
+        if copy:
+            lengths = forest.lengths
+            stack = [root]
+            while stack:
+                node = stack.pop()
+                forest.parent[node] = links.parent[node]
+                forest.first_child[node] = links.first_child[node]
+                forest.last_child[node] = links.last_child[node]
+                forest.prev_sibling[node] = links.prev_sibling[node]
+                forest.next_sibling[node] = links.next_sibling[node]
+                forest.message[node] = links.message[node]
+                lengths.pop(node, None)
+                stack.extend(links.children(node))
+
+        pruned = forest.prune(root)
+        if not pruned:
+            return None
+
+        node = pruned[0]
+        subj = forest.get_normalized_subject(node)
+        self.pruned_roots[root] = node
+        self.root_subjects[root] = subj
+        if subj:
+            self.subject_roots.setdefault(subj, set()).add(root)
+        return subj
+
+    def _group(self, subj, pruned):
+        """(string, {int})
+
+        Steps 5B and 5C for one subject.  The roots of .links that are
+        not in 'pruned' (every root if it is None) are pruned again first,
+        since grouping moved their nodes around.
+        """
+        forest = self.forest
+        parent = forest.parent
+        subject_table = forest.subject_table
+
+        # Undo the previous grouping of this subject
+        old = subject_table.pop(subj, None)
+        if old is not None:
+            stack = [old]
+            while stack:
+                node = stack.pop()
+                forest.lengths.pop(node, None)
+                stack.extend(forest.children(node))
+
+        for node in self.subject_dummies.pop(subj, ()):
+            forest.parent[node] = forest.first_child[node] = \
+                forest.last_child[node] = forest.prev_sibling[node] = \
+                forest.next_sibling[node] = -1
+            self.free_nodes.append(node)
+
+        roots = self.subject_roots.get(subj)
+        if not roots:
+            self.subject_roots.pop(subj, None)
+            return
+
+        root_set = []
+        for root in sorted(roots):
+            if pruned is not None and root not in pruned:
+                self._add_root(root, True)
+            root_set.append(self.pruned_roots[root])
+
+        # 5B
+        ctr = None
+        for node in root_set:
+            if (ctr is None or
+                (not forest.is_dummy(ctr) and
+                 forest.is_dummy(node)) or
+                (not forest.is_dummy(ctr) and
+                 not forest.is_dummy(node) and
+                 len(forest.get_subject(ctr)) > len(forest.get_subject(node)))):
+                ctr = node
+
+        # 5C
+        dummies = []
+        for node in root_set:
+            # Already merged into another thread
+            if parent[node] != -1 or ctr == node:
+                continue
+
+            if forest.is_dummy(ctr) and forest.is_dummy(node):
+                for c in list(forest.children(node)):
+                    forest.add_child(ctr, c)
+            elif forest.is_dummy(ctr) or forest.is_dummy(node):
+                if forest.is_dummy(ctr):
+                    forest.add_child(ctr, node)
+                else:
+                    forest.add_child(node, ctr)
+                    ctr = node
+            elif len(forest.get_subject(ctr)) < len(forest.get_subject(node)):
+                # ctr has fewer levels of 're:' headers
+                forest.add_child(ctr, node)
+            elif len(forest.get_subject(ctr)) > len(forest.get_subject(node)):
+                # node has fewer levels of 're:' headers
+                forest.add_child(node, ctr)
+                ctr = node
+            else:
+                if self.free_nodes:
+                    new = self.free_nodes.pop()
+                else:
+                    new = self._new_node()
+                dummies.append(new)
+                forest.add_child(new, ctr)
+                forest.add_child(new, node)
+                ctr = new
+
+        subject_table[subj] = ctr
+        if dummies:
+            self.subject_dummies[subj] = dummies
+
+
+def thread_forest (msglist):
+    """([Message]) : ThreadForest
+
+    Threads the messages exactly like thread() does, but builds a
+    ThreadForest instead of Containers.  msglist becomes the forest's
+    message store, and .subject_table maps subjects to root nodes.
+    Unlike ThreadState.update(), the trees of step 1 are pruned in place,
+    since nothing is kept for a later update.
+    """
+
+    forest = ThreadForest(msglist)
+    id_table = forest.id_table
+    parent = forest.parent
+    message = forest.message
+    new_node = forest.new_node
+    add_child = forest.add_child
+    is_ancestor = forest.is_ancestor
+
+    for index, msg in enumerate(msglist):
+        # 1A
+        this_node = id_table.get(msg.message_id, None)
+        if this_node is not None:
+            message[this_node] = index
+        else:
+            this_node = new_node(index)
+            id_table[msg.message_id] = this_node
+
+        # 1B
+        prev = -1
+        for ref in msg.references:
+            node = id_table.get(ref, None)
+            if node is None:
+                node = new_node()
+                id_table[ref] = node
+
+            if prev != -1:
+                #If they are already linked, don't change the existing links.
+                if parent[node] != -1:
+                    pass
+                # Don't add link if it would create a loop
+                elif node == this_node or is_ancestor(node, prev):
+                    pass
+                else:
+                    add_child(prev, node)
+
+            prev = node
+
+        #1C
+        if prev != -1:
+            if not is_ancestor(this_node, prev):
+                add_child(prev, this_node)
+        elif parent[this_node] != -1:
+            forest.remove_child(parent[this_node], this_node)
+
+    # 2. Find root set
+    root_set = [node for node in xrange(forest.node_count())
+                if parent[node] == -1]
+
+    # 4. Prune empty containers
+    new_root_set = []
+    for node in root_set:
+        new_root_set.extend(forest.prune(node))
+    root_set = new_root_set
+
+    # 5. Group root set by subject
+    subjects = [forest.get_normalized_subject(node) for node in root_set]
+    subject_table = forest.subject_table
+    for node, subj in izip(root_set, subjects):
+        if subj == "":
+            continue
+
+        existing = subject_table.get(subj, None)
+        if (existing is None or
+            (not forest.is_dummy(existing) and
+             forest.is_dummy(node)) or
+            (not forest.is_dummy(existing) and
+             not forest.is_dummy(node) and
+             len(forest.get_subject(existing)) >
+             len(forest.get_subject(node)))):
+            subject_table[subj] = node
+
+    # 5C
+    for node, subj in izip(root_set, subjects):
+        # Already merged into another thread
+        if parent[node] != -1:
+            continue
+
+        ctr = subject_table.get(subj)
+        if ctr is None or ctr == node:
+            continue
+        # The subject table must keep pointing at the root of the merged
+        # thread, since it is what we return
+        if forest.is_dummy(ctr) and forest.is_dummy(node):
+            for c in list(forest.children(node)):
+                add_child(ctr, c)
+        elif forest.is_dummy(ctr) or forest.is_dummy(node):
+            if forest.is_dummy(ctr):
+                add_child(ctr, node)
+            else:
+                add_child(node, ctr)
+                subject_table[subj] = node
+        elif len(forest.get_subject(ctr)) < len(forest.get_subject(node)):
+            # ctr has fewer levels of 're:' headers
+            add_child(ctr, node)
+        elif len(forest.get_subject(ctr)) > len(forest.get_subject(node)):
+            # node has fewer levels of 're:' headers
+            add_child(node, ctr)
+            subject_table[subj] = node
+        else:
+            new = new_node()
+            add_child(new, ctr)
+            add_child(new, node)
+            subject_table[subj] = new
+
+    return forest
+
+
+def forest_from_trees (msglist, trees, index_of):
+    """([Message], [tree], {key:int}) : ThreadForest
+
+    Builds a ThreadForest from threads computed elsewhere, such as by an
+    IMAP server's THREAD command.  Each tree is a (key, [tree]) pair for
+    a message and the trees of its replies; index_of maps keys to
+    indexes in msglist.  Keys it lacks, and None, become dummy nodes.
+    The trees are pruned as in step 4, and roots whose stripped subjects
+    collide are put under a dummy node so that .subject_table keeps all
+    of them.
+    """
+
+    forest = ThreadForest(msglist)
+
+    root_set = []
+    for tree in trees:
+        stack = [(tree, -1)]
+        while stack:
+            (key, children), parent = stack.pop()
+            node = forest.new_node(index_of.get(key, -1))
+            if parent == -1:
+                root = node
+            else:
+                forest.add_child(parent, node)
+            stack.extend((child, node) for child in reversed(children))
+        root_set.extend(forest.prune(root))
+
+    subject_table = forest.subject_table
+    for node in root_set:
+        subj = forest.get_normalized_subject(node)
+        if subj == "":
+            continue
+
+        existing = subject_table.get(subj)
+        if existing is None:
+            subject_table[subj] = node
+        elif forest.is_dummy(existing):
+            forest.add_child(existing, node)
+        else:
+            new = forest.new_node()
+            forest.add_child(new, existing)
+            forest.add_child(new, node)
+            subject_table[subj] = new
+
+    return forest
+
+
 def print_container(ctr, depth=-1, debug=0, indent=0):
     import sys
     if depth == 0:
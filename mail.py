@@ -1,22 +1,102 @@
 #Modified by Joao Paulo Barraca <jpbarraca@ua.pt>
 
 import imaplib
+import itertools
 import logging
+import mmap
+import multiprocessing
 import random
 
 import cache
+import compressed
 import messageinfo
 import stringscanner
 import os
 import email
+import email.header
+import email.utils
 import time
 import re
 
 from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
+
+try:
+    from os import scandir as _scandir
+except ImportError:
+    try:
+        from scandir import scandir as _scandir
+    except ImportError:
+        _scandir = None
+
+# Tokens of a THREAD response (RFC 5256)
+_THREAD_TOKEN = re.compile(r"\(|\)|\d+")
+
+# The size that ends a line followed by a literal
+_LITERAL_SIZE = re.compile(r"\{\d+\}$")
+
+
+def _JoinReply(reply):
+    """
+    Join the data imaplib returned for a response into a single string
+
+    Lines are strings, except those followed by a literal, which come as
+    (line, literal) pairs. The literal takes the place of its size.
+    """
+    parts = []
+    for chunk in reply:
+        if isinstance(chunk, tuple):
+            line, literal = chunk
+            parts.append(_LITERAL_SIZE.sub("", line))
+            parts.append(literal)
+        elif chunk:
+            parts.append(chunk)
+    return "".join(parts)
+
+
+def _ParseThreadReply(thread_reply):
+    """
+    Parse the text of a THREAD response into (uid, children) trees, with
+    None as the uid of the dummy parents of threads whose root is missing
+
+    In "(3 6 (4 23)(44 7 96))", 6 is a reply to 3, and the (4 23) and
+    (44 7 96) threads are replies to 6.
+    """
+    roots = []
+
+    # Each open parenthesis is [the list its first message goes in, the
+    # last message of its chain so far]
+    stack = []
+    for token in _THREAD_TOKEN.findall(thread_reply):
+        if token == "(":
+            if not stack:
+                siblings = roots
+            else:
+                frame = stack[-1]
+                if frame[1] is None:
+                    # A list of threads with no message in front of it
+                    frame[1] = (None, [])
+                    frame[0].append(frame[1])
+                siblings = frame[1][1]
+            stack.append([siblings, None])
+        elif token == ")":
+            stack.pop()
+        else:
+            frame = stack[-1]
+            node = (token, [])
+            if frame[1] is None:
+                frame[0].append(node)
+            else:
+                frame[1][1].append(node)
+            frame[1] = node
+
+    return roots
+
 
 class Mail(object):
     def __init__(self, server, use_ssl, username, password,
-            record=False, replay=False, max_messages=-1, random_subset=False):
+            record=False, replay=False, max_messages=-1, random_subset=False,
+            server_threads=False):
         self.__server = server
         self.__username = username
         self.__record = record
@@ -25,6 +105,7 @@ class Mail(object):
         self.__random_subset = random_subset
 
         self.__current_mailbox = None
+        self.__shard = None
 
         if record or replay:
             self.__cache = cache.FileCache()
@@ -39,6 +120,11 @@ class Mail(object):
 
         self.__mail.login(username, password)
 
+        self.__server_threads = server_threads
+        if server_threads and "THREAD=REFERENCES" not in self.__mail.capabilities:
+            logging.info("Server can't thread messages, threading locally")
+            self.__server_threads = False
+
     def GetMailboxes(self):
         logging.info("Getting mailboxes")
 
@@ -70,6 +156,10 @@ class Mail(object):
 
         self.__current_mailbox = mailbox
 
+    def SelectShard(self, shard):
+        "Only fetch one shard of the UIDs of each mailbox, see _GetShard"
+        self.__shard = shard
+
     def GetMessageIds(self):
         message_infos = self.__UidFetch("ALL", "(INTERNALDATE RFC822.SIZE)")
 
@@ -81,6 +171,20 @@ class Mail(object):
                 "(UID FLAGS INTERNALDATE RFC822.SIZE RFC822.HEADER)",
                 self.__max_messages)
 
+    def GetThreads(self):
+        """
+        Return the threads of the selected mailbox as computed by the server
+        (UID THREAD REFERENCES), as (uid, children) trees, or None if server
+        threading wasn't asked for or isn't supported
+        """
+        if not self.__server_threads:
+            return None
+
+        logging.info("Fetching threads from the server")
+        thread_reply = self.__UidCommand("THREAD", "REFERENCES", "UTF-8", "ALL")
+
+        return _ParseThreadReply(_JoinReply(thread_reply))
+
     def Logout(self):
         logging.info("Logging out")
 
@@ -97,6 +201,10 @@ class Mail(object):
 
         logging.info("  %d messages were listed" % len(message_ids))
 
+        if self.__shard is not None:
+            message_ids = _GetShard(message_ids, self.__shard)
+            logging.info("  %d messages are in this shard" % len(message_ids))
+
         if max_fetch != -1 and len(message_ids) > max_fetch:
             if self.__random_subset:
                 # Pick random sample when there is a max, so that we get more
@@ -194,6 +302,165 @@ class Mail(object):
             assert response == "OK"
 
 
+_DISCOVERY_THREADS = 8
+
+_MAILDIR_SUBDIRS = ('new', 'cur', 'tmp')
+
+_MAILBOX_PACKAGE_DIR = re.compile(".*\/[A-Z0-9]+\-[A-Z0-9]+\-[A-Z0-9]+\-[A-Z0-9]+\-[A-Z0-9]+\/Data\/.*\/Messages")
+
+
+def _GetShard(items, shard):
+    """
+    Return the part of the items list that belongs to shard, an (index,
+    count) pair with index counted from 0. The items are split into count
+    contiguous ranges of (nearly) the same size; with no shard, all of them
+    are returned.
+    """
+    if shard is None:
+        return items
+
+    index, count = shard
+    return items[len(items) * index / count:len(items) * (index + 1) / count]
+
+
+def _ListDir(path):
+    """
+    Return the (subdirectory names, file names) of path
+
+    Symbolic links to directories are listed as files, so that they are
+    never followed. Unreadable directories are treated as empty.
+    """
+    dirs = []
+    files = []
+    try:
+        if _scandir is not None:
+            for entry in _scandir(path):
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(entry.name)
+                else:
+                    files.append(entry.name)
+        else:
+            for name in os.listdir(path):
+                child = os.path.join(path, name)
+                if os.path.isdir(child) and not os.path.islink(child):
+                    dirs.append(name)
+                else:
+                    files.append(name)
+    except OSError:
+        pass
+    return dirs, files
+
+
+def _WalkMaildir(top):
+    """
+    Return (mailbox, message paths) pairs for the Maildirs under top
+
+    A directory is a Maildir when it has new, cur and tmp subdirectories;
+    the messages are the files in those three.
+    """
+    mailboxes = []
+    stack = [top]
+    while stack:
+        dirname = stack.pop()
+        dirnames, filenames = _ListDir(dirname)
+
+        if all(subdirname in dirnames for subdirname in _MAILDIR_SUBDIRS):
+            paths = []
+            for subdirname in _MAILDIR_SUBDIRS:
+                folder = os.path.join(dirname, subdirname)
+                paths.extend([os.path.join(folder, filename)
+                        for filename in _ListDir(folder)[1]
+                        if not filename.startswith('.')])
+            mailboxes.append((dirname, paths))
+
+            dirnames = [subdirname for subdirname in dirnames
+                    if subdirname not in _MAILDIR_SUBDIRS]
+
+        stack.extend([os.path.join(dirname, subdirname)
+                for subdirname in dirnames])
+
+    return mailboxes
+
+
+def _WalkMailBoxPackage(top):
+    """
+    Return (mailbox, message paths) pairs for the .mbox folders under top
+
+    The owning .mbox folder and whether a directory holds messages are
+    worked out once per directory and handed down to its subdirectories,
+    instead of being recomputed for every file.
+    """
+    mailboxes = []
+    stack = [(top, None, False)]
+    while stack:
+        dirname, paths, is_message_dir = stack.pop()
+
+        if dirname.endswith(".mbox"):
+            paths = []
+            mailboxes.append((dirname, paths))
+
+        # Anything below a matching directory matches as well
+        if not is_message_dir:
+            is_message_dir = _MAILBOX_PACKAGE_DIR.match(dirname) is not None
+
+        dirnames, filenames = _ListDir(dirname)
+
+        if is_message_dir and paths is not None:
+            paths.extend([os.path.join(dirname, filename)
+                    for filename in filenames
+                    if not filename.startswith('.') and filename.endswith(".emlx")])
+
+        stack.extend([(os.path.join(dirname, subdirname), paths, is_message_dir)
+                for subdirname in dirnames])
+
+    return mailboxes
+
+
+def _DiscoverMailboxes(path, walk):
+    """
+    Yield the (mailbox, message paths) pairs found under path
+
+    The top-level subtrees of path are walked concurrently, and their
+    mailboxes are yielded as soon as each subtree and the ones before it
+    are done, so messages can be read before the whole tree has been
+    walked. Subtrees, and the mailboxes and messages of each, are yielded
+    in sorted order, so that every run reads messages in the same order.
+    """
+    dirnames, filenames = _ListDir(path)
+
+    pool = ThreadPool(_DISCOVERY_THREADS)
+    try:
+        for mailboxes in pool.imap(walk,
+                [os.path.join(path, dirname) for dirname in sorted(dirnames)]):
+            for mailbox, paths in sorted(mailboxes):
+                paths.sort()
+                yield mailbox, paths
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _GetMailboxes(discovery, mailboxes, discovered):
+    """
+    Yield the mailboxes discovered so far, in the order they were found,
+    then the rest as discovery finds them. They are recorded in mailboxes
+    (name to message paths) and in the discovered list, which every call
+    shares, so that several of these generators can be used at once.
+    """
+    i = 0
+    while True:
+        if i == len(discovered):
+            found = next(discovery, None)
+            if found is None:
+                return
+            mailbox, paths = found
+            logging.info("Found %s", mailbox)
+            mailboxes[mailbox] = paths
+            discovered.append(mailbox)
+        yield discovered[i]
+        i += 1
+
+
 class MaildirInfo(object):
     """
     A semi-greedy Maildir crawler
@@ -212,37 +479,27 @@ class MaildirInfo(object):
          it to the root it will index all Maildirs in your hard drive.
     6. As is this is slower than the mail.Mail class because we read
          the entire mail contents into memory.
+    7. Top-level folders are walked concurrently, and mailboxes are
+         returned by GetMailboxes, in sorted order, as soon as their folder
+         (and the ones before it) has been walked.
 
     """
     def __init__(self, path):
         self.path = os.path.expanduser(path)
         self.mailboxes = {}
 
-        for dirname, dirnames, filenames in os.walk(self.path):
-
-            for subdirname in dirnames:
-                folder = os.path.join(dirname, subdirname)
-
-                if os.path.isdir(os.path.join(folder, 'new')) and \
-                        os.path.isdir(os.path.join(folder, 'cur')) and \
-                        os.path.isdir(os.path.join(folder, 'tmp')):
-
-                    self.mailboxes[folder] = []
-                    logging.info("Found %s", folder)
-
-            for filename in filenames:
-                box = os.path.dirname(dirname)
-                if not filename.startswith('.') and box in self.mailboxes:
-                    path = os.path.join(dirname, filename )
-                    self.mailboxes[box].append(path)
-
-        if not self.mailboxes:
+        # Wait for the first mailbox
+        self.__discovery = _DiscoverMailboxes(self.path, _WalkMaildir)
+        self.__discovered = []
+        if next(self.GetMailboxes(), None) is None:
                 raise RuntimeError("No mailboxes were found")
         self.__current_mailbox = None
+        self.__shard = None
 
     def GetMailboxes(self):
-        "Return list of mailboxes in this maildir"
-        return self.mailboxes.keys()
+        "Return the mailboxes in this maildir, as they are discovered"
+        return _GetMailboxes(self.__discovery, self.mailboxes,
+                             self.__discovered)
 
     def SelectMailbox(self, mailbox):
         "Set the current mailbox"
@@ -250,6 +507,10 @@ class MaildirInfo(object):
         logging.info("Selecting mailbox '%s'", mailbox)
         self.__current_mailbox = mailbox
 
+    def SelectShard(self, shard):
+        "Only read one shard of the files of each mailbox, see _GetShard"
+        self.__shard = shard
+
     def GetMessageInfos(self):
         """
         Return a list of MessageInfo objects, one per message
@@ -261,11 +522,11 @@ class MaildirInfo(object):
         if self.__current_mailbox and self.mailboxes.has_key(self.__current_mailbox):
             boxes = [self.__current_mailbox]
         else:
-            boxes = self.GetMailboxes()
+            boxes = list(self.GetMailboxes())
 
         info = []
         for mbox in boxes:
-            for path in self.mailboxes[mbox]:
+            for path in _GetShard(self.mailboxes[mbox], self.__shard):
                 mi = messageinfo.MessageInfo()
                 try:
                     fd = open(path, "r")
@@ -295,10 +556,7 @@ class MaildirInfo(object):
                         print("Unable to parse mail, skipping ", path)
                         continue
 
-                    date = email.utils.parsedate_tz(msg["Date"])
-                    t = time.gmtime(email.utils.mktime_tz(date))
-                    maildate = time.strftime("%d-%b-%Y %H:%M:%S", t) + ' %+05d' % (date[9] / 3600)
-                    mi.PopulateField('INTERNALDATE', maildate)
+                    mi.PopulateField('INTERNALDATE', _GetInternalDate(msg))
 
                     info.append(mi)
                 except:
@@ -335,45 +593,49 @@ class MailBoxPackageInfo(object):
     2. Dates might be different from the dates you see in IMAP
     3. As is this is slower than the mail.Mail class because we read
          the entire mail contents into memory.
+    4. Top-level folders are walked concurrently, and mailboxes are
+         returned by GetMailboxes, in sorted order, as soon as their folder
+         (and the ones before it) has been walked.
+    5. When Mail.app's "Envelope Index" database is present, sender,
+         recipients, subject, date, size and Message-ID are read from it in
+         bulk. The index has no List-Id, so it is still read from the
+         header of every .emlx file, unless read_list_ids is False: .emlx
+         files are then not opened at all, and no mailing lists are found.
 
     """
-    def __init__(self, path):
-        import re
+    # Kept from .emlx headers, compared in lower case. The recipients are
+    # the same as the Envelope Index has.
+    _HEADERS = ['from', 'date', 'to', 'cc', 'bcc', 'subject', 'sender',
+                'message-id', 'list-id']
 
+    # Envelope Index recipients.type values
+    _RECIPIENT_HEADERS = {0: 'To', 1: 'Cc', 2: 'Bcc'}
+
+    def __init__(self, path, use_envelope_index=True, read_list_ids=True):
         self.path = os.path.expanduser(path)
         self.mailboxes = {}
-        validDir = re.compile(".*\/[A-Z0-9]+\-[A-Z0-9]+\-[A-Z0-9]+\-[A-Z0-9]+\-[A-Z0-9]+\/Data\/.*\/Messages")
-
-        for dirname, dirnames, filenames in os.walk(self.path):
-            for subdirname in dirnames:
-                folder = os.path.join(dirname, subdirname)
-                if os.path.isdir(folder) and folder.endswith(".mbox"):
-                    self.mailboxes[folder] = []
-                    logging.info("Found %s", folder)
-
-            for filename in filenames:
-                logging.debug("Testing %s", dirname)
-
-                if not validDir.match(dirname):
-                        logging.debug("Ignoring %s", dirname)
-                        continue
-
-                box = dirname
-                while os.path.exists(box) and not box.endswith(".mbox"):
-                    box = os.path.dirname(box)
 
-                if not filename.startswith('.') and filename.endswith(".emlx") and box in self.mailboxes:
-                    logging.debug("Adding file %s/%s to box %s",dirname,filename,box)
-                    path = os.path.join(dirname, filename)
-                    self.mailboxes[box].append(path)
-
-        if not self.mailboxes:
+        # Wait for the first mailbox
+        self.__discovery = _DiscoverMailboxes(self.path, _WalkMailBoxPackage)
+        self.__discovered = []
+        if next(self.GetMailboxes(), None) is None:
                 raise RuntimeError("No mailboxes were found")
         self.__current_mailbox = None
+        self.__shard = None
+
+        self.__envelopes = {}
+        self.__envelope_headers = read_list_ids and ['List-Id'] or []
+        index_path = os.path.join(self.path, "MailData", "Envelope Index")
+        if use_envelope_index and os.path.isfile(index_path):
+            self.__LoadEnvelopeIndex(index_path)
+            if self.__envelopes and not read_list_ids:
+                logging.warning("Not reading List-Ids: mailing lists will be "
+                                "left out")
 
     def GetMailboxes(self):
-        "Return list of mailboxes in this maildir"
-        return self.mailboxes.keys()
+        "Return the mailboxes in this package, as they are discovered"
+        return _GetMailboxes(self.__discovery, self.mailboxes,
+                             self.__discovered)
 
     def SelectMailbox(self, mailbox):
         "Set the current mailbox"
@@ -381,6 +643,10 @@ class MailBoxPackageInfo(object):
         logging.info("Selecting mailbox '%s'", mailbox)
         self.__current_mailbox = mailbox
 
+    def SelectShard(self, shard):
+        "Only read one shard of the files of each mailbox, see _GetShard"
+        self.__shard = shard
+
     def GetMessageInfos(self):
         """
         Return a list of MessageInfo objects, one per message
@@ -392,64 +658,180 @@ class MailBoxPackageInfo(object):
         if self.__current_mailbox and self.mailboxes.has_key(self.__current_mailbox):
             boxes = [self.__current_mailbox]
         else:
-            boxes = self.GetMailboxes()
+            boxes = list(self.GetMailboxes())
 
         info = []
         for mbox in boxes:
             #logging.debug("GetMessages from Mailbox: %s", mbox)
-            for path in self.mailboxes[mbox]:
+            for path in _GetShard(self.mailboxes[mbox], self.__shard):
                 #logging.debug("ReadMessage: %s", path)
 
-                mi = messageinfo.MessageInfo()
                 try:
-                    fd = open(path, "r")
-                    fd.readline()
-
-                    headers = StringIO()
-                    bytes_read = 0
-                    while True:
-                        chunk = fd.read(1024)
-                        if chunk == '':
-                            break
-
-                        bytes_read += len(chunk)
-                        headers.write(chunk)
-                        if '\n\n' in chunk or bytes_read >= 100000:
-                            break
-                    fd.close()
-
-                    msg = email.message_from_string(headers.getvalue())
-
-                    # FIXME: there has to be a better way to do this
-                    # e.g. Just read the headers and stat the file
-                    mi.PopulateField('RFC822.SIZE', os.stat(path).st_size)
-                    mi.PopulateField('RFC822.HEADER', self.__BuildHeader(msg))
-
-                    if "Date" not in msg:
-                        #logging.info("ERROR: Unable to parse file: %s", path)
-                        continue
-
-                    date = email.utils.parsedate_tz(msg["Date"])
-                    t = time.gmtime(email.utils.mktime_tz(date))
-                    maildate = time.strftime("%d-%b-%Y %H:%M:%S", t) + ' %+05d' % (date[9] / 3600)
-                    mi.PopulateField('INTERNALDATE', maildate)
-
-                    info.append(mi)
+                    envelope = self.__envelopes.get(_GetEmlxRowId(path))
+                    if envelope is not None:
+                        mi = self.__GetEnvelopeMessageInfo(envelope, path)
+                    else:
+                        mi = self.__GetEmlxMessageInfo(path)
+
+                    if mi is not None:
+                        info.append(mi)
                 except:
                     #logging.info("ERROR: Unable to parse file: %s", path)
                     pass
 
         return info
 
+    def __ReadEmlxHeader(self, path):
+        """
+        Parse the header block of the .emlx file at path
+
+        Returns (msg, size). An .emlx file starts with a line holding the
+        byte length of the message, which is followed by the message and
+        an Apple plist trailer. That length bounds the header read and is
+        the exact message size, without the trailer.
+        """
+        fd = open(path, "r")
+        try:
+            try:
+                size = int(fd.readline())
+            except ValueError:
+                size = None
+
+            limit = size is None and 100000 or min(size, 100000)
+
+            headers = StringIO()
+            bytes_read = 0
+            last_chunk = ''
+            while bytes_read < limit:
+                chunk = fd.read(min(1024, limit - bytes_read))
+                if chunk == '':
+                    break
+
+                bytes_read += len(chunk)
+                headers.write(chunk)
+                if '\n\n' in last_chunk[-1:] + chunk:
+                    break
+                last_chunk = chunk
+        finally:
+            fd.close()
+
+        if size is None:
+            size = os.stat(path).st_size
+
+        return email.message_from_string(headers.getvalue()), size
+
+    def __GetEmlxMessageInfo(self, path):
+        msg, size = self.__ReadEmlxHeader(path)
+
+        if "Date" not in msg:
+            return None
+
+        mi = messageinfo.MessageInfo()
+        mi.PopulateField('RFC822.SIZE', size)
+        mi.PopulateField('RFC822.HEADER', self.__BuildHeader(msg))
+        mi.PopulateField('INTERNALDATE', _GetInternalDate(msg))
+
+        return mi
+
+    def __GetEnvelopeMessageInfo(self, envelope, path):
+        size, date, header = envelope
+
+        if self.__envelope_headers:
+            msg, emlx_size = self.__ReadEmlxHeader(path)
+            extra_header = StringIO()
+            for k in self.__envelope_headers:
+                if k in msg:
+                    extra_header.write('%s: %s\r\n' % (k, msg[k]))
+            header += extra_header.getvalue()
+
+        t = time.gmtime(date)
+
+        mi = messageinfo.MessageInfo()
+        mi.PopulateField('RFC822.SIZE', size)
+        mi.PopulateField('RFC822.HEADER', header)
+        mi.PopulateField('INTERNALDATE',
+                time.strftime("%d-%b-%Y %H:%M:%S +0000", t))
+
+        return mi
+
+    def __LoadEnvelopeIndex(self, index_path):
+        """
+        Read the envelope of every message from Mail.app's SQLite index
+
+        Each envelope is stored as (size, date, header), keyed by the
+        message ROWID (which is also the .emlx file name). Older indexes
+        have no Message-IDs, which threading needs; every .emlx file would
+        have to be read anyway then, so the index is not used.
+        """
+        import sqlite3
+
+        logging.info("Reading %s", index_path)
+
+        db = sqlite3.connect(index_path)
+        try:
+            def GetColumns(table):
+                return [row[1] for row in
+                        db.execute("PRAGMA table_info(%s)" % table)]
+
+            message_columns = GetColumns("messages")
+            if "global_message_id" not in message_columns or \
+                    "message_id_header" not in GetColumns("message_global_data"):
+                logging.info("  It has no Message-IDs, reading .emlx files instead")
+                return
+
+            query = ("SELECT m.ROWID, m.size, m.date_sent, m.date_received, "
+                    "%s, s.subject, a.address, a.comment, g.message_id_header "
+                    "FROM messages m "
+                    "LEFT JOIN subjects s ON m.subject = s.ROWID "
+                    "LEFT JOIN addresses a ON m.sender = a.ROWID "
+                    "LEFT JOIN message_global_data g "
+                    "ON m.global_message_id = g.ROWID") % (
+                    "subject_prefix" in message_columns and
+                        "m.subject_prefix" or "NULL")
+
+            recipients = {}
+            for message, type, address, comment in db.execute(
+                    "SELECT r.message, r.type, a.address, a.comment "
+                    "FROM recipients r JOIN addresses a ON r.address = a.ROWID "
+                    "ORDER BY r.message, r.type, r.position"):
+                name = MailBoxPackageInfo._RECIPIENT_HEADERS.get(type)
+                if name and address:
+                    recipients.setdefault(message, {}).setdefault(
+                            name, []).append(_FormatAddress(comment, address))
+
+            for (rowid, size, date_sent, date_received, subject_prefix,
+                    subject, address, comment, message_id) in db.execute(query):
+                date = date_sent or date_received
+                if not date or size is None:
+                    continue
+
+                header = StringIO()
+                if address:
+                    header.write('From: %s\r\n' % _FormatAddress(comment, address))
+                for name, values in recipients.get(rowid, {}).items():
+                    header.write('%s: %s\r\n' % (name, ", ".join(values)))
+                if subject is not None:
+                    header.write('Subject: %s\r\n' % _EncodeHeader(
+                            (subject_prefix or "") + subject))
+                header.write('Date: %s\r\n' % email.utils.formatdate(date))
+                if message_id:
+                    header.write('Message-ID: %s\r\n' % message_id.encode("utf-8"))
+
+                self.__envelopes[rowid] = (size, date, header.getvalue())
+        finally:
+            db.close()
+
+        logging.info("  Found %d envelopes", len(self.__envelopes))
+
     def __BuildHeader(self, msg):
         """
         From a dict of header name/value build the
         email header
         """
         header = StringIO()
-        for k in msg.keys():
-            if k in ['From', 'Date', 'To', 'Subject', 'Sender', 'Message-ID', 'List-Id']:
-                header.write('%s: %s\r\n' % (k, msg[k]))
+        for k, v in msg.items():
+            if k.lower() in MailBoxPackageInfo._HEADERS:
+                header.write('%s: %s\r\n' % (k, v))
         return header.getvalue()
 
     def Logout(self):
@@ -457,6 +839,266 @@ class MailBoxPackageInfo(object):
         pass
 
 
+def _GetEmlxRowId(path):
+    """
+    Return the Envelope Index ROWID of the .emlx file at path, which is
+    the leading number of its name (e.g. 1234.emlx or 1234.partial.emlx)
+    """
+    try:
+        return int(os.path.basename(path).split(".", 1)[0])
+    except ValueError:
+        return None
+
+
+def _EncodeHeader(value):
+    "RFC 2047-encode a unicode header value if it is not plain ASCII"
+    try:
+        return value.encode("ascii")
+    except UnicodeError:
+        return email.header.Header(value, "utf-8").encode()
+
+
+def _FormatAddress(name, address):
+    return email.utils.formataddr(
+            (name and _EncodeHeader(name) or "", address.encode("utf-8")))
+
+
+def _GetInternalDate(msg):
+    """
+    Build an IMAP INTERNALDATE string from the Date header of msg
+
+    The date is converted to UTC, so the zone is always +0000.
+    """
+    date = email.utils.parsedate_tz(msg["Date"])
+    t = time.gmtime(email.utils.mktime_tz(date))
+    return time.strftime("%d-%b-%Y %H:%M:%S +0000", t)
+
+
+_MBOX_LINE_LIMIT = 1 << 16
+
+
+def _FindMboxSeparator(data, start, end):
+    """
+    Return the offset of the first "From " separator line starting in
+    [start, end), or -1 if there is none
+    """
+    if start == 0 and data[0:5] == "From ":
+        return 0
+
+    index = data.find("\nFrom ", max(start - 1, 0), end + 5)
+    if index == -1 or index + 1 >= end:
+        return -1
+    return index + 1
+
+
+def _ScanMboxRange(path, start, end):
+    """
+    Return (size, header) pairs for the messages of the mbox at path whose
+    separator line starts in [start, end)
+
+    Only the header block of each message is copied out of the mapping.
+    The size is taken from the separator offsets, and does not include the
+    separator line itself.
+    """
+    records = []
+
+    fd = open(path, "rb")
+    try:
+        data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        fd.close()
+
+    try:
+        length = len(data)
+        separator = _FindMboxSeparator(data, start, end)
+
+        while separator != -1:
+            next_separator = _FindMboxSeparator(data, separator + 1, length)
+            message_end = next_separator != -1 and next_separator or length
+
+            message_start = data.find("\n", separator, message_end) + 1
+            if message_start == 0:
+                message_start = message_end
+
+            header_limit = min(message_end, message_start + 100000)
+            header_end = data.find("\n\n", message_start, header_limit)
+            if header_end == -1:
+                header_end = data.find("\n\r\n", message_start, header_limit)
+            if header_end == -1:
+                header_end = header_limit
+
+            records.append((message_end - message_start,
+                    data[message_start:header_end + 1]))
+
+            if next_separator == -1 or next_separator >= end:
+                break
+            separator = next_separator
+    finally:
+        data.close()
+
+    return records
 
 
+def _ScanMboxRangeStar(args):
+    return _ScanMboxRange(*args)
 
+
+def _ScanMboxStream(fd):
+    """
+    Yield (size, header) pairs for the messages of an mbox read from fd
+
+    The input is consumed one bounded line at a time: header blocks are
+    collected (up to 100000 bytes), body lines are only counted.
+    """
+    size = None
+    header_lines = None
+    header_bytes = 0
+    at_line_start = True
+
+    while True:
+        line = fd.readline(_MBOX_LINE_LIMIT)
+        if not line:
+            break
+
+        if at_line_start and line.startswith("From "):
+            if size is not None:
+                yield size, "".join(header_lines)
+
+            size = 0
+            header_lines = []
+            header_bytes = 0
+            in_header = True
+        elif size is not None:
+            size += len(line)
+
+            if in_header:
+                if at_line_start and (line == "\n" or line == "\r\n"):
+                    in_header = False
+                elif header_bytes < 100000:
+                    header_lines.append(line)
+                    header_bytes += len(line)
+
+        at_line_start = line.endswith("\n")
+
+    if size is not None:
+        yield size, "".join(header_lines)
+
+
+class MboxInfo(object):
+    """
+    A reader for mbox files
+
+    The file is mapped into memory and scanned once for "From " separator
+    lines. A few notes:
+
+    1. Message sizes are derived from the separator offsets, so message
+         bodies are never read or copied.
+    2. Only the header block of each message is parsed.
+    3. With workers > 1 the file is split into byte ranges which are
+         scanned in parallel, each range owning the messages whose
+         separator line starts inside it.
+    4. Dates are taken from the Date header, so they might be different
+         from the dates you see in IMAP.
+    5. Compressed files (.gz, .bz2, .xz) are read as a stream instead,
+         with the decompressor running in its own process when possible.
+
+    """
+    def __init__(self, path, workers=1):
+        self.path = os.path.expanduser(path)
+        self.__workers = max(workers, 1)
+
+        if not os.path.isfile(self.path):
+            raise RuntimeError("No mailboxes were found")
+
+        logging.info("Found %s", self.path)
+        self.__current_mailbox = None
+        self.__shard = None
+
+    def GetMailboxes(self):
+        "Return list of mailboxes in this mbox (the file itself)"
+        return [self.path]
+
+    def SelectMailbox(self, mailbox):
+        "Set the current mailbox"
+
+        logging.info("Selecting mailbox '%s'", mailbox)
+        self.__current_mailbox = mailbox
+
+    def SelectShard(self, shard):
+        """
+        Only read one shard of the file, see _GetShard. Shards are byte
+        ranges, each owning the messages whose separator starts inside it;
+        compressed files can't be split that way, so their messages are
+        dealt to the shards in turn.
+        """
+        self.__shard = shard
+
+    def GetMessageInfos(self):
+        """
+        Return a list of MessageInfo objects, one per message
+        """
+        if compressed.IsCompressed(self.path):
+            fd = compressed.Open(self.path)
+            try:
+                records = _ScanMboxStream(fd)
+                if self.__shard is not None:
+                    index, count = self.__shard
+                    records = itertools.islice(records, index, None, count)
+                return self.__GetMessageInfos(records)
+            finally:
+                fd.close()
+
+        length = os.path.getsize(self.path)
+        if length == 0:
+            return []
+
+        start, end = 0, length
+        if self.__shard is not None:
+            index, count = self.__shard
+            start, end = length * index / count, length * (index + 1) / count
+
+        if self.__workers == 1:
+            records = _ScanMboxRange(self.path, start, end)
+        else:
+            range_size = (end - start) / self.__workers + 1
+            ranges = [
+                    (self.path, range_start, min(range_start + range_size, end))
+                    for range_start in xrange(start, end, range_size)]
+
+            logging.info("  Scanning %d byte ranges", len(ranges))
+
+            pool = multiprocessing.Pool(self.__workers)
+            try:
+                records = []
+                for range_records in pool.imap(_ScanMboxRangeStar, ranges):
+                    records.extend(range_records)
+            finally:
+                pool.close()
+                pool.join()
+
+        return self.__GetMessageInfos(records)
+
+    def __GetMessageInfos(self, records):
+        info = []
+        for size, header in records:
+            mi = messageinfo.MessageInfo()
+            try:
+                mi.PopulateField('RFC822.SIZE', size)
+                mi.PopulateField('RFC822.HEADER', header)
+
+                if "Date" not in mi.headers:
+                    continue
+
+                mi.PopulateField('INTERNALDATE', _GetInternalDate(mi.headers))
+
+                info.append(mi)
+            except:
+                logging.info("ERROR: Unable to parse message in %s", self.path)
+
+        logging.info("  Found %d messages", len(info))
+
+        return info
+
+    def Logout(self):
+        "Do nothing"
+        pass
@@ -3,20 +3,25 @@
 # Modified by Joao Paulo Barraca <jpbarraca@ua.pt>
 
 import codecs
+import cPickle
 import getopt
 import getpass
 import logging
 import messageinfo
+import os
 import re
 import sys
 
 from Cheetah.Template import Template
 import jwzthreading
 
+import filters
 import mail
 import stats.base
 import stats.bucket
+import stats.cube
 import stats.group
+import stats.sketch
 import stats.table
 
 
@@ -24,9 +29,12 @@ def GetOptsMap():
     opts, args = getopt.getopt(sys.argv[1:], "", [
         # Standard options
         "username=", "password=", "use_ssl", "server=", "maildir=", "mailboxpackage=",
+        "mbox=",
 
         # Other params
-        "filter_out=", "me=", "server_mailbox=",
+        "filter_out=", "me=", "server_mailbox=", "workers=",
+        "thread_state=", "server_threads", "count_cube=", "count_cube_in=",
+        "shard=", "merge", "approximate=", "mailboxpackage_skip_list_ids",
 
         # Development options
         "record", "replay",
@@ -35,17 +43,33 @@ def GetOptsMap():
 
     if len(opts) == 0:
         print "Usage: main.py --username=<login> --password=<password> --server=<server_address> [options]"
+        print "       main.py --merge <shard files>"
+        print "       main.py --count_cube_in=path"
         print "Main Parameters"
         print "\t--username=<login>\t\tThe login to use when connecting to the server"
         print "\t--password=<password>\t\tThe password to use when connecting to the server"
         print "\t--server=<server_address>\tThe IP address or DNS name of the server"
         print "\t--maildir=path\t\t\tRead emails from maildir folders"
         print "\t--mailboxpackage=path\t\tRead emails from mailbox packages (Mail.app)"
+        print "\t--mbox=path\t\t\tRead emails from an mbox file"
         print "\nOptions"
         print "\t--filter_out=<filter>\t\tRegular expression to filter results"
         print "\t--me=<address>\t\t\tYour email address"
         print "\t--use_ssl\t\t\tConnect to server using SSL"
         print "\t--server_mailbox=<inbox,mb1>\tOnly consider the given mailboxes (or label)"
+        print "\t--workers=<n>\t\t\tNumber of worker processes to use"
+        print "\t--thread_state=path\t\tKeep threads in path, re-threading only new mail"
+        print "\t--server_threads\t\tUse the threads computed by the IMAP server"
+        print "\t--count_cube=path\t\tSave the message counts by day, hour and size to path"
+        print "\t--count_cube_in=path\t\tOnly draw the time and size charts, from counts saved"
+        print "\t\t\t\t\twith --count_cube, without reading any mail"
+        print "\t--shard=<i/n>\t\t\tOnly process the i-th of n parts of each mailbox, and"
+        print "\t\t\t\t\tsave the partial stats to out/ for --merge"
+        print "\t--merge\t\t\t\tBuild the report from the given shard files"
+        print "\t--approximate=<error>\t\tCount addresses in bounded memory, with counts off"
+        print "\t\t\t\t\tby at most error times the messages (e.g. 0.001)"
+        print "\t--mailboxpackage_skip_list_ids\tDon't open .emlx files when Mail.app's Envelope"
+        print "\t\t\t\t\tIndex is used, leaving out mailing lists"
         print "\n"
         sys.exit()
 
@@ -53,12 +77,23 @@ def GetOptsMap():
     for name, value in opts:
         opts_map[name[2:]] = value
 
+    if "merge" in opts_map:
+        opts_map["merge"] = args
+        assert args, "--merge needs the shard files"
+        return opts_map
+
+    if "count_cube_in" in opts_map:
+        return opts_map
+
     if "maildir" in opts_map:
         return opts_map
 
     if "mailboxpackage" in opts_map:
         return opts_map
 
+    if "mbox" in opts_map:
+        return opts_map
+
     assert "username" in opts_map
 
     if "password" not in opts_map:
@@ -79,16 +114,28 @@ def GetMessageInfos(opts):
         m = mail.MaildirInfo(opts["maildir"])
     else:
         if "mailboxpackage" in opts:
-            m = mail.MailBoxPackageInfo(opts["mailboxpackage"])
+            m = mail.MailBoxPackageInfo(
+                opts["mailboxpackage"],
+                read_list_ids="mailboxpackage_skip_list_ids" not in opts)
+        elif "mbox" in opts:
+            m = mail.MboxInfo(opts["mbox"], int(opts.get("workers", 1)))
         else:
             m = mail.Mail(
                 opts["server"], "use_ssl" in opts, opts[
                     "username"], opts["password"],
                 "record" in opts, "replay" in opts,
                 "max_messages" in opts and int(opts["max_messages"]) or -1,
-                "random_subset" in opts,)
+                "random_subset" in opts,
+                # A shard only sees part of each mailbox, but the server
+                # threads all of it
+                "server_threads" in opts and "shard" not in opts)
+
+    if "shard" in opts:
+        m.SelectShard(ParseShard(opts["shard"]))
 
     message_infos = []
+    server_threads = None
+    selected_count = 0
     server_mailbox = []
     if "server_mailbox" in opts:
         server_mailbox = opts['server_mailbox'].split(",")
@@ -107,7 +154,10 @@ def GetMessageInfos(opts):
                 continue
 
         m.SelectMailbox(mailbox)
+        selected_count += 1
         mb_message_infos = m.GetMessageInfos()
+        if "server_threads" in opts and isinstance(m, mail.Mail):
+            server_threads = m.GetThreads()
         for message_info in mb_message_infos:
             message_info.AddMailbox(mailbox)
         message_infos.extend(mb_message_infos)
@@ -120,130 +170,286 @@ def GetMessageInfos(opts):
 
     m.Logout()
 
+    # UIDs, and so the server's threads, are only meaningful within a mailbox
+    if server_threads is not None and selected_count > 1:
+        logging.info("Server threads only cover one mailbox, threading locally")
+        server_threads = None
+
+    if "filter_out" in opts or "me" in opts:
+        get_verdicts = GetVerdictFunction(
+            message_infos, opts.get("filter_out"), opts.get("me"))
+
     # Filter out those that we're not interested in
     if "filter_out" in opts:
-        message_infos = FilterMessageInfos(message_infos, opts["filter_out"])
+        message_infos = FilterMessageInfos(message_infos, get_verdicts)
 
     # Tag messages as being from the user running the script
     if "me" in opts:
         logging.info("Identifying \"me\" messages")
-        me_addresses = [address.lower().strip()
-                        for address in opts["me"].split(",")]
 
         me_from_count = 0
         me_to_count = 0
 
         for message_info in message_infos:
-            name, address = message_info.GetSender()
-
-            for me_address in me_addresses:
-                if me_address == address:
-                    message_info.is_from_me = True
-                    me_from_count += 1
-                    break
-
-            for name, address in message_info.GetRecipients():
-                for me_address in me_addresses:
-                    if me_address == address:
-                        message_info.is_to_me = True
-                        me_to_count += 1
-                        break
-                if message_info.is_to_me:
-                    break
+            sender_verdict, list_verdict, recipient_verdicts = \
+                get_verdicts(message_info)
+            if sender_verdict & filters.IS_ME:
+                message_info.is_from_me = True
+                me_from_count += 1
+
+            if recipient_verdicts & filters.IS_ME:
+                message_info.is_to_me = True
+                me_to_count += 1
 
         logging.info("  %d messages are from \"me\"" % me_from_count)
         logging.info("  %d messages are to \"me\"" % me_to_count)
 
-    return message_infos
+    return message_infos, server_threads
 
 
-def FilterMessageInfos(message_infos, filter_param):
-    logging.info("Filtering messages")
-    remaining_message_infos = []
-
-    filters = []
-    raw_filters = filter_param.split(",")
-    for raw_filter in raw_filters:
-        operator, value = raw_filter.strip().split(":", 1)
-        filters.append([operator, value.lower()])
+def GetVerdictFunction(message_infos, filter_param, me_param):
+    """
+    A function that gives the filters.GetMessageVerdicts() of a message.
+    The verdicts are worked out once for each address ID, unless addresses
+    aren't numbered (in the approximate mode): then the addresses of each
+    message are matched.
+    """
+    matcher = filters.AddressMatcher(filter_param, me_param)
+    if stats.sketch.GetErrorBound() is not None:
+        return matcher.GetMessageVerdicts
 
+    # The addresses of every message have to be in the table first
     for message_info in message_infos:
-        filtered_out = False
-        for operator, operator_value in filters:
-            if operator == "to":
-                pairs = message_info.GetRecipients()
-            elif operator == "from":
-                pairs = [message_info.GetSender()]
-            elif operator == "list":
-                pairs = [message_info.GetListId()]
-            else:
-                raise AssertionError("unknown operator: %s" % operator)
-
-            values = [name and name.lower() or "" for name, address in pairs] + \
-                [address and address.lower() or "" for name, address in pairs]
-
-            for value in values:
-                if value.find(operator_value) != -1:
-                    filtered_out = True
-                    break
-
-            if filtered_out:
-                break
-
-        if not filtered_out:
-            remaining_message_infos.append(message_info)
+        message_info.GetSenderId()
+
+    verdicts = matcher.GetVerdicts(messageinfo.MessageInfo.GetAddressTable())
+    return lambda message_info: \
+        filters.GetMessageVerdicts(message_info, verdicts)
+
+
+def FilterMessageInfos(message_infos, get_verdicts):
+    logging.info("Filtering messages")
+    remaining_message_infos = [
+        message_info for message_info in message_infos
+        if not filters.IsFilteredOut(get_verdicts(message_info))]
 
     logging.info("  %d messages remaining" % len(remaining_message_infos))
     return remaining_message_infos
 
 
-def ExtractThreads(message_infos):
+def GetThreadMessages(message_infos):
+    """
+    The jwzthreading.Message of each message info (or
+    messageinfo.MessageRecord) that has a Message-ID
+    """
     thread_messages = []
     for message_info in message_infos:
-        try:
-            thread_message = jwzthreading.make_message(message_info.headers)
-        except ValueError:
+        # Messages without a Message-ID can't be threaded
+        if message_info.message_id is None:
             continue
 
-        if thread_message:
-            thread_message.message_info = message_info
-            thread_messages.append(thread_message)
-
-    thread_dict = jwzthreading.thread(thread_messages)
+        thread_message = jwzthreading.Message()
+        thread_message.message_id = message_info.message_id
+        thread_message.references = message_info.references
+        thread_message.subject = message_info.subject
+        thread_message.normalized_subject = message_info.normalized_subject
+        thread_message.message_info = message_info
+        thread_messages.append(thread_message)
+
+    return thread_messages
+
+
+def ExtractThreads(thread_messages, state_path=None, server_threads=None):
+    if server_threads is not None:
+        index_of = dict((thread_message.message_info.GetUid(), index)
+                        for index, thread_message in enumerate(thread_messages))
+        forest = jwzthreading.forest_from_trees(
+            thread_messages, server_threads, index_of)
+    elif state_path is None:
+        forest = jwzthreading.thread_forest(thread_messages)
+    else:
+        if os.path.exists(state_path):
+            state = jwzthreading.ThreadState.load(state_path)
+        else:
+            state = jwzthreading.ThreadState()
+        forest = state.update(thread_messages)
+        state.save(state_path)
 
-    containers = []
-    for subject, container in thread_dict.items():
+    threads = []
+    for subject, node in forest.subject_table.items():
         # jwzthreading is too aggressive in threading by subject and will combine
         # distinct threads that happen to have the same subject. Split them up if
         # we have a dummy container that has lots of children at the first
         # level.
-        if container.is_dummy() and len(container.children) >= 10:
-            for child_container in container.children:
-                child_container.subject = subject
-                containers.append(child_container)
+        children = forest.is_dummy(node) and list(forest.children(node)) or []
+        if len(children) >= 10:
+            for child in children:
+                threads.append(jwzthreading.Thread(forest, child, subject))
         else:
-            container.subject = subject
-            containers.append(container)
+            threads.append(jwzthreading.Thread(forest, node, subject))
+
+    return threads
+
+
+def ParseShard(value):
+    "Turn --shard=i/n (i counted from 1) into an (index, count) pair"
+    index, count = [int(part) for part in value.split("/")]
+    if not 1 <= index <= count:
+        raise ValueError("Invalid shard %s, it should be i/n with 1 <= i <= n"
+                         % value)
+    return index - 1, count
+
+
+def GetShardPath(value):
+    index, count = ParseShard(value)
+    return "out/shard-%d-of-%d.pickle" % (index + 1, count)
+
+
+def SaveShard(dispatcher, thread_messages, path):
+    # The date range and the --approximate error bound go first, so that
+    # MergeShards can check them without loading the stats. Threads can span
+    # shards, so they are only found by MergeShards, from the
+    # messageinfo.MessageRecord of each message, which the shard saves last.
+    shard_file = open(path, "wb")
+    try:
+        cPickle.dump({
+            "date_range": messageinfo.MessageInfo.GetDateRange(),
+            "error_bound": stats.sketch.GetErrorBound(),
+        }, shard_file, cPickle.HIGHEST_PROTOCOL)
+        cPickle.dump(dispatcher.GetState(), shard_file,
+                     cPickle.HIGHEST_PROTOCOL)
+        cPickle.dump([
+            thread_message.message_info.GetRecord()
+            for thread_message in thread_messages
+        ], shard_file, cPickle.HIGHEST_PROTOCOL)
+    finally:
+        shard_file.close()
+
+
+def DescribeErrorBound(error_bound):
+    if error_bound is None:
+        return "exact counts"
+    return "--approximate=%s" % error_bound
+
+
+def ReadShardHeader(path):
+    shard_file = open(path, "rb")
+    try:
+        header = cPickle.load(shard_file)
+    finally:
+        shard_file.close()
+
+    if not isinstance(header, dict):
+        raise ValueError("%s was saved by an older version, run its --shard "
+                         "again" % path)
+    return header
+
+
+def MergeShards(paths, error_bound=None):
+    """
+    Merge the stats saved by --shard runs into a single report. The messages
+    of all the shards are then threaded together, for the thread stats.
+
+    The shards must all have been run with the same --approximate setting,
+    which the merged stats then use. If error_bound is given (--approximate
+    on the --merge run), it has to be that setting too.
+    """
+    headers = [ReadShardHeader(path) for path in paths]
+
+    shard_error_bounds = {}
+    for path, header in zip(paths, headers):
+        shard_error_bounds.setdefault(header["error_bound"], []).append(path)
+    if len(shard_error_bounds) > 1:
+        raise ValueError(
+            "Shards were run with different --approximate settings, and "
+            "can't be merged: %s" % "; ".join(
+                "%s for %s" % (DescribeErrorBound(bound), ", ".join(bound_paths))
+                for bound, bound_paths in sorted(shard_error_bounds.items())))
+
+    shard_error_bound = shard_error_bounds.keys()[0]
+    if error_bound is not None and error_bound != shard_error_bound:
+        raise ValueError(
+            "The shards were run with %s, not --approximate=%s" % (
+                DescribeErrorBound(shard_error_bound), error_bound))
+    stats.sketch.SetErrorBound(shard_error_bound)
+    if shard_error_bound is not None:
+        messageinfo.MessageInfo.SetNumberAddresses(False)
+
+    date_ranges = [header["date_range"] for header in headers]
+    date_range = [min(start for start, end in date_ranges),
+                  max(end for start, end in date_ranges)]
+
+    report_stats = InitStats(date_range)
+    dispatcher = stats.group.StatDispatcher(report_stats)
 
-    return containers
+    thread_messages = []
+    for path in paths:
+        logging.info("Merging %s", path)
+        shard_file = open(path, "rb")
+        try:
+            cPickle.load(shard_file)
+            dispatcher.Merge(cPickle.load(shard_file))
 
+            thread_messages.extend(
+                GetThreadMessages(cPickle.load(shard_file)))
+        finally:
+            shard_file.close()
 
-def InitStats(date_range):
-    s = [
-        stats.base.TitleStat(date_range),
+    logging.info("Extracting threads")
+    dispatcher.Accumulate([], ExtractThreads(thread_messages))
+    dispatcher.FinishAccumulating()
+
+    return report_stats, dispatcher
+
+
+def LoadCountCube(path):
+    """
+    Draw the time and size charts from a cube saved with --count_cube. The
+    rest of the report needs the messages themselves, and is left out.
+    """
+    count_cube = stats.cube.CountCube.Load(path)
+    date_range = count_cube.GetDateRange()
+
+    report_stats = [
+        stats.base.TitleStat(date_range, count_threads=False),
         stats.group.StatTabGroup(
+            InitTimeTab(date_range),
             (
-                "Time",
-                stats.group.StatColumnGroup(
-                    stats.bucket.DayOfWeekStat(),
-                    stats.bucket.TimeOfDayStat(),
-                    stats.bucket.YearStat(date_range),
-                ),
+                "Size",
                 stats.group.StatColumnGroup(
-                    stats.group.MonthStatCollection(date_range),
-                    stats.group.DayStatCollection(date_range),
+                    stats.bucket.SizeBucketStat(),
                 ),
             ),
+        )
+    ]
+
+    # These stats are all drawn from the cube, which is already finished
+    dispatcher = stats.group.StatDispatcher(report_stats)
+    dispatcher.SetCountCube(count_cube)
+
+    return report_stats, dispatcher
+
+
+def InitTimeTab(date_range):
+    return (
+        "Time",
+        stats.group.StatColumnGroup(
+            stats.bucket.DayOfWeekStat(),
+            stats.bucket.TimeOfDayStat(),
+            stats.bucket.YearStat(date_range),
+        ),
+        stats.group.StatColumnGroup(
+            stats.group.MonthStatCollection(date_range),
+            stats.group.DayStatCollection(date_range),
+        ),
+    )
+
+
+def InitStats(date_range):
+    s = [
+        stats.base.TitleStat(date_range),
+        stats.group.StatTabGroup(
+            InitTimeTab(date_range),
             (
                 "Size",
                 stats.group.StatColumnGroup(
@@ -266,6 +472,9 @@ def InitStats(date_range):
                     stats.table.ListIdTableStat(),
                     stats.group.ListDistributionStatCollection(date_range),
                 ),
+                stats.group.StatColumnGroup(
+                    stats.group.DistinctAddressStatCollection(date_range),
+                ),
             ),
             (
                 "Me",
@@ -301,24 +510,54 @@ logging.info("Initializing")
 
 opts = GetOptsMap()
 
-message_infos = GetMessageInfos(opts)
-
-logging.info("Extracting threads")
-threads = ExtractThreads(message_infos)
-
-stats = InitStats(messageinfo.MessageInfo.GetDateRange())
+error_bound = None
+if "approximate" in opts:
+    error_bound = float(opts["approximate"])
+    stats.sketch.SetErrorBound(error_bound)
+    # The address table would keep every address
+    messageinfo.MessageInfo.SetNumberAddresses(False)
+
+if "merge" in opts:
+    report_stats, dispatcher = MergeShards(opts["merge"], error_bound)
+elif "count_cube_in" in opts:
+    report_stats, dispatcher = LoadCountCube(opts["count_cube_in"])
+else:
+    message_infos, server_threads = GetMessageInfos(opts)
+    thread_messages = GetThreadMessages(message_infos)
+
+    # Shards leave threading to --merge, see SaveShard
+    threads = []
+    if "shard" not in opts:
+        logging.info("Extracting threads")
+        threads = ExtractThreads(thread_messages, opts.get("thread_state"),
+                                 server_threads)
+
+    report_stats = InitStats(messageinfo.MessageInfo.GetDateRange())
+
+    logging.info("Generating stats")
+
+    # A single pass over the messages and threads feeds every stat
+    dispatcher = stats.group.StatDispatcher(report_stats)
+    dispatcher.Accumulate(message_infos, threads)
+
+    if "shard" in opts:
+        shard_path = GetShardPath(opts["shard"])
+        logging.info("Saving shard to %s", shard_path)
+        SaveShard(dispatcher, thread_messages, shard_path)
+        logging.info("Done")
+        sys.exit()
 
-logging.info("Generating stats")
+    dispatcher.FinishAccumulating()
 
-for stat in stats:
-    stat.ProcessMessageInfos(message_infos, threads)
+if "count_cube" in opts:
+    dispatcher.GetCountCube().Save(opts["count_cube"])
 
 logging.info("Outputting HTML")
 
 t = Template(
     file="templates/index.tmpl",
     searchList={
-        "stats": stats,
+        "stats": report_stats,
         "host": re.sub("^.*@", "", opts.get("username", ''))
     }
 )
@@ -9,6 +9,8 @@ import time
 
 import re
 
+import jwzthreading
+
 InternalDate = re.compile(r'.*INTERNALDATE "'
                 r'(?P<day>[ 0123][0-9])-(?P<mon>[A-Z][a-z][a-z])-(?P<year>[0-9][0-9][0-9][0-9])'
                 r' (?P<hour>[0-9][0-9]):(?P<min>[0-9][0-9]):(?P<sec>[0-9][0-9])'
@@ -16,21 +18,136 @@ InternalDate = re.compile(r'.*INTERNALDATE "'
                 r'"')
 
 
+class AddressTable(object):
+    """
+    Every address seen in the messages, numbered from 0, with the name to
+    show for it
+
+    Messages resolve their sender, recipients and list to these IDs once,
+    and filters and stats use the IDs instead of parsing the headers again.
+    IDs only mean something within a run: whatever is saved for another run
+    (e.g. a shard's stats) has to use the addresses. The table keeps every
+    address, so the approximate mode doesn't use it (see
+    MessageInfo.SetNumberAddresses).
+    """
+
+    def __init__(self):
+        self.__ids = {}
+        self.__addresses = []
+        self.__names = []
+
+    def __len__(self):
+        return len(self.__addresses)
+
+    def GetId(self, address, name=None):
+        """The ID of address (added if new); name replaces its name if given"""
+        address_id = self.__ids.get(address)
+        if address_id is None:
+            address_id = self.__ids[address] = len(self.__addresses)
+            self.__addresses.append(address)
+            self.__names.append(name or address)
+        elif name and name != address:
+            # The address stands in for a missing name, it doesn't replace
+            # a real one
+            self.__names[address_id] = name
+        return address_id
+
+    def GetAddress(self, address_id):
+        return self.__addresses[address_id]
+
+    def GetName(self, address_id):
+        return self.__names[address_id]
+
+    def GetNameAddress(self, address_id):
+        return self.__names[address_id], self.__addresses[address_id]
+
+
+class MessageRecord(object):
+    """
+    The little of a message that threading, the thread stats and the
+    message templates use, without its headers. Shards save one per message
+    for MergeShards, so it is pickled as a plain tuple.
+    """
+    __slots__ = ["message_id", "references", "subject", "normalized_subject",
+                 "display_subject", "sender", "list_id", "size", "date_sec"]
+
+    def __init__(self, message_info):
+        self.message_id = message_info.message_id
+        self.references = message_info.references
+        self.subject = message_info.subject
+        self.normalized_subject = message_info.normalized_subject
+        # Usually the same as the raw subject, which is then only kept once
+        self.display_subject = message_info.GetSubject()
+        if self.display_subject == self.subject:
+            self.display_subject = self.subject
+        self.sender = message_info.GetSender()
+        self.list_id = message_info.GetListId()
+        self.size = message_info.size
+        self.date_sec = message_info.GetDateSec()
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in MessageRecord.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(MessageRecord.__slots__, state):
+            setattr(self, name, value)
+
+    def GetRecord(self):
+        return self
+
+    def GetSubject(self):
+        return self.display_subject
+
+    def GetSender(self):
+        return self.sender
+
+    def GetListId(self):
+        return self.list_id
+
+
 class MessageInfo(object):
     __oldestMessageSec = time.mktime([2027, 12, 31, 23, 59, 59, 0, 0, 0])
     __newestMessageSec = time.mktime([1970, 1, 1, 0, 0, 0, 0, 0, 0])
     __parseDates = True
     __hasDate = False
+    __numberAddresses = True
 
     _NAME_CACHE = {}
 
+    _ADDRESS_TABLE = AddressTable()
+
     def __init__(self):
+        self.__uid = None
         self.__message_id = None
         self.__mailboxes = []
         self.is_from_me = False
         self.is_to_me = False
 
         self.__parsed_name_address = {}
+        self.__ResetAddressIds()
+
+    def __ResetAddressIds(self):
+        # Resolved on first use, see AddressTable. Without the table, the
+        # (name, address) pairs are kept instead.
+        self.__addresses_resolved = False
+        self.__sender_id = None
+        self.__recipient_ids = ()
+        self.__list_address_id = None
+        self.__sender = (None, None)
+        self.__recipients = []
+        self.__list_address = (None, None)
+
+    def __getstate__(self):
+        # Address IDs are only valid in this run
+        state = self.__dict__.copy()
+        state["_MessageInfo__addresses_resolved"] = False
+        state["_MessageInfo__sender_id"] = None
+        state["_MessageInfo__recipient_ids"] = ()
+        state["_MessageInfo__list_address_id"] = None
+        state["_MessageInfo__sender"] = (None, None)
+        state["_MessageInfo__recipients"] = []
+        state["_MessageInfo__list_address"] = (None, None)
+        return state
 
     def PopulateField(self, name, value):
         if name == "UID":
@@ -58,6 +175,15 @@ class MessageInfo(object):
 
             self.headers = email.message_from_string(value)
 
+            # What threading needs, so that it never goes back to the
+            # headers: interned raw and stripped subjects, the Message-ID
+            # (None if missing) and the tuple of referenced IDs
+            self.subject, self.normalized_subject = \
+                jwzthreading.normalize_subject(
+                    self.headers.get("Subject", "No subject"))
+            self.message_id, self.references = \
+                jwzthreading.get_message_ids(self.headers)
+
         else: raise AssertionError("unknown field: %s" % name)
 
     def GetMessageId(self):
@@ -68,6 +194,12 @@ class MessageInfo(object):
             self.__message_id = d.digest()
         return self.__message_id
 
+    def GetUid(self):
+        return self.__uid
+
+    def GetRecord(self):
+        return MessageRecord(self)
+
     def AddMailbox(self, mailbox):
         self.__mailboxes.append(mailbox)
 
@@ -77,16 +209,70 @@ class MessageInfo(object):
     def GetDate(self):
         return self.__date_tuple
 
+    def GetDateSec(self):
+        return self.__date_sec
+
+    def GetSenderId(self):
+        """
+        ID of the sender in GetAddressTable(), None if there is none (or if
+        addresses aren't numbered)
+        """
+        if not self.__addresses_resolved:
+            self.__ResolveAddresses()
+        return self.__sender_id
+
+    def GetRecipientIds(self):
+        if not self.__addresses_resolved:
+            self.__ResolveAddresses()
+        return self.__recipient_ids
+
+    def GetListAddressId(self):
+        if not self.__addresses_resolved:
+            self.__ResolveAddresses()
+        return self.__list_address_id
+
     def GetSender(self):
-        return self._GetNameAddress("from")
+        sender_id = self.GetSenderId()
+        if sender_id is None:
+            return self.__sender
+        return MessageInfo._ADDRESS_TABLE.GetNameAddress(sender_id)
 
     def GetListId(self):
+        list_address_id = self.GetListAddressId()
+        if list_address_id is None:
+            return self.__list_address
+        address = MessageInfo._ADDRESS_TABLE.GetAddress(list_address_id)
+        return address, address
+
+    def GetRecipients(self):
+        if not MessageInfo.__numberAddresses:
+            if not self.__addresses_resolved:
+                self.__ResolveAddresses()
+            return self.__recipients
+
+        return [MessageInfo._ADDRESS_TABLE.GetNameAddress(recipient_id)
+                for recipient_id in self.GetRecipientIds()]
+
+    def __ResolveAddresses(self):
+        table = MessageInfo._ADDRESS_TABLE
+        number_addresses = MessageInfo.__numberAddresses
+
+        name, address = self._GetNameAddress("from")
+        if address:
+            if number_addresses:
+                self.__sender_id = table.GetId(address, name)
+            else:
+                self.__sender = name, address
+
         (name, address) = self._GetNameAddress("list-id")
         # Don't use the name part of the list-id header, it tends to be overly
         # descriptive (i.e. too long)
-        return address, address
+        if address:
+            if number_addresses:
+                self.__list_address_id = table.GetId(address)
+            else:
+                self.__list_address = address, address
 
-    def GetRecipients(self):
         tos = self.GetHeaderAll('to')
         ccs = self.GetHeaderAll('cc')
         bccs = self.GetHeaderAll('bcc')
@@ -102,7 +288,15 @@ class MessageInfo(object):
                 name, address = self._GetCleanedUpNameAddress(name, address)
                 recipients_map[address] = name.replace("'", "")
 
-        return [(name, address) for address, name in recipients_map.items()]
+        if number_addresses:
+            self.__recipient_ids = tuple(
+                table.GetId(address, name)
+                for address, name in recipients_map.items())
+        else:
+            self.__recipients = [
+                (name, address) for address, name in recipients_map.items()]
+
+        self.__addresses_resolved = True
 
     def _GetNameAddress(self, header):
         if header not in self.headers:
@@ -123,6 +317,9 @@ class MessageInfo(object):
 
     _PLUS_ADDRESS_RE = re.compile("\+.*@")
 
+    def GetSubject(self):
+        return self.GetHeader("subject")
+
     def GetHeader(self, name):
         return self._GetDecodedValue(self.headers[name])
 
@@ -149,6 +346,11 @@ class MessageInfo(object):
         if name == "No Description Available":
             name = None
 
+        if not MessageInfo.__numberAddresses:
+            # The most used name of each address would have to be kept for
+            # every address, like the table
+            return name or address, address
+
         cache = MessageInfo._NAME_CACHE
 
         if address in cache:
@@ -171,9 +373,23 @@ class MessageInfo(object):
         return [MessageInfo.__oldestMessageSec, MessageInfo.__newestMessageSec]
     GetDateRange = staticmethod(GetDateRange)
 
+    def GetAddressTable():
+        return MessageInfo._ADDRESS_TABLE
+    GetAddressTable = staticmethod(GetAddressTable)
+
     def SetParseDate(parseDates):
         MessageInfo.__parseDates = parseDates
     SetParseDate = staticmethod(SetParseDate)
 
+    def SetNumberAddresses(numberAddresses):
+        """
+        Whether addresses are numbered in GetAddressTable(). If not, as in
+        the approximate mode, the Get...Id() methods find nothing and
+        messages keep their (name, address) pairs instead, which
+        GetSender(), GetRecipients() and GetListId() return in both cases.
+        """
+        MessageInfo.__numberAddresses = numberAddresses
+    SetNumberAddresses = staticmethod(SetNumberAddresses)
+
     def __str__(self):
         return "%s (size: %d, date: %s)" % (self.GetHeader("subject"), self.size, self.__date_string)
@@ -0,0 +1,127 @@
+#!/usr/bin/python
+
+# Times the stacking and smoothing of the distribution charts on synthetic
+# data, with and without numpy, against the old loops over each bucket and
+# address. Also times whole Distribution.GetHtml() calls, template included.
+#
+# To run:
+# ./renderbench.py [chart_count ...]
+# The counts default to 100 and 1000 (e.g. 20 years x 5 collections x 10).
+
+import random
+import sys
+import time
+
+from pygooglechart import ExtendedData
+
+import stats.base
+import stats.distribution
+import stats.matrix
+
+_BUCKET_COUNT = stats.matrix.BUCKET_COUNT
+_BUCKET_SIZE = stats.matrix.BUCKET_SIZE
+
+class FakeAddressMatrix(object):
+  def __init__(self, top, first, last):
+    self.__top = top
+    self.__first = first
+    self.__last = last
+
+  def IsEmpty(self, role, year):
+    return False
+
+  def GetBucketRange(self, role, year):
+    return self.__first, self.__last
+
+  def GetTopAddresses(self, role, year, count):
+    return self.__top
+
+def OldStackAndSmooth(series, first, last):
+  # What Distribution.GetHtml() used to do
+  bucket_lines = [[] for counts in series]
+  for i in xrange(0, len(series[0])):
+    sum = 0
+    for counts in series:
+      sum += counts[i]
+    sum = float(sum)
+    fraction_sum = 0
+    for j, counts in enumerate(series):
+      if sum == 0:
+        fraction = 0
+      else:
+        fraction = counts[i]/sum
+      fraction_sum += fraction
+      if j == len(series) - 1:
+        fraction_sum = 1.0
+      bucket_lines[j].append(round(fraction_sum * ExtendedData.max_value()))
+
+  lines = []
+  for points in bucket_lines:
+    smoothed = []
+    window = []
+    window_sum = 0
+    for i in xrange(0, len(points)):
+      if i < first or i > last:
+        smoothed.append(0)
+      else:
+        point = points[i]
+        if len(window) == _BUCKET_SIZE:
+          window_sum -= window.pop(0)
+        window.append(point)
+        window_sum += point
+        smoothed.append(round(window_sum/len(window)))
+    lines.append(smoothed)
+  return lines
+
+def StackAndSmooth(series, first, last):
+  lines = stats.base.GetStackedShares(series, ExtendedData.max_value())
+  return stats.base.GetMovingAverages(lines, _BUCKET_SIZE, first, last)
+
+def Time(label, count, function):
+  start = time.time()
+  result = function()
+  print "%-28s n=%-6d %7.2fs" % (label, count, time.time() - start)
+  return result
+
+def MakeChart():
+  first = random.randint(0, _BUCKET_COUNT - 1)
+  last = random.randint(first, _BUCKET_COUNT - 1)
+  series = []
+  for i in xrange(10):
+    counts = [0] * _BUCKET_COUNT
+    for bucket in xrange(first, last + 1):
+      # Some buckets without any message
+      if random.random() < 0.7:
+        counts[bucket] = int(random.paretovariate(1.5))
+    series.append(counts)
+  return series, first, last
+
+def RenderAll(charts):
+  for series, first, last in charts:
+    top = [("user%d@example.com" % i, "User %d" % i, counts)
+        for i, counts in enumerate(reversed(series))]
+    distribution = stats.distribution.SenderDistribution(2009)
+    distribution.SetAddressMatrix(FakeAddressMatrix(top, first, last))
+    distribution.GetHtml()
+
+def UseNumpy(numpy):
+  stats.base.numpy = numpy
+
+random.seed(0)
+numpy = stats.base.numpy
+counts = [int(c) for c in sys.argv[1:]] or [100, 1000]
+
+for count in counts:
+  charts = [MakeChart() for i in xrange(count)]
+
+  expected = Time("stack and smooth, old", count,
+      lambda: [OldStackAndSmooth(*chart) for chart in charts])
+
+  for label, module in [("numpy", numpy), ("no numpy", None)]:
+    if label == "numpy" and numpy is None: continue
+    UseNumpy(module)
+    result = Time("stack and smooth, %s" % label, count,
+        lambda: [StackAndSmooth(*chart) for chart in charts])
+    assert result == expected
+    Time("GetHtml, %s" % label, count, lambda: RenderAll(charts))
+    UseNumpy(numpy)
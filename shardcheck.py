@@ -0,0 +1,157 @@
+#!/usr/bin/python
+
+# Checks that --shard and --merge give the same report as a single run. An
+# mbox file (or a synthetic one) is read by main.py in shard_count separate
+# processes running at the same time, their shard files are merged, and the
+# merged report is compared with the report of a single run over the whole
+# file. Replies in the synthetic mbox refer to messages anywhere before
+# them, so most threads span shards.
+#
+# The per-message records that shards save for threading at merge time are
+# also measured, and have to stay small: a few hundred bytes each, not a
+# whole message info with its headers.
+#
+# To run:
+# ./shardcheck.py [shard_count [mbox_path]]
+# The count defaults to 4; without a path, 3000 synthetic messages are used.
+
+import cPickle
+import email.utils
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+def MakeMbox(count):
+  random.seed(0)
+  messages = []
+  threads = []
+  for i in xrange(count):
+    date = 1230768000 + i * 3600
+    sender = random.randint(0, 80)
+    header = [
+      "From: Person %d <user%d@example.com>" % (sender, sender),
+      "To: user%d@example.com, me@example.net" % random.randint(0, 80),
+      "Date: " + email.utils.formatdate(date),
+    ]
+    # Some messages without a Message-ID, and some sharing one
+    message_id = "<m%d@example.com>" % random.randint(0, count * 19 / 20)
+    if random.random() < 0.97:
+      header.append("Message-ID: " + message_id)
+
+    if threads and random.random() < 0.6:
+      references, subject = random.choice(threads)
+      references = references[-5:]
+      header.append("References: " + " ".join(references))
+      header.append("Subject: Re: " + subject)
+    else:
+      references, subject = [], "Topic %d" % i
+      header.append("Subject: " + subject)
+    threads.append((references + [message_id], subject))
+
+    if random.random() < 0.3:
+      header.append("List-Id: <list%d.example.org>" % random.randint(0, 5))
+
+    messages.append("From user@example.com %s\n%s\n\n%s\n" % (
+        time.asctime(time.gmtime(date)), "\n".join(header),
+        "x" * random.randint(0, 20000)))
+  return "".join(messages)
+
+def RunMain(*args):
+  """The report main.py writes, or None if it fails"""
+  process = subprocess.Popen(
+      [sys.executable, "main.py", "--me=me@example.net"] + list(args),
+      stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+  output = process.communicate()[0]
+  if process.returncode:
+    print output
+    return None
+  return open("out/index.html").read()
+
+# Bytes a shard may spend per message on its threading records
+_MAX_RECORD_BYTES = 200
+
+def GetRecordSize(shard_path):
+  """(number of messages, bytes) of the records saved in a shard file"""
+  shard_file = open(shard_path, "rb")
+  try:
+    cPickle.load(shard_file)
+    cPickle.load(shard_file)
+    start = shard_file.tell()
+    records = cPickle.load(shard_file)
+    return len(records), shard_file.tell() - start
+  finally:
+    shard_file.close()
+
+def GetSubtitle(report):
+  return re.search(r"Based on [^<]*\.", report).group(0)
+
+shard_count = len(sys.argv) > 1 and int(sys.argv[1]) or 4
+
+temp_dir = tempfile.mkdtemp()
+try:
+  if len(sys.argv) > 2:
+    mbox_path = sys.argv[2]
+  else:
+    mbox_path = os.path.join(temp_dir, "synthetic.mbox")
+    mbox_file = open(mbox_path, "w")
+    mbox_file.write(MakeMbox(3000))
+    mbox_file.close()
+
+  shard_paths = []
+  processes = []
+  for i in xrange(1, shard_count + 1):
+    shard_paths.append("out/shard-%d-of-%d.pickle" % (i, shard_count))
+    processes.append(subprocess.Popen(
+        [sys.executable, "main.py", "--me=me@example.net",
+         "--mbox=" + mbox_path, "--shard=%d/%d" % (i, shard_count)],
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT))
+  for process in processes:
+    output = process.communicate()[0]
+    if process.returncode:
+      print output
+      sys.exit(1)
+
+  record_count = record_bytes = 0
+  for path in shard_paths:
+    count, size = GetRecordSize(path)
+    record_count += count
+    record_bytes += size
+
+  merged = RunMain("--merge", *shard_paths)
+  single = RunMain("--mbox=" + mbox_path)
+  for path in shard_paths:
+    os.remove(path)
+  if merged is None or single is None:
+    sys.exit(1)
+finally:
+  shutil.rmtree(temp_dir)
+
+print "%d shards: %s" % (shard_count, GetSubtitle(merged))
+print "single run: %s" % GetSubtitle(single)
+
+bytes_per_record = float(record_bytes) / max(1, record_count)
+print "%d threading records saved, %.0f bytes each" % (
+    record_count, bytes_per_record)
+failures = 0
+if bytes_per_record > _MAX_RECORD_BYTES:
+  print "  Records should take at most %d bytes" % _MAX_RECORD_BYTES
+  failures += 1
+
+merged_lines = merged.splitlines()
+single_lines = single.splitlines()
+differences = [
+  i for i in xrange(max(len(merged_lines), len(single_lines)))
+  if merged_lines[i:i + 1] != single_lines[i:i + 1]
+]
+print "%d of %d report lines differ" % (len(differences), len(single_lines))
+for i in differences[:5]:
+  print "  line %d:\n    merged %r\n    single %r" % (
+      i + 1, merged_lines[i:i + 1], single_lines[i:i + 1])
+
+failures += len(differences)
+sys.exit(failures and 1 or 0)
@@ -1,9 +1,18 @@
+import array
+import bisect
 import email
 import calendar
+import datetime
 import heapq
+import math
 import sys
 import time
 
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
 from Cheetah.Template import Template
 from pygooglechart import ExtendedData
 from pygooglechart import SimpleData
@@ -11,12 +20,117 @@ from pygooglechart import SimpleData
 MONTH_NAMES = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", 
     "Oct", "Nov", "Dec"]
 
+# Routing keys a stat can ask for, besides a year or a (year, month) pair
+ALL_MESSAGES = "all"
+NO_MESSAGES = "none"
+
 def GetYearRange(date_range):
   start, end = date_range
   start_year = time.localtime(start).tm_year
   end_year = time.localtime(end).tm_year
   return range(start_year, end_year + 1)
 
+def GetRoutingKeys(message_info):
+  """The year and (year, month) routing keys that a message matches"""
+  date = message_info.GetDate()
+  return date.tm_year, (date.tm_year, date.tm_mon)
+
+def AsNumpyArray(values):
+  if isinstance(values, array.array):
+    # Share the array's memory instead of going through each item
+    return numpy.frombuffer(values, dtype="i%d" % values.itemsize)
+  return numpy.asarray(values)
+
+def GetBuckets(values, edges):
+  """
+  Bucket of each of the (integer) values, given the sorted lower edges of
+  the buckets: the index of the last edge that the value reaches (-1 if
+  none).
+
+  A numpy array when numpy is available, a list otherwise.
+  """
+  if numpy is not None:
+    return numpy.searchsorted(edges, AsNumpyArray(values), side="right") - 1
+
+  return [bisect.bisect_right(edges, value) - 1 for value in values]
+
+def CountBuckets(values, edges):
+  """How many of values fall in each bucket, see GetBuckets()"""
+  if not len(values):
+    return [0] * len(edges)
+
+  buckets = GetBuckets(values, edges)
+
+  if numpy is not None:
+    buckets = buckets[buckets >= 0]
+    return numpy.bincount(buckets, minlength=len(edges)).tolist()
+
+  counts = [0] * len(edges)
+  for bucket in buckets:
+    if bucket >= 0:
+      counts[bucket] += 1
+  return counts
+
+def _Round(value):
+  # Like round() for the non-negative values of a chart
+  return math.floor(value + 0.5)
+
+def GetStackedShares(series, scale):
+  """
+  Lines of a stacked chart of the share of each series (lists of counts
+  with the same length, bottom first) at each point: a line is the sum of
+  the shares of its series and those under it, times scale. The top line is
+  always at scale, even where all the counts are 0.
+  """
+  if numpy is not None:
+    counts = numpy.asarray(series, dtype=float)
+    totals = counts.sum(axis=0)
+    shares = numpy.zeros_like(counts)
+    numpy.divide(counts, totals, out=shares, where=totals != 0)
+    stacked = shares.cumsum(axis=0)
+    stacked[-1] = 1.0
+    return numpy.floor(stacked * scale + 0.5).tolist()
+
+  lines = [[] for counts in series]
+  for counts in zip(*series):
+    total = float(sum(counts))
+    stacked = 0
+    for line, count in zip(lines, counts):
+      if total:
+        stacked += count/total
+      line.append(_Round(stacked * scale))
+    lines[-1][-1] = float(scale)
+  return lines
+
+def GetMovingAverages(lines, window, first, last):
+  """
+  Each line smoothed with the average of every point and the (up to)
+  window - 1 points before it, starting from the first point. Points
+  before first or after last are 0.
+  """
+  if numpy is not None:
+    points = numpy.asarray(lines, dtype=float)
+    averages = numpy.zeros_like(points)
+    sums = points[:, first:last + 1].cumsum(axis=1)
+    sums[:, window:] = sums[:, window:] - sums[:, :-window]
+    counts = numpy.minimum(numpy.arange(1, sums.shape[1] + 1), window)
+    averages[:, first:last + 1] = numpy.floor(sums / counts + 0.5)
+    return averages.tolist()
+
+  averages = []
+  for points in lines:
+    sums = [0]
+    for point in points[first:last + 1]:
+      sums.append(sums[-1] + point)
+
+    line = [0] * len(points)
+    for i in xrange(1, len(sums)):
+      start = max(0, i - window)
+      line[first + i - 1] = \
+          _Round(float(sums[i] - sums[start]) / (i - start))
+    averages.append(line)
+  return averages
+
 def GetDisplaySize(bytes):
   megabytes = bytes/(1 << 20)
   
@@ -45,6 +159,75 @@ class Stat(object):
   
   def IsEmpty(self):
     return False
+
+  # Stats are fed one message (or thread) at a time, usually by a
+  # group.StatDispatcher making a single pass for all of them. Messages are
+  # only passed to Accumulate() if they match GetRoutingKey().
+
+  def GetRoutingKey(self):
+    return ALL_MESSAGES
+
+  def AccumulatesThreads(self):
+    return False
+
+  def Accumulate(self, message_info):
+    pass
+
+  def AccumulateThread(self, thread):
+    pass
+
+  def FinishAccumulating(self):
+    pass
+
+  # Stats that only chart counts by time and size are instead handed the
+  # cube.CountCube that the dispatcher builds for all of them
+
+  def UsesCountCube(self):
+    return False
+
+  def SetCountCube(self, count_cube):
+    pass
+
+  # Similarly, the address distributions are slices of the dispatcher's
+  # matrix.AddressMatrix
+
+  def UsesAddressMatrix(self):
+    return False
+
+  def SetAddressMatrix(self, address_matrix):
+    pass
+
+  # Partial results, so that the messages can be split (by mailbox, year,
+  # process...) and accumulated separately. GetState() is what has been
+  # accumulated so far, as plain picklable data (None if the stat keeps
+  # nothing of its own); Merge() adds another shard's state to this stat,
+  # before FinishAccumulating(). Matching stats of different runs share a
+  # state key.
+
+  def GetStateKey(self):
+    key = self.GetRoutingKey()
+    if key in (ALL_MESSAGES, NO_MESSAGES):
+      return self.__class__.__name__
+    return self.__class__.__name__, key
+
+  def GetState(self):
+    return None
+
+  def Merge(self, state):
+    pass
+
+  def ProcessMessageInfos(self, message_infos, threads):
+    key = self.GetRoutingKey()
+    if key != NO_MESSAGES:
+      for message_info in message_infos:
+        if key == ALL_MESSAGES or key in GetRoutingKeys(message_info):
+          self.Accumulate(message_info)
+
+    if self.AccumulatesThreads():
+      for thread in threads:
+        self.AccumulateThread(thread)
+
+    self.FinishAccumulating()
   
 class ChartStat(Stat):
   def __init__(self):
@@ -81,7 +264,7 @@ class ChartStat(Stat):
 class TitleStat(Stat):
   _TIME_FORMAT = "%B %d %Y"
   
-  def __init__(self, date_range):
+  def __init__(self, date_range, count_threads=True):
     Stat.__init__(self)
     
     start_sec, end_sec = date_range
@@ -90,11 +273,39 @@ class TitleStat(Stat):
     self.__end = time.strftime(
         TitleStat._TIME_FORMAT, time.localtime(end_sec))
     
+    # Without threads (a report drawn from a saved cube.CountCube), the
+    # messages are counted off the cube
+    self.__count_threads = count_threads
     self.__message_count = 0
-  
-  def ProcessMessageInfos(self, message_infos, threads):
-    self.__message_count = len(message_infos)
-    self.__thread_count = len(threads)
+    self.__thread_count = None
+    if count_threads:
+      self.__thread_count = 0
+
+  def GetRoutingKey(self):
+    return self.__count_threads and ALL_MESSAGES or NO_MESSAGES
+
+  def AccumulatesThreads(self):
+    return self.__count_threads
+
+  def UsesCountCube(self):
+    return not self.__count_threads
+
+  def SetCountCube(self, count_cube):
+    self.__message_count = count_cube.GetMessageCount()
+
+  def Accumulate(self, message_info):
+    self.__message_count += 1
+
+  def AccumulateThread(self, thread):
+    self.__thread_count += 1
+
+  def GetState(self):
+    return self.__message_count, self.__thread_count
+
+  def Merge(self, state):
+    message_count, thread_count = state
+    self.__message_count += message_count
+    self.__thread_count += thread_count
   
   def GetHtml(self):
     t = Template(
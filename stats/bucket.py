@@ -1,11 +1,13 @@
 from pygooglechart import StackedVerticalBarChart, Axis
 
 from base import *
+from cube import GetWeekday, SIZE_BUCKETS
 
 _Y_AXIS_SPACE = 36
 
 
 class BucketStat(ChartStat):
+    """A bar chart of counts in a fixed number of buckets"""
 
     def __init__(self, bucket_count, title, width, height):
         ChartStat.__init__(self)
@@ -17,21 +19,23 @@ class BucketStat(ChartStat):
         self.__width = width
         self.__height = height
 
-    def _GetBucketCollection(self, message_infos, threads):
-        return message_infos
+    def GetState(self):
+        return list(self.__buckets)
 
-    def ProcessMessageInfos(self, message_infos, threads):
-        for bucket_obj in self._GetBucketCollection(message_infos, threads):
-            bucket = self._GetBucket(bucket_obj)
+    def Merge(self, state):
+        for bucket, count in enumerate(state):
+            if count:
+                self._AddToBucket(bucket, count)
 
-            if bucket is None:
-                continue
+    def _AddToBucket(self, bucket, count=1):
+        if bucket is None:
+            return
 
-            self.__buckets[bucket] += 1
+        self.__buckets[bucket] += count
 
-            v = self.__buckets[bucket]
-            if v > self.__max:
-                self.__max = v
+        v = self.__buckets[bucket]
+        if v > self.__max:
+            self.__max = v
 
     def GetHtml(self):
         max = self._GetRescaledMax(self.__max)
@@ -69,13 +73,31 @@ class BucketStat(ChartStat):
         return unicode(t)
 
 
-class TimeOfDayStat(BucketStat):
+class CountCubeBucketStat(BucketStat):
+    """A bucket stat read off the shared cube.CountCube, not the messages"""
+
+    def GetRoutingKey(self):
+        return NO_MESSAGES
+
+    def UsesCountCube(self):
+        return True
+
+    def SetCountCube(self, count_cube):
+        for bucket, count in self._GetCubeBuckets(count_cube):
+            self._AddToBucket(bucket, count)
+
+    def GetState(self):
+        # The cube holds the counts, and is merged instead
+        return None
+
+
+class TimeOfDayStat(CountCubeBucketStat):
 
     def __init__(self):
         BucketStat.__init__(self, 24, 'Time of day', 400, 200)
 
-    def _GetBucket(self, message_info):
-        return message_info.GetDate().tm_hour
+    def _GetCubeBuckets(self, count_cube):
+        return enumerate(count_cube.GetHourCounts())
 
     def _GetBucketLabels(self):
         return ['Midnight', '', '', '', '', '',
@@ -84,20 +106,20 @@ class TimeOfDayStat(BucketStat):
                         ' 6 PM', '', '', '', '', '']
 
 
-class DayOfWeekStat(BucketStat):
+class DayOfWeekStat(CountCubeBucketStat):
 
     def __init__(self):
         BucketStat.__init__(self, 7, 'Day of week', 300, 200)
 
-    def _GetBucket(self, message_info):
-        # In the time tuple Monday is 0, but we want Sunday to be 0
-        return (message_info.GetDate().tm_wday + 1) % 7
+    def _GetCubeBuckets(self, count_cube):
+        return [(GetWeekday(day), count)
+                for day, count in count_cube.GetDayCounts()]
 
     def _GetBucketLabels(self):
         return ['S', 'M', 'T', 'W', 'T', 'F', 'S']
 
 
-class YearStat(BucketStat):
+class YearStat(CountCubeBucketStat):
 
     def __init__(self, date_range):
         self.__years = GetYearRange(date_range)
@@ -107,33 +129,31 @@ class YearStat(BucketStat):
         BucketStat.__init__(
             self, len(self.__years), "Year", width, 200)
 
-    def _GetBucket(self, message_info):
-        return message_info.GetDate().tm_year - self.__years[0]
+    def _GetCubeBuckets(self, count_cube):
+        return [(day.year - self.__years[0], count)
+                for day, count in count_cube.GetDayCounts()]
 
     def _GetBucketLabels(self):
         return [str(x) for x in self.__years]
 
 
-class MonthStat(BucketStat):
+class MonthStat(CountCubeBucketStat):
 
     def __init__(self, year):
         self.__year = year
         # No title is necessary, since the stat collection provides one
         BucketStat.__init__(self, 12, None, 300, 200)
 
-    def _GetBucket(self, message_info):
-        date = message_info.GetDate()
-
-        if date.tm_year == self.__year:
-            return date.tm_mon - 1
-        else:
-            return None
+    def _GetCubeBuckets(self, count_cube):
+        days = count_cube.GetDayCounts(
+            datetime.date(self.__year, 1, 1), datetime.date(self.__year, 12, 31))
+        return [(day.month - 1, count) for day, count in days]
 
     def _GetBucketLabels(self):
         return MONTH_NAMES
 
 
-class DayStat(BucketStat):
+class DayStat(CountCubeBucketStat):
 
     def __init__(self, year, month):
         self.__year = year
@@ -147,37 +167,18 @@ class DayStat(BucketStat):
             500,
             200)
 
-    def _GetBucket(self, message_info):
-        date = message_info.GetDate()
-
-        if date.tm_year == self.__year and date.tm_mon == self.__month:
-            return date.tm_mday - 1
-        else:
-            return None
+    def _GetCubeBuckets(self, count_cube):
+        days = count_cube.GetDayCounts(
+            datetime.date(self.__year, self.__month, 1),
+            datetime.date(self.__year, self.__month, self.__days_in_month))
+        return [(day.day - 1, count) for day, count in days]
 
     def _GetBucketLabels(self):
         return [str(d) for d in range(1, self.__days_in_month + 1)]
 
 
-class SizeBucketStat(BucketStat):
-    _SIZE_BUCKETS = [
-        0,
-        1 << 9,
-        1 << 10,
-        1 << 11,
-        1 << 12,
-        1 << 13,
-        1 << 14,
-        1 << 15,
-        1 << 16,
-        1 << 17,
-        1 << 18,
-        1 << 19,
-        1 << 20,
-        1 << 21,
-        1 << 22,
-        1 << 23,
-    ]
+class SizeBucketStat(CountCubeBucketStat):
+    _SIZE_BUCKETS = SIZE_BUCKETS
 
     def __init__(self):
         BucketStat.__init__(
@@ -187,12 +188,8 @@ class SizeBucketStat(BucketStat):
             500,
             200)
 
-    def _GetBucket(self, message_info):
-        size = message_info.size
-
-        for i in reversed(xrange(0, len(SizeBucketStat._SIZE_BUCKETS))):
-            if size >= SizeBucketStat._SIZE_BUCKETS[i]:
-                return i
+    def _GetCubeBuckets(self, count_cube):
+        return enumerate(count_cube.GetSizeCounts())
 
     def _GetBucketLabels(self):
         return [GetDisplaySize(s) for s in SizeBucketStat._SIZE_BUCKETS]
@@ -227,15 +224,30 @@ class ThreadSizeBucketStat(BucketStat):
             500,
             200)
 
-    def _GetBucketCollection(self, message_infos, threads):
-        return threads
+        # Thread lengths are collected, and all put in buckets at once when
+        # accumulation is done
+        self.__lengths = array.array("l")
+
+    def GetRoutingKey(self):
+        return NO_MESSAGES
+
+    def AccumulatesThreads(self):
+        return True
+
+    def AccumulateThread(self, thread):
+        self.__lengths.append(thread.length)
+
+    def FinishAccumulating(self):
+        self.__BinLengths()
 
-    def _GetBucket(self, thread):
-        size = len(thread)
+    def GetState(self):
+        self.__BinLengths()
+        return BucketStat.GetState(self)
 
-        for i in reversed(xrange(0, len(ThreadSizeBucketStat._SIZE_BUCKETS))):
-            if size >= ThreadSizeBucketStat._SIZE_BUCKETS[i]:
-                return i
+    def __BinLengths(self):
+        lengths = self.__lengths
+        self.__lengths = array.array("l")
+        self.Merge(CountBuckets(lengths, ThreadSizeBucketStat._SIZE_BUCKETS))
 
     def _GetBucketLabels(self):
         return [str(s) for s in ThreadSizeBucketStat._SIZE_BUCKETS]
@@ -0,0 +1,320 @@
+"""
+Message counts by day, hour of day and size bucket
+
+The time and size histograms are all sums over some of these three
+dimensions, so the counts are gathered once in a dense cube and each chart
+is a cheap marginal of it. The cells of the messages are counted in
+batches, with numpy for a whole batch at once, and the cube is filled with
+the counts of the non-empty cells; without numpy, they are kept in a dict.
+
+Like the stats, cubes of separate runs can be merged. A finished cube can
+also be saved and loaded back, so its charts can be drawn again without
+going over the messages.
+"""
+
+import array
+import cPickle
+import datetime
+import os
+import tempfile
+import time
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+from itertools import izip
+
+from base import ALL_MESSAGES, AsNumpyArray, GetBuckets
+
+SIZE_BUCKETS = [
+  0,
+  1 << 9,
+  1 << 10,
+  1 << 11,
+  1 << 12,
+  1 << 13,
+  1 << 14,
+  1 << 15,
+  1 << 16,
+  1 << 17,
+  1 << 18,
+  1 << 19,
+  1 << 20,
+  1 << 21,
+  1 << 22,
+  1 << 23,
+]
+
+_HOURS = 24
+_SIZES = len(SIZE_BUCKETS)
+_CELLS_PER_DAY = _HOURS * _SIZES
+
+# Messages gathered before they are counted into cells
+_BATCH_MESSAGES = 1 << 20
+
+def GetWeekday(day):
+  # date.weekday() has Monday as 0, but we want Sunday to be 0
+  return (day.weekday() + 1) % 7
+
+class CountCube(object):
+  """
+  Counts of messages per (day, hour, size bucket)
+
+  It is fed like a stat, see group.StatDispatcher. Days are numbered from
+  the first day that has a message, so the range doesn't have to be known
+  up front.
+  """
+  def __init__(self):
+    # Day (counted from 0001-01-01), hour and size of each message
+    self.__days = array.array("l")
+    self.__hours = array.array("l")
+    self.__sizes = array.array("l")
+    # (cells, counts) of the messages put in cells so far, and of the
+    # states merged in. These cells count days from 0001-01-01 too.
+    self.__cell_counts = []
+
+    self.__first_day = 0
+    self.__day_count = 0
+    self.__counts = None
+    self.__day_totals = []
+
+  # Stat protocol, so that the dispatcher can feed us
+
+  def GetRoutingKey(self):
+    return ALL_MESSAGES
+
+  def AccumulatesThreads(self):
+    return False
+
+  def Accumulate(self, message_info):
+    date = message_info.GetDate()
+    self.__days.append(
+        datetime.date(date.tm_year, date.tm_mon, date.tm_mday).toordinal())
+    self.__hours.append(date.tm_hour)
+    self.__sizes.append(message_info.size)
+
+    if len(self.__days) >= _BATCH_MESSAGES:
+      self.__GetCellCounts()
+
+  def GetState(self):
+    cells, counts = self.__GetCellCounts()
+    return {
+      "cells": array.array("l", cells),
+      "counts": array.array("l", counts),
+    }
+
+  def Merge(self, state):
+    self.__cell_counts.append((state["cells"], state["counts"]))
+
+  def FinishAccumulating(self):
+    cells, counts = self.__GetCellCounts()
+    self.__cell_counts = []
+
+    if not len(cells):
+      self.__SetCounts(0, 0, [], [])
+      return
+
+    # Cells come sorted
+    first_day = int(cells[0]) / _CELLS_PER_DAY
+    day_count = int(cells[-1]) / _CELLS_PER_DAY - first_day + 1
+
+    if numpy is not None:
+      cells = cells - first_day * _CELLS_PER_DAY
+    else:
+      cells = [cell - first_day * _CELLS_PER_DAY for cell in cells]
+
+    self.__SetCounts(first_day, day_count, cells, counts)
+
+  def __GetCellCounts(self):
+    """(cells, counts) of all that was accumulated or merged, each cell once"""
+    days, hours, sizes = self.__days, self.__hours, self.__sizes
+    self.__days = array.array("l")
+    self.__hours = array.array("l")
+    self.__sizes = array.array("l")
+
+    if days:
+      sizes = GetBuckets(sizes, SIZE_BUCKETS)
+
+      if numpy is not None:
+        cells = ((AsNumpyArray(days) * _HOURS + AsNumpyArray(hours)) * _SIZES +
+                 sizes)
+        self.__cell_counts.append(numpy.unique(cells, return_counts=True))
+      else:
+        counts = {}
+        for day, hour, size in izip(days, hours, sizes):
+          cell = (day * _HOURS + hour) * _SIZES + size
+          counts[cell] = counts.get(cell, 0) + 1
+        self.__cell_counts.append((counts.keys(), counts.values()))
+
+    if numpy is not None:
+      if not self.__cell_counts:
+        return numpy.zeros(0, numpy.int64), numpy.zeros(0, numpy.int64)
+
+      cells, inverse = numpy.unique(
+          numpy.concatenate(
+              [AsNumpyArray(c) for c, n in self.__cell_counts]),
+          return_inverse=True)
+      counts = numpy.bincount(
+          inverse,
+          weights=numpy.concatenate(
+              [AsNumpyArray(n) for c, n in self.__cell_counts]))
+      counts = counts.astype(numpy.int64)
+    else:
+      all_counts = {}
+      for cells, counts in self.__cell_counts:
+        for cell, count in izip(cells, counts):
+          all_counts[cell] = all_counts.get(cell, 0) + count
+      cells = sorted(all_counts)
+      counts = [all_counts[cell] for cell in cells]
+
+    self.__cell_counts = [(cells, counts)]
+    return cells, counts
+
+  # Marginals
+
+  def IsEmpty(self):
+    return not self.__day_count
+
+  def GetDayCounts(self, first=None, last=None):
+    """
+    [(datetime.date, count)] for the days with messages, optionally only
+    those between the first and last dates (inclusive)
+    """
+    start = 0
+    end = self.__day_count
+    if first is not None:
+      start = max(start, first.toordinal() - self.__first_day)
+    if last is not None:
+      end = min(end, last.toordinal() - self.__first_day + 1)
+
+    day_totals = self.__day_totals
+    return [
+      (datetime.date.fromordinal(self.__first_day + i), day_totals[i]) \
+          for i in xrange(start, end) if day_totals[i]
+    ]
+
+  def GetHourCounts(self):
+    if numpy is not None:
+      return self.__GetCube().sum(axis=(0, 2)).tolist()
+
+    hours = [0] * _HOURS
+    for cell, count in self.__counts.iteritems():
+      hours[cell / _SIZES % _HOURS] += count
+    return hours
+
+  def GetSizeCounts(self):
+    if numpy is not None:
+      return self.__GetCube().sum(axis=(0, 1)).tolist()
+
+    sizes = [0] * _SIZES
+    for cell, count in self.__counts.iteritems():
+      sizes[cell % _SIZES] += count
+    return sizes
+
+  def GetWeekdayHourCounts(self):
+    """7 x 24 counts (Sunday first), e.g. for an hour by weekday heatmap"""
+    weekday_hours = [[0] * _HOURS for i in xrange(7)]
+
+    if numpy is not None:
+      day_hours = self.__GetCube().sum(axis=2).tolist()
+      for i, hours in enumerate(day_hours):
+        row = weekday_hours[
+            GetWeekday(datetime.date.fromordinal(self.__first_day + i))]
+        for hour, count in enumerate(hours):
+          row[hour] += count
+      return weekday_hours
+
+    for cell, count in self.__counts.iteritems():
+      day, hour = divmod(cell / _SIZES, _HOURS)
+      weekday = GetWeekday(datetime.date.fromordinal(self.__first_day + day))
+      weekday_hours[weekday][hour] += count
+    return weekday_hours
+
+  def GetMessageCount(self):
+    return sum(self.__day_totals)
+
+  def GetDateRange(self):
+    """
+    [start, end] in seconds, at midnight of the first and last days, like
+    messageinfo.MessageInfo.GetDateRange()
+    """
+    if not self.__day_count:
+      return [0, 0]
+    return [
+      time.mktime(datetime.date.fromordinal(day).timetuple()) for day in
+          (self.__first_day, self.__first_day + self.__day_count - 1)
+    ]
+
+  # Saving and loading
+
+  @classmethod
+  def Load(cls, path):
+    f = open(path, "rb")
+    try:
+      return cPickle.load(f)
+    finally:
+      f.close()
+
+  def Save(self, path):
+    # Write next to the old cube and rename, so that an interrupted run
+    # never leaves a truncated file behind
+    temp_fd, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)))
+    temp_fp = os.fdopen(temp_fd, "wb")
+    cPickle.dump(self, temp_fp, cPickle.HIGHEST_PROTOCOL)
+    temp_fp.close()
+    os.rename(temp_path, path)
+
+  def __getstate__(self):
+    # Only the non-empty cells are kept, as plain arrays, so that a cube can
+    # be loaded with or without numpy
+    if numpy is not None:
+      cells = numpy.flatnonzero(self.__counts)
+      counts = self.__counts[cells]
+    else:
+      cells = sorted(self.__counts)
+      counts = [self.__counts[cell] for cell in cells]
+
+    return {
+      "first_day": self.__first_day,
+      "day_count": self.__day_count,
+      "cells": array.array("l", cells),
+      "counts": array.array("l", counts),
+    }
+
+  def __setstate__(self, state):
+    self.__days = array.array("l")
+    self.__hours = array.array("l")
+    self.__sizes = array.array("l")
+    self.__cell_counts = []
+    self.__SetCounts(
+        state["first_day"], state["day_count"],
+        state["cells"], state["counts"])
+
+  def __SetCounts(self, first_day, day_count, cells, counts):
+    self.__first_day = first_day
+    self.__day_count = day_count
+
+    if numpy is not None:
+      self.__counts = numpy.zeros(day_count * _CELLS_PER_DAY, numpy.int64)
+      if len(cells):
+        self.__counts[AsNumpyArray(cells)] = AsNumpyArray(counts)
+    else:
+      self.__counts = dict(zip(cells, counts))
+
+    self.__SumDays()
+
+  def __GetCube(self):
+    return self.__counts.reshape(self.__day_count, _HOURS, _SIZES)
+
+  def __SumDays(self):
+    if numpy is not None:
+      self.__day_totals = self.__GetCube().sum(axis=(1, 2)).tolist()
+      return
+
+    day_totals = [0] * self.__day_count
+    for cell, count in self.__counts.iteritems():
+      day_totals[cell / _CELLS_PER_DAY] += count
+    self.__day_totals = day_totals
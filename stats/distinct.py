@@ -0,0 +1,121 @@
+from pygooglechart import GroupedVerticalBarChart, Axis
+
+from base import *
+from sketch import HyperLogLog
+
+_Y_AXIS_SPACE = 36
+
+_SENDER_COLOR = '71C1FF'
+_RECIPIENT_COLOR = 'F4A674'
+
+class DistinctAddressStat(ChartStat):
+  """
+  Estimated number of distinct senders and recipients of each month of a
+  year, and of the whole year
+
+  A HyperLogLog sketch is kept per month and role, instead of the set of
+  addresses. The year's counts come from merging the months' sketches.
+  """
+  def __init__(self, year):
+    ChartStat.__init__(self)
+
+    self.__year = year
+    # Sketches are only made for the months that have messages
+    self.__senders = [None] * 12
+    self.__recipients = [None] * 12
+
+  def GetRoutingKey(self):
+    return self.__year
+
+  def Accumulate(self, message_info):
+    month = message_info.GetDate().tm_mon - 1
+
+    # Sketches hash the addresses, which (unlike the IDs) are the same in
+    # every run, and don't need the address table
+    name, address = message_info.GetSender()
+    if address is not None:
+      self.__GetSketch(self.__senders, month).Add(address)
+
+    recipient_addresses = message_info.GetRecipients()
+    if recipient_addresses:
+      recipients = self.__GetSketch(self.__recipients, month)
+      for name, address in recipient_addresses:
+        recipients.Add(address)
+
+  def __GetSketch(self, sketches, month):
+    sketch = sketches[month]
+    if sketch is None:
+      sketch = sketches[month] = HyperLogLog()
+    return sketch
+
+  def GetState(self):
+    return {
+      "senders": self.__GetSketchStates(self.__senders),
+      "recipients": self.__GetSketchStates(self.__recipients),
+    }
+
+  def __GetSketchStates(self, sketches):
+    return [sketch and sketch.GetState() for sketch in sketches]
+
+  def Merge(self, state):
+    for sketches, states in ((self.__senders, state["senders"]),
+                             (self.__recipients, state["recipients"])):
+      for month, sketch_state in enumerate(states):
+        if sketch_state is not None:
+          self.__GetSketch(sketches, month).Merge(sketch_state)
+
+  def IsEmpty(self):
+    for sketch in self.__senders + self.__recipients:
+      if sketch is not None:
+        return False
+    return True
+
+  def __GetCounts(self, sketches):
+    """Estimates for each month, and for the whole year"""
+    counts = []
+    year = HyperLogLog()
+    for sketch in sketches:
+      if sketch is None:
+        counts.append(0)
+      else:
+        counts.append(sketch.Estimate())
+        year.Merge(sketch.GetState())
+    return counts, year.Estimate()
+
+  def GetHtml(self):
+    if self.IsEmpty(): return ""
+
+    sender_counts, year_senders = self.__GetCounts(self.__senders)
+    recipient_counts, year_recipients = self.__GetCounts(self.__recipients)
+
+    chart_max = self._GetRescaledMax(max(sender_counts + recipient_counts))
+    w = 450
+    h = 200
+
+    chart = GroupedVerticalBarChart(w, h)
+
+    # Two bars per month, and the default 8 pixels between months
+    group_width = (w - _Y_AXIS_SPACE) / 12
+    chart.set_bar_width((group_width - 10) / 2)
+    chart.set_bar_spacing(2)
+
+    chart.add_data(self._GetRescaledData(sender_counts, chart_max))
+    chart.add_data(self._GetRescaledData(recipient_counts, chart_max))
+    chart.set_colours([_SENDER_COLOR, _RECIPIENT_COLOR])
+    chart.set_axis_range(Axis.LEFT, 0, chart_max)
+    chart.set_axis_labels(Axis.BOTTOM, MONTH_NAMES)
+
+    t = Template(
+        file="templates/distinct-stat.tmpl",
+        searchList = {
+          "id": self.id,
+          "width": w,
+          "height": h,
+          "chart_url": chart.get_url(),
+          "legend": [
+            (_SENDER_COLOR, "senders", year_senders),
+            (_RECIPIENT_COLOR, "recipients", year_recipients),
+          ],
+          "year": self.__year,
+        })
+    return unicode(t)
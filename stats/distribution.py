@@ -3,6 +3,9 @@ import math
 from pygooglechart import ExtendedData, SimpleLineChart, Axis
 
 from base import *
+from matrix import BUCKET_COUNT, BUCKET_SIZE
+from matrix import SENDER, RECIPIENT, LIST, ME_RECIPIENT, ME_SENDER
+from sketch import CountMinSketch, GetErrorBound, SpaceSaving
 
 _FILL_COLORS = [
   'F4A674',
@@ -18,108 +21,130 @@ _FILL_COLORS = [
 ]
 
 class Distribution(ChartStat):
-  _BUCKET_SIZE = 5
-  _BUCKET_COUNT = int(math.floor(365/_BUCKET_SIZE))
+  _BUCKET_SIZE = BUCKET_SIZE
+  _BUCKET_COUNT = BUCKET_COUNT
 
-  def __init__(self, year, css_class):
+  def __init__(self, year, role, css_class):
     ChartStat.__init__(self)
     
     self.__year = year
+    self.__role = role
     self.__css_class = css_class
-    self.__buckets = [{} for i in xrange(0, ListDistribution._BUCKET_COUNT)]
     self.__min_bucket = sys.maxint
     self.__max_bucket = -sys.maxint - 1
-    self.__all_addresses = {}
-    self.__address_names = {}
+    # [(address, name, counts by bucket)] of the top addresses, most
+    # messages first, from the shared matrix.AddressMatrix
+    self.__top_addresses = []
+
+    # In the approximate mode, the addresses don't all go in the matrix:
+    # the totals of the most frequent ones are kept in a summary, and the
+    # counts by bucket in a sketch
+    self.__summary = None
+    self.__sketch = None
+    self.__count = 0
+    error_bound = GetErrorBound()
+    if error_bound is not None:
+      self.__summary = SpaceSaving(max(10, int(math.ceil(1 / error_bound))))
+      self.__sketch = CountMinSketch(error_bound)
    
-  def ProcessMessageInfos(self, message_infos, threads):
-    for message_info in message_infos:
-      date = message_info.GetDate()
-      
-      if date.tm_year != self.__year: continue
+  def GetRoutingKey(self):
+    if self.__summary is None:
+      return NO_MESSAGES
+    return self.__year
 
-      bucket_index = (date.tm_yday - 1) / Distribution._BUCKET_SIZE
-      
-      # Ignore the last partial week bucket of the year
-      if bucket_index >= Distribution._BUCKET_COUNT: continue
+  def UsesAddressMatrix(self):
+    return self.__summary is None
 
-      for name, address in self._GetAddresses(message_info):
-        self.__address_names[address] = name
-        
-        if not address: continue
-  
-        self.__all_addresses[address] = \
-            self.__all_addresses.get(address, 0) + 1
-  
-        bucket = self.__buckets[bucket_index]
-        
-        if bucket_index > self.__max_bucket: self.__max_bucket = bucket_index
-        if bucket_index < self.__min_bucket: self.__min_bucket = bucket_index
-        
-        bucket[address] = bucket.get(address, 0) + 1
+  def SetAddressMatrix(self, address_matrix):
+    if address_matrix.IsEmpty(self.__role, self.__year):
+      return
+
+    self.__min_bucket, self.__max_bucket = \
+        address_matrix.GetBucketRange(self.__role, self.__year)
+    self.__top_addresses = \
+        address_matrix.GetTopAddresses(self.__role, self.__year, 10)
+
+  def Accumulate(self, message_info):
+    date = message_info.GetDate()
+
+    bucket_index = (date.tm_yday - 1) / Distribution._BUCKET_SIZE
+
+    # Ignore the last partial week bucket of the year
+    if bucket_index >= Distribution._BUCKET_COUNT: return
+
+    # Addresses aren't numbered in the approximate mode
+    for name, address in self._GetAddresses(message_info):
+      if address is None: continue
+
+      self.__summary.Add(address, name)
+      self.__sketch.Add("%d %s" % (bucket_index, address))
+      self.__count += 1
+
+      if bucket_index > self.__max_bucket: self.__max_bucket = bucket_index
+      if bucket_index < self.__min_bucket: self.__min_bucket = bucket_index
+
+  def GetState(self):
+    if self.__summary is None:
+      # The matrix holds the counts, and is merged instead
+      return None
+
+    return {
+      "summary": self.__summary.GetState(),
+      "sketch": self.__sketch.GetState(),
+      "count": self.__count,
+      "min_bucket": self.__min_bucket,
+      "max_bucket": self.__max_bucket,
+    }
+
+  def Merge(self, state):
+    self.__min_bucket = min(self.__min_bucket, state["min_bucket"])
+    self.__max_bucket = max(self.__max_bucket, state["max_bucket"])
+
+    self.__summary.Merge(state["summary"])
+    self.__sketch.Merge(state["sketch"])
+    self.__count += state["count"]
 
   def IsEmpty(self):
-    return len(self.__all_addresses) == 0
+    if self.__summary is not None:
+      return self.__count == 0
+    return len(self.__top_addresses) == 0
+
+  def __GetApproximation(self):
+    if self.__summary is None:
+      return None
+
+    return ("Approximate: totals may be up to %d too high, and 5-day counts "
+        "up to %d (in 99%% of cases)") % (
+            self.__summary.GetMaxError(),
+            math.ceil(GetErrorBound() * self.__count))
+
+  def __GetEstimatedTopAddresses(self):
+    """Like the matrix's top addresses, estimated from the sketch"""
+    return [
+      (address, entry[3], [
+        self.__sketch.Estimate("%d %s" % (bucket_index, address))
+        for bucket_index in xrange(0, Distribution._BUCKET_COUNT)
+      ])
+      for address, entry in self.__summary.GetTop(10)
+    ]
 
   def GetHtml(self):
     if self.IsEmpty(): return ""
     
-    # Determine top 10 addresses
-    top_addresses = \
-        [(count, address) for (address, count) in self.__all_addresses.items()]
-    top_addresses.sort(reverse=True)
-    top_addresses = [address for (count, address) in top_addresses]
-    
-    if len(top_addresses) > 10:
-      top_addresses = top_addresses[0:10]
-    
-    top_addresses.reverse()
-
-    # Collect lines for each address
-    bucket_lines = {}
-    
-    for bucket in self.__buckets:
-      sum = 0
-      for address in top_addresses:
-        sum += bucket.get(address, 0)
-      
-      sum = float(sum)
-      fraction_sum = 0
-      
-      for address in top_addresses:
-        if sum == 0:
-          fraction = 0
-        else:
-          fraction = bucket.get(address, 0)/sum
-      
-        fraction_sum += fraction
-        
-        # Make sure everything adds up to 1.0
-        if address == top_addresses[-1]:
-          fraction_sum = 1.0
-        
-        if address not in bucket_lines:
-          bucket_lines[address] = []
-
-        bucket_lines[address].append(round(
-            fraction_sum * ExtendedData.max_value()))
-
-    # Smooth lines
-    for address, points in bucket_lines.items():
-      smoothed = []
-      window = []
-      window_sum = 0
-      for i in xrange(0, len(points)):
-        if i < self.__min_bucket or i > self.__max_bucket:
-          smoothed.append(0)
-        else:
-          point = points[i]
-          if len(window) == Distribution._BUCKET_SIZE:
-            window_sum -= window.pop(0)
-          window.append(point)
-          window_sum += point
-          smoothed.append(round(window_sum/len(window)))
-      bucket_lines[address] = smoothed
+    # Top 10 addresses
+    if self.__summary is not None:
+      top = self.__GetEstimatedTopAddresses()
+    else:
+      top = self.__top_addresses
+
+    # Lines stacked from the least frequent address up, as shares of the
+    # top addresses' messages in each bucket, and smoothed
+    lines = GetStackedShares(
+        [counts for address, name, counts in reversed(top)],
+        ExtendedData.max_value())
+    lines = GetMovingAverages(
+        lines, Distribution._BUCKET_SIZE, self.__min_bucket, self.__max_bucket)
+    lines.reverse()
     
     # Generate chart
     chart = SimpleLineChart(450, 250)
@@ -127,10 +152,7 @@ class Distribution(ChartStat):
     colors = []
     legend = []
     
-    top_addresses.reverse()
-    
-    for address in top_addresses:
-      data = bucket_lines[address]
+    for (address, name, counts), data in zip(top, lines):
       chart.add_data(data)
       
       color = _FILL_COLORS[data_index % len(_FILL_COLORS)]
@@ -142,7 +164,7 @@ class Distribution(ChartStat):
       data_index += 1
 
       colors.append(color)
-      legend.append((color, self.__address_names[address], address))
+      legend.append((color, name, address))
 
     # Another set of points to make sure we will to the bottom
     chart.add_data([0, 0])
@@ -159,33 +181,34 @@ class Distribution(ChartStat):
           # make the URL longer than its limits
           "legend": legend, 
           "class": self.__css_class,
+          "approximation": self.__GetApproximation(),
         })
     return unicode(t)
 
 class SenderDistribution(Distribution):
   def __init__(self, year):
-    Distribution.__init__(self, year, "sender")
+    Distribution.__init__(self, year, SENDER, "sender")
   
   def _GetAddresses(self, message_info):
     return [message_info.GetSender()]
 
 class RecipientDistribution(Distribution):
   def __init__(self, year):
-    Distribution.__init__(self, year, "recipient")
+    Distribution.__init__(self, year, RECIPIENT, "recipient")
   
   def _GetAddresses(self, message_info):
     return message_info.GetRecipients()
     
 class ListDistribution(Distribution):
   def __init__(self, year):
-    Distribution.__init__(self, year, "list")
+    Distribution.__init__(self, year, LIST, "list")
     
   def _GetAddresses(self, message_info):
     return [message_info.GetListId()]
     
 class MeRecipientDistribution(Distribution):
   def __init__(self, year):
-    Distribution.__init__(self, year, "recipient")
+    Distribution.__init__(self, year, ME_RECIPIENT, "recipient")
   
   def _GetAddresses(self, message_info):
     if message_info.is_from_me:
@@ -196,10 +219,10 @@ class MeRecipientDistribution(Distribution):
     
 class MeSenderDistribution(Distribution):
   def __init__(self, year):
-    Distribution.__init__(self, year, "sender")
+    Distribution.__init__(self, year, ME_SENDER, "sender")
   
   def _GetAddresses(self, message_info):
     if message_info.is_to_me:
-      return [message_info.GetSender()]    
+      return [message_info.GetSender()]
     else:
       return []
\ No newline at end of file
@@ -1,6 +1,9 @@
 from base import *
 from bucket import *
 from distribution import *
+from distinct import *
+from cube import CountCube
+from matrix import AddressMatrix
 
 class StatGroup(Stat):
   def __init__(self):
@@ -11,9 +14,135 @@ class StatGroup(Stat):
     self._stats.append(stat)
   
   def ProcessMessageInfos(self, message_infos, threads):
-    for stat in self._stats:
-      if stat:
-        stat.ProcessMessageInfos(message_infos, threads) 
+    StatDispatcher([self]).ProcessMessageInfos(message_infos, threads)
+
+class StatDispatcher(object):
+  """
+  Feeds messages and threads to many stats in a single pass
+
+  Each message is handed to the stats that want every message, and to those
+  whose routing key is its year or (year, month), so the per-year and
+  per-month stats don't each scan the whole corpus. Stats that use a count
+  cube or an address matrix share a single one, built in the same pass.
+  """
+  def __init__(self, stats):
+    self.__stats = []
+    self.__all_stats = []
+    self.__routed_stats = {}
+    self.__thread_stats = []
+    self.__cube_stats = []
+    self.__count_cube = None
+    self.__matrix_stats = []
+    self.__address_matrix = None
+
+    pending = list(reversed(stats))
+    while pending:
+      stat = pending.pop()
+      if stat is None:
+        # Divider in a collection
+        continue
+      if isinstance(stat, StatGroup):
+        pending.extend(reversed(stat._stats))
+        continue
+
+      self.__stats.append(stat)
+
+      key = stat.GetRoutingKey()
+      if key == ALL_MESSAGES:
+        self.__all_stats.append(stat)
+      elif key != NO_MESSAGES:
+        self.__routed_stats.setdefault(key, []).append(stat)
+
+      if stat.AccumulatesThreads():
+        self.__thread_stats.append(stat)
+
+      if stat.UsesCountCube():
+        self.__cube_stats.append(stat)
+
+      if stat.UsesAddressMatrix():
+        self.__matrix_stats.append(stat)
+
+    if self.__cube_stats:
+      self.__count_cube = CountCube()
+      self.__all_stats.append(self.__count_cube)
+
+    if self.__matrix_stats:
+      self.__address_matrix = AddressMatrix()
+      self.__all_stats.append(self.__address_matrix)
+
+  def GetCountCube(self):
+    return self.__count_cube
+
+  def SetCountCube(self, count_cube):
+    """Fills the cube stats from count_cube, e.g. one loaded from disk"""
+    self.__count_cube = count_cube
+    for stat in self.__cube_stats:
+      stat.SetCountCube(count_cube)
+
+  def ProcessMessageInfos(self, message_infos, threads):
+    self.Accumulate(message_infos, threads)
+    self.FinishAccumulating()
+
+  def Accumulate(self, message_infos, threads):
+    all_stats = self.__all_stats
+    routed_stats = self.__routed_stats
+
+    for message_info in message_infos:
+      for stat in all_stats:
+        stat.Accumulate(message_info)
+
+      for key in GetRoutingKeys(message_info):
+        for stat in routed_stats.get(key, ()):
+          stat.Accumulate(message_info)
+
+    for thread in threads:
+      for stat in self.__thread_stats:
+        stat.AccumulateThread(thread)
+
+  def GetState(self):
+    """The partial states of all the stats (and cube), by state key"""
+    states = {}
+    for stat in self.__stats:
+      state = stat.GetState()
+      if state is not None:
+        states[stat.GetStateKey()] = state
+
+    if self.__count_cube is not None:
+      states["CountCube"] = self.__count_cube.GetState()
+
+    if self.__address_matrix is not None:
+      states["AddressMatrix"] = self.__address_matrix.GetState()
+
+    return states
+
+  def Merge(self, states):
+    """
+    Merges the states of another dispatcher's stats into ours. States of
+    stats that this report doesn't have are ignored.
+    """
+    for stat in self.__stats:
+      key = stat.GetStateKey()
+      if key in states:
+        stat.Merge(states[key])
+
+    if self.__count_cube is not None and "CountCube" in states:
+      self.__count_cube.Merge(states["CountCube"])
+
+    if self.__address_matrix is not None and "AddressMatrix" in states:
+      self.__address_matrix.Merge(states["AddressMatrix"])
+
+  def FinishAccumulating(self):
+    if self.__count_cube is not None:
+      self.__count_cube.FinishAccumulating()
+      self.SetCountCube(self.__count_cube)
+
+    if self.__address_matrix is not None:
+      self.__address_matrix.FinishAccumulating()
+      for stat in self.__matrix_stats:
+        stat.SetAddressMatrix(self.__address_matrix)
+
+    for stat in self.__stats:
+      stat.FinishAccumulating()
 
 class StatCollection(StatGroup):
   def __init__(self, title):
@@ -104,6 +233,13 @@ class MeRecipientDistributionStatCollection(StatCollection):
     for year in GetYearRange(date_range):
       self._AddStatRef(MeRecipientDistribution(year), "%s" % year)
 
+class DistinctAddressStatCollection(StatCollection):
+  def __init__(self, date_range):
+    StatCollection.__init__(self, "Unique senders and recipients for ")
+
+    for year in GetYearRange(date_range):
+      self._AddStatRef(DistinctAddressStat(year), "%s" % year)
+
 class MeSenderDistributionStatCollection(StatCollection):
   def __init__(self, date_range):
     StatCollection.__init__(self, "Sender to me distribution for ")
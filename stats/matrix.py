@@ -0,0 +1,276 @@
+"""
+Message counts by address, role and 5-day bucket
+
+The sender, recipient and list distributions of every year are slices of
+this one sparse matrix, so the addresses of a message are parsed once for
+all of them instead of once per distribution. As in cube.CountCube, the
+(address, role, bucket) entries are only gathered while accumulating and
+counted in batches: with numpy by sorting a batch at once, without it in a
+dict. Memory then grows with the cells that have messages, not with the
+messages.
+"""
+
+import array
+import heapq
+import math
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+from itertools import izip
+
+from base import ALL_MESSAGES, AsNumpyArray
+from messageinfo import MessageInfo
+
+# What an address was to a message
+SENDER = 0
+RECIPIENT = 1
+LIST = 2
+# Recipient of a message from me, sender of a message to me
+ME_RECIPIENT = 3
+ME_SENDER = 4
+_ROLE_COUNT = 5
+
+BUCKET_SIZE = 5
+# The last partial bucket of the year is left out
+BUCKET_COUNT = int(math.floor(365/BUCKET_SIZE))
+
+# Buckets are numbered year * BUCKET_COUNT + bucket of the year, which is
+# below this for any year before 3590
+_PERIOD_COUNT = 1 << 18
+
+_CELLS_PER_ADDRESS = _ROLE_COUNT * _PERIOD_COUNT
+
+# Entries gathered before they are counted into cells
+_BATCH_ENTRIES = 1 << 20
+
+class AddressMatrix(object):
+  """
+  Counts of messages per (address, role, 5-day bucket)
+
+  It is fed like a stat, see group.StatDispatcher. Addresses are those of
+  the messageinfo.AddressTable, and are shown with its names.
+  """
+  def __init__(self):
+    # Address ID, role and bucket of each entry
+    self.__ids = array.array("l")
+    self.__roles = array.array("l")
+    self.__periods = array.array("l")
+    # (cells, counts) of the entries counted so far, and of the states
+    # merged in
+    self.__cell_counts = []
+
+    # (role, year) -> (address IDs, buckets, counts) once finished
+    self.__slices = {}
+
+  # Stat protocol, so that the dispatcher can feed us
+
+  def GetRoutingKey(self):
+    return ALL_MESSAGES
+
+  def AccumulatesThreads(self):
+    return False
+
+  def Accumulate(self, message_info):
+    date = message_info.GetDate()
+    bucket = (date.tm_yday - 1) / BUCKET_SIZE
+    if bucket >= BUCKET_COUNT: return
+    period = date.tm_year * BUCKET_COUNT + bucket
+
+    sender_id = message_info.GetSenderId()
+    self.__Add(sender_id, SENDER, period)
+    if message_info.is_to_me:
+      self.__Add(sender_id, ME_SENDER, period)
+
+    for recipient_id in message_info.GetRecipientIds():
+      self.__Add(recipient_id, RECIPIENT, period)
+      if message_info.is_from_me:
+        self.__Add(recipient_id, ME_RECIPIENT, period)
+
+    self.__Add(message_info.GetListAddressId(), LIST, period)
+
+    if len(self.__ids) >= _BATCH_ENTRIES:
+      self.__GetCellCounts()
+
+  def __Add(self, address_id, role, period):
+    if address_id is None: return
+
+    self.__ids.append(address_id)
+    self.__roles.append(role)
+    self.__periods.append(period)
+
+  def GetState(self):
+    cells, counts = self.__GetCellCounts()
+
+    # Other runs have other address IDs, so the addresses of ours go along
+    address_table = MessageInfo.GetAddressTable()
+    names, addresses = [], []
+    for address_id in xrange(0, len(address_table)):
+      name, address = address_table.GetNameAddress(address_id)
+      names.append(name)
+      addresses.append(address)
+
+    return {
+      "addresses": addresses,
+      "names": names,
+      "cells": array.array("l", cells),
+      "counts": array.array("l", counts),
+    }
+
+  def Merge(self, state):
+    address_table = MessageInfo.GetAddressTable()
+    address_ids = [
+      address_table.GetId(address, name)
+      for address, name in izip(state["addresses"], state["names"])
+    ]
+
+    if numpy is not None:
+      other_ids, rest = numpy.divmod(
+          AsNumpyArray(state["cells"]), _CELLS_PER_ADDRESS)
+      cells = numpy.asarray(address_ids, numpy.int64)[other_ids] * \
+          _CELLS_PER_ADDRESS + rest
+    else:
+      cells = [
+        address_ids[cell / _CELLS_PER_ADDRESS] * _CELLS_PER_ADDRESS + \
+            cell % _CELLS_PER_ADDRESS
+        for cell in state["cells"]
+      ]
+
+    self.__cell_counts.append((cells, state["counts"]))
+
+  def FinishAccumulating(self):
+    cells, counts = self.__GetCellCounts()
+    self.__cell_counts = []
+
+    if numpy is not None:
+      ids, rest = numpy.divmod(cells, _CELLS_PER_ADDRESS)
+      roles, periods = numpy.divmod(rest, _PERIOD_COUNT)
+      years, buckets = numpy.divmod(periods, BUCKET_COUNT)
+
+      # Group the cells by (role, year), keeping them sorted by address
+      slice_keys = roles * _PERIOD_COUNT + years
+      order = numpy.argsort(slice_keys, kind="mergesort")
+      slice_keys, starts = numpy.unique(slice_keys[order], return_index=True)
+      ends = starts[1:].tolist() + [len(order)]
+
+      self.__slices = {}
+      for slice_key, start, end in izip(slice_keys.tolist(), starts, ends):
+        cell_order = order[start:end]
+        self.__slices[divmod(slice_key, _PERIOD_COUNT)] = (
+            ids[cell_order], buckets[cell_order], counts[cell_order])
+      return
+
+    self.__slices = {}
+    for cell, count in izip(cells, counts):
+      address_id, rest = divmod(cell, _CELLS_PER_ADDRESS)
+      role, period = divmod(rest, _PERIOD_COUNT)
+      year, bucket = divmod(period, BUCKET_COUNT)
+
+      address_ids, buckets, bucket_counts = \
+          self.__slices.setdefault((role, year), ([], [], []))
+      address_ids.append(address_id)
+      buckets.append(bucket)
+      bucket_counts.append(count)
+
+  def __GetCellCounts(self):
+    """(cells, counts) of all that was accumulated or merged, each cell once"""
+    ids, roles, periods = self.__ids, self.__roles, self.__periods
+    self.__ids = array.array("l")
+    self.__roles = array.array("l")
+    self.__periods = array.array("l")
+
+    if ids:
+      if numpy is not None:
+        cells = (AsNumpyArray(ids) * _ROLE_COUNT + AsNumpyArray(roles)) * \
+            _PERIOD_COUNT + AsNumpyArray(periods)
+        self.__cell_counts.append(numpy.unique(cells, return_counts=True))
+      else:
+        counts = {}
+        for address_id, role, period in izip(ids, roles, periods):
+          cell = (address_id * _ROLE_COUNT + role) * _PERIOD_COUNT + period
+          counts[cell] = counts.get(cell, 0) + 1
+        self.__cell_counts.append((counts.keys(), counts.values()))
+
+    if numpy is not None:
+      if not self.__cell_counts:
+        return numpy.zeros(0, numpy.int64), numpy.zeros(0, numpy.int64)
+
+      cells, inverse = numpy.unique(
+          numpy.concatenate(
+              [AsNumpyArray(c) for c, n in self.__cell_counts]),
+          return_inverse=True)
+      counts = numpy.bincount(
+          inverse,
+          weights=numpy.concatenate(
+              [AsNumpyArray(n) for c, n in self.__cell_counts]))
+      counts = counts.astype(numpy.int64)
+    else:
+      all_counts = {}
+      for cells, counts in self.__cell_counts:
+        for cell, count in izip(cells, counts):
+          all_counts[cell] = all_counts.get(cell, 0) + count
+      cells = sorted(all_counts)
+      counts = [all_counts[cell] for cell in cells]
+
+    self.__cell_counts = [(cells, counts)]
+    return cells, counts
+
+  # Slices
+
+  def IsEmpty(self, role, year):
+    return (role, year) not in self.__slices
+
+  def GetBucketRange(self, role, year):
+    """The first and last buckets of the year that have messages"""
+    address_ids, buckets, counts = self.__slices[(role, year)]
+    if numpy is not None:
+      return int(buckets.min()), int(buckets.max())
+    return min(buckets), max(buckets)
+
+  def GetTopAddresses(self, role, year, count):
+    """
+    The count addresses with the most messages in the year, as [(address,
+    name, counts by bucket)], most messages first (and then by address,
+    backwards)
+    """
+    address_ids, buckets, counts = self.__slices[(role, year)]
+    address_table = MessageInfo.GetAddressTable()
+
+    # Totals for the year, only the top ones are sorted
+    if numpy is not None:
+      unique_ids, inverse = numpy.unique(address_ids, return_inverse=True)
+      totals = izip(
+          numpy.bincount(inverse, weights=counts).astype(numpy.int64).tolist(),
+          unique_ids.tolist())
+    else:
+      totals = {}
+      for address_id, bucket_count in izip(address_ids, counts):
+        totals[address_id] = totals.get(address_id, 0) + bucket_count
+      totals = [(total, address_id) for address_id, total in totals.iteritems()]
+
+    top_ids = [
+      address_id for total, address_id in heapq.nlargest(
+          count,
+          totals,
+          key=lambda (total, address_id):
+              (total, address_table.GetAddress(address_id)))
+    ]
+
+    bucket_counts = dict(
+        (address_id, [0] * BUCKET_COUNT) for address_id in top_ids)
+    if numpy is not None:
+      cells = numpy.flatnonzero(numpy.in1d(address_ids, top_ids))
+      address_ids = address_ids[cells].tolist()
+      buckets = buckets[cells].tolist()
+      counts = counts[cells].tolist()
+    for address_id, bucket, bucket_count in izip(address_ids, buckets, counts):
+      if address_id in bucket_counts:
+        bucket_counts[address_id][bucket] = bucket_count
+
+    return [
+      (address_table.GetAddress(address_id), address_table.GetName(address_id),
+          bucket_counts[address_id])
+      for address_id in top_ids
+    ]
@@ -0,0 +1,235 @@
+"""
+Bounded-memory summaries for the approximate mode
+
+With --approximate=<error>, the address tables and distributions don't keep
+a counter for every address they see. They use these summaries instead, in
+which counts may be off by at most error times the number of counted
+messages:
+
+- SpaceSaving keeps ceil(1/error) counters, for the most frequent addresses;
+  their counts can only be too high.
+- CountMinSketch keeps ceil(e/error) x ceil(ln(1/0.01)) counters for any
+  number of keys; an estimate can only be too high, and is within the bound
+  99% of the time.
+
+HyperLogLog, which estimates how many distinct addresses were seen, is always
+used (exact counts are not worth their memory there).
+
+All of them can be merged with the summaries of another shard.
+"""
+
+import array
+import hashlib
+import heapq
+import math
+import struct
+
+from itertools import imap
+
+# Relative error allowed by the approximate mode, None for exact counts
+_error_bound = None
+
+def SetErrorBound(error_bound):
+  global _error_bound
+  _error_bound = error_bound
+
+def GetErrorBound():
+  return _error_bound
+
+class SpaceSaving(object):
+  """
+  Space-Saving summary of the most frequent addresses
+
+  Each monitored address has [count, error, bytes, name]: count is at most
+  error too high, bytes and name are those of the messages counted since
+  the address was (last) picked up. When all the counters are taken, a new
+  address replaces the one with the lowest count and starts from it.
+  """
+  def __init__(self, capacity):
+    self.__capacity = capacity
+    self.__entries = {}
+    # (count, address) for every entry, plus older pairs that no longer
+    # match the entry's count and are skipped
+    self.__heap = []
+
+  def Add(self, address, name, bytes=0):
+    entries = self.__entries
+
+    entry = entries.get(address)
+    if entry is not None:
+      entry[0] += 1
+      entry[2] += bytes
+      # The address stands in for a missing name, as in the address table
+      if name != address:
+        entry[3] = name
+    elif len(entries) < self.__capacity:
+      entry = entries[address] = [1, 0, bytes, name]
+    else:
+      min_count, min_address = self.__PopMin()
+      del entries[min_address]
+      entry = entries[address] = [min_count + 1, min_count, bytes, name]
+
+    self.__Push(entry[0], address)
+
+  def GetTop(self, count):
+    """
+    The count most frequent addresses, as (address, [count, error, bytes,
+    name]), highest count first and then by address
+    """
+    return heapq.nsmallest(
+        count,
+        self.__entries.iteritems(),
+        key=lambda (address, entry): (-entry[0], address))
+
+  def GetMaxError(self):
+    """How much too high any count may be"""
+    if len(self.__entries) < self.__capacity:
+      return 0
+    return min(entry[0] for entry in self.__entries.itervalues())
+
+  def GetState(self):
+    return self.__entries
+
+  def Merge(self, state):
+    entries = self.__entries
+    min_count = self.GetMaxError()
+    other_min_count = 0
+    if len(state) >= self.__capacity:
+      other_min_count = min(entry[0] for entry in state.itervalues())
+
+    # An address missing from a summary may have been counted up to its
+    # lowest count there
+    for address, entry in entries.iteritems():
+      if address not in state:
+        entry[0] += other_min_count
+        entry[1] += other_min_count
+
+    for address, (count, error, bytes, name) in state.iteritems():
+      entry = entries.get(address)
+      if entry is None:
+        entries[address] = [count + min_count, error + min_count, bytes, name]
+      else:
+        entry[0] += count
+        entry[1] += error
+        entry[2] += bytes
+        if name != address:
+          entry[3] = name
+
+    if len(entries) > self.__capacity:
+      self.__entries = entries = dict(self.GetTop(self.__capacity))
+    self.__RebuildHeap()
+
+  def __Push(self, count, address):
+    if len(self.__heap) > 4 * self.__capacity:
+      self.__RebuildHeap()
+    else:
+      heapq.heappush(self.__heap, (count, address))
+
+  def __PopMin(self):
+    heap = self.__heap
+    entries = self.__entries
+    while True:
+      count, address = heapq.heappop(heap)
+      entry = entries.get(address)
+      if entry is not None and entry[0] == count:
+        return count, address
+
+  def __RebuildHeap(self):
+    self.__heap = [
+      (entry[0], address) for address, entry in self.__entries.iteritems()
+    ]
+    heapq.heapify(self.__heap)
+
+class CountMinSketch(object):
+  """Count-Min sketch of counts by key (a string)"""
+  _FAILURE_PROBABILITY = 0.01
+
+  def __init__(self, error_bound):
+    self.__width = int(math.ceil(math.e / error_bound))
+    self.__depth = int(math.ceil(
+        math.log(1 / CountMinSketch._FAILURE_PROBABILITY)))
+    self.__counts = array.array("l", [0]) * (self.__width * self.__depth)
+
+  def Add(self, key, count=1):
+    counts = self.__counts
+    for cell in self.__GetCells(key):
+      counts[cell] += count
+
+  def Estimate(self, key):
+    counts = self.__counts
+    return min(counts[cell] for cell in self.__GetCells(key))
+
+  def GetState(self):
+    return self.__counts
+
+  def Merge(self, state):
+    counts = self.__counts
+    for cell, count in enumerate(state):
+      if count:
+        counts[cell] += count
+
+  def __GetCells(self, key):
+    if isinstance(key, unicode):
+      key = key.encode("utf-8")
+
+    # One hash function per row, made from the two halves of an md5 digest
+    # (which, unlike hash(), is the same on every machine that a shard runs
+    # on, and unlike adler32 spreads short keys such as addresses well)
+    width = self.__width
+    hash1, hash2 = struct.unpack("<QQ", hashlib.md5(key).digest())
+    return [
+      row * width + (hash1 + row * hash2) % width
+      for row in xrange(self.__depth)
+    ]
+
+class HyperLogLog(object):
+  """
+  HyperLogLog estimate of the number of distinct keys (strings) seen
+
+  2^_PRECISION one-byte registers, for a standard error of about 1.6%. Small
+  counts are estimated from the empty registers instead, and are then close
+  to exact.
+  """
+  _PRECISION = 12
+  _REGISTER_COUNT = 1 << _PRECISION
+  _RANK_BITS = 64 - _PRECISION
+  _ALPHA = 0.7213 / (1 + 1.079 / _REGISTER_COUNT)
+
+  def __init__(self):
+    self.__registers = array.array("B", [0]) * HyperLogLog._REGISTER_COUNT
+
+  def Add(self, key):
+    if isinstance(key, unicode):
+      key = key.encode("utf-8")
+
+    # md5 rather than hash(), so that shards hashed on other machines agree
+    hash, = struct.unpack("<Q", hashlib.md5(key).digest()[:8])
+    register = hash >> HyperLogLog._RANK_BITS
+    rest = hash & ((1 << HyperLogLog._RANK_BITS) - 1)
+    rank = HyperLogLog._RANK_BITS - rest.bit_length() + 1
+
+    registers = self.__registers
+    if rank > registers[register]:
+      registers[register] = rank
+
+  def Estimate(self):
+    registers = self.__registers
+    register_count = HyperLogLog._REGISTER_COUNT
+
+    # Linear counting, from the empty registers, is better for small counts,
+    # where the raw estimate is biased
+    empty_count = registers.count(0)
+    if empty_count:
+      estimate = register_count * math.log(float(register_count) / empty_count)
+      if estimate <= 2.5 * register_count:
+        return int(round(estimate))
+
+    estimate = HyperLogLog._ALPHA * register_count * register_count / \
+        math.fsum(2.0 ** -rank for rank in registers)
+    return int(round(estimate))
+
+  def GetState(self):
+    return self.__registers
+
+  def Merge(self, state):
+    self.__registers = array.array("B", imap(max, self.__registers, state))
@@ -1,6 +1,11 @@
 #Modified by Joao Paulo Barraca <jpbarraca@ua.pt>
 
+import itertools
+import math
+
 from base import *
+from messageinfo import MessageInfo
+from sketch import GetErrorBound, SpaceSaving
 
 class SizeFormatter(object):
   def __init__(self):
@@ -33,20 +38,29 @@ class TableStat(Stat):
 
     self.__formatters = formatters
 
-  def ProcessMessageInfos(self, message_infos, threads):
-    data = self._GetTableData(message_infos, threads)
+    # Min-heap of the largest rows seen so far, never more than _TABLE_SIZE
+    self.__rows = []
 
-    heapq.heapify(data)
+  def FinishAccumulating(self):
+    self.__display_data = self._GetDisplayData(self._GetTopRows())
 
-    table_data = []
-    for i in range(0, min(len(data), TableStat._TABLE_SIZE)):
-      table_data.append(heapq.heappop(data))
+  def _AddRow(self, row):
+    rows = self.__rows
+    if len(rows) < TableStat._TABLE_SIZE:
+      heapq.heappush(rows, row)
+    elif row > rows[0]:
+      heapq.heapreplace(rows, row)
 
-    self.__display_data = self._GetDisplayData(table_data)
+  def _GetTopRows(self):
+    return sorted(self.__rows, reverse=True)
 
   def IsEmpty(self):
     return len(self.__display_data) == 0
 
+  def _GetApproximation(self):
+    """A note on how far off the table may be, None if it is exact"""
+    return None
+
   def GetHtml(self):
     if self.IsEmpty(): return ""
 
@@ -55,6 +69,7 @@ class TableStat(Stat):
         searchList = {
           "id": self.id,
           "title": self.__title,
+          "approximation": self._GetApproximation(),
           "formatters": self.__formatters,
           "objs": self.__display_data
         })
@@ -66,31 +81,48 @@ class SizeTableStat(TableStat):
         self,
         "Top messages by size",
         [SubjectSenderFormatter(), SizeFormatter()])
+    self.__sequence = itertools.count()
+
+  def Accumulate(self, message_info):
+    self.__AddRow(message_info.size, message_info)
+
+  def GetState(self):
+    return self._GetTopRows()
+
+  def Merge(self, state):
+    # Shards are merged in order, so their rows are numbered again as if
+    # their messages had been accumulated here
+    for size, _, message_info in state:
+      self.__AddRow(size, message_info)
 
-  def _GetTableData(self, message_infos, threads):
-    return [(sys.maxint - m.size, m) for m in message_infos]
+  def __AddRow(self, size, message_info):
+    # Of messages of the same size, the earliest one comes first (Message-IDs
+    # may be missing or shared, and message infos don't compare)
+    self._AddRow((size, -next(self.__sequence), message_info))
 
   def _GetDisplayData(self, data):
-    return [d[1] for d in data]
+    return [d[2] for d in data]
 
 class ThreadSubjectFormatter(object):
   def __init__(self):
     self.header = "Subject"
     self.css_class = "subject"
 
-  def Format(self, thread):
-    if thread.message and thread.message.message_info:
+  def Format(self, data):
+    subject, message_info, length = data
+
+    if message_info:
       t = Template(
           file="templates/subject-sender-formatter.tmpl",
           searchList = {
-            "message_info": thread.message.message_info,
+            "message_info": message_info,
             "connector": "started by"
           });
     else:
       t = Template(
           file="templates/subject-formatter.tmpl",
           searchList = {
-            "subject": thread.subject,
+            "subject": subject,
             "connector": "started by"
           });
     return unicode(t)
@@ -100,8 +132,10 @@ class ThreadSizeFormatter(object):
     self.header = "Length"
     self.css_class = "length sorting"
 
-  def Format(self, thread):
-    return len(thread)
+  def Format(self, data):
+    subject, message_info, length = data
+
+    return length
 
 class ThreadSizeTableStat(TableStat):
   def __init__(self):
@@ -110,11 +144,36 @@ class ThreadSizeTableStat(TableStat):
         "Top threads",
         [ThreadSubjectFormatter(), ThreadSizeFormatter()])
 
-  def _GetTableData(self, message_infos, threads):
-    return [(sys.maxint - len(t), t) for t in threads]
+  def GetRoutingKey(self):
+    return NO_MESSAGES
+
+  def AccumulatesThreads(self):
+    return True
+
+  def AccumulateThread(self, thread):
+    # Rows only keep what the table shows (the messageinfo.MessageRecord of
+    # the first message, not the thread and its forest), so that they can be
+    # merged from other runs. Threads split off the same subject tie on it,
+    # and are then ordered by Message-ID rather than by where their records
+    # happen to be in memory.
+    message = thread.message
+    message_info = message and message.message_info
+    record = message_info and message_info.GetRecord() or None
+    message_id = message and message.message_id or None
+    self._AddRow((thread.length, thread.subject, message_id, record))
+
+  def GetState(self):
+    return self._GetTopRows()
+
+  def Merge(self, state):
+    for row in state:
+      self._AddRow(row)
 
   def _GetDisplayData(self, data):
-    return [d[1] for d in data]
+    return [
+      (subject, message_info, length)
+      for length, subject, message_id, message_info in data
+    ]
 
 class ThreadOriginFormatter(object):
   def __init__(self, header, css_class):
@@ -155,40 +214,62 @@ class ThreadOriginTableStat(TableStat):
       [ThreadOriginFormatter(column_header, column_css_class),
           ThreadOriginSizeFormatter(),
           ThreadCountFormatter()])
+    self.__origin_threads = {}
 
-  def _GetTableData(self, message_infos, threads):
-    origin_threads = {}
+  def GetRoutingKey(self):
+    return NO_MESSAGES
 
-    for thread in threads:
-      origin = self._GetThreadOrigin(thread)
+  def AccumulatesThreads(self):
+    return True
 
-      if not origin: continue
+  def AccumulateThread(self, thread):
+    origin = self._GetThreadOrigin(thread)
 
-      origin_name, origin_address = origin
+    if not origin: return
 
-      if origin_address in origin_threads:
-        origin_thread_info = origin_threads[origin_address]
-      else:
-        origin_thread_info = {
-          "address": origin_address,
-          "name": "",
-          "count": 0,
-          "total_size": 0,
-        }
-        origin_threads[origin_address] = origin_thread_info
-
-      if origin_name:
-        origin_thread_info["name"] = origin_name
-      origin_thread_info["count"] += 1
-      origin_thread_info["total_size"] += len(thread)
+    origin_name, origin_address = origin
 
-    return [
-      (sys.maxint - i["total_size"]/i["count"], i) \
-          for origin_address, i in origin_threads.items()
-    ]
+    origin_threads = self.__origin_threads
+    if origin_address in origin_threads:
+      origin_thread_info = origin_threads[origin_address]
+    else:
+      origin_thread_info = {
+        "address": origin_address,
+        "name": "",
+        "count": 0,
+        "total_size": 0,
+      }
+      origin_threads[origin_address] = origin_thread_info
+
+    if origin_name:
+      origin_thread_info["name"] = origin_name
+    origin_thread_info["count"] += 1
+    origin_thread_info["total_size"] += thread.length
+
+  def GetState(self):
+    return self.__origin_threads
+
+  def Merge(self, state):
+    origin_threads = self.__origin_threads
+    for origin_address, other_info in state.iteritems():
+      if origin_address not in origin_threads:
+        origin_threads[origin_address] = dict(other_info)
+        continue
+
+      origin_thread_info = origin_threads[origin_address]
+      if other_info["name"]:
+        origin_thread_info["name"] = other_info["name"]
+      origin_thread_info["count"] += other_info["count"]
+      origin_thread_info["total_size"] += other_info["total_size"]
+
+  def _GetTopRows(self):
+    return heapq.nlargest(
+        TableStat._TABLE_SIZE,
+        self.__origin_threads.itervalues(),
+        key=lambda i: i["total_size"]/i["count"])
 
   def _GetDisplayData(self, data):
-    return [d[1] for d in data]
+    return data
 
 class ThreadStarterTableStat(ThreadOriginTableStat):
   def __init__(self):
@@ -264,35 +345,98 @@ class UniqueAddressTableStat(TableStat):
         AddressCountFormatter(),
         AddressBytesFormatter(),
       ])
-
-  def _GetTableData(self, message_infos, threads):
-    address_counts = {}
-    address_bytes = {}
-    address_names = {}
-
-    for message_info in message_infos:
+    # Address ID -> [message count, total bytes]. All the counts have to
+    # be kept, the top ones are only known at the end.
+    self.__addresses = {}
+
+    # Unless we are allowed to be approximate, then only the most frequent
+    # addresses are counted
+    self.__summary = None
+    error_bound = GetErrorBound()
+    if error_bound is not None:
+      self.__summary = SpaceSaving(
+          max(TableStat._TABLE_SIZE, int(math.ceil(1 / error_bound))))
+
+  def Accumulate(self, message_info):
+    addresses = self.__addresses
+    summary = self.__summary
+
+    if summary is not None:
+      # Addresses aren't numbered in the approximate mode
       for name, address in self._GetAddresses(message_info):
-        if not address: continue
+        if address is not None:
+          summary.Add(address, name, message_info.size)
+      return
 
-        address_counts[address] = address_counts.get(address, 0) + 1
-        address_bytes[address] = \
-            address_bytes.get(address, 0) + message_info.size
-        address_names[address] = name
+    for address_id in self._GetAddressIds(message_info):
+      if address_id is None: continue
 
+      counters = addresses.get(address_id)
+      if counters is None:
+        addresses[address_id] = [1, message_info.size]
+      else:
+        counters[0] += 1
+        counters[1] += message_info.size
+
+  def GetState(self):
+    if self.__summary is not None:
+      return self.__summary.GetState()
+
+    # By address, since other runs have other IDs
+    address_table = MessageInfo.GetAddressTable()
+    state = {}
+    for address_id, (count, bytes) in self.__addresses.iteritems():
+      name, address = address_table.GetNameAddress(address_id)
+      state[address] = [count, bytes, name]
+    return state
+
+  def Merge(self, state):
+    if self.__summary is not None:
+      self.__summary.Merge(state)
+      return
+
+    addresses = self.__addresses
+    address_table = MessageInfo.GetAddressTable()
+
+    for address, (count, bytes, name) in state.iteritems():
+      address_id = address_table.GetId(address, name)
+      counters = addresses.get(address_id)
+      if counters is None:
+        addresses[address_id] = [count, bytes]
+      else:
+        counters[0] += count
+        counters[1] += bytes
+
+  def _GetApproximation(self):
+    if self.__summary is None:
+      return None
+    return "Counts may be up to %d too high" % self.__summary.GetMaxError()
+
+  def _GetTopRows(self):
+    if self.__summary is not None:
+      return [
+        (address, (count, bytes, name))
+        for address, (count, error, bytes, name) in
+            self.__summary.GetTop(TableStat._TABLE_SIZE)
+      ]
+
+    # Most messages first, then by address
+    address_table = MessageInfo.GetAddressTable()
+    top = heapq.nsmallest(
+        TableStat._TABLE_SIZE,
+        self.__addresses.iteritems(),
+        key=lambda (address_id, counters):
+            (-counters[0], address_table.GetAddress(address_id)))
     return [
-      (
-        sys.maxint - count,
-        address,
-        address_names[address],
-        address_bytes[address]
-      )
-      for address, count in address_counts.items()
+      (address_table.GetAddress(address_id),
+          (count, bytes, address_table.GetName(address_id)))
+      for address_id, (count, bytes) in top
     ]
 
   def _GetDisplayData(self, data):
     return [
-      (address, name, sys.maxint - inverse_count, bytes)
-      for inverse_count, address, name, bytes in data
+      (address, name, count, bytes)
+      for address, (count, bytes, name) in data
    ]
 
 class SenderTableStat(UniqueAddressTableStat):
@@ -303,6 +447,9 @@ class SenderTableStat(UniqueAddressTableStat):
         "Sender",
         "sender")
 
+  def _GetAddressIds(self, message_info):
+    return [message_info.GetSenderId()]
+
   def _GetAddresses(self, message_info):
     return [message_info.GetSender()]
 
@@ -314,6 +461,9 @@ class ListIdTableStat(UniqueAddressTableStat):
         "List",
         "list")
 
+  def _GetAddressIds(self, message_info):
+    return [message_info.GetListAddressId()]
+
   def _GetAddresses(self, message_info):
     return [message_info.GetListId()]
 
@@ -325,6 +475,9 @@ class RecipientTableStat(UniqueAddressTableStat):
       "Recipient",
       "recipient")
 
+  def _GetAddressIds(self, message_info):
+    return message_info.GetRecipientIds()
+
   def _GetAddresses(self, message_info):
     return message_info.GetRecipients()
 
@@ -336,6 +489,12 @@ class MeRecipientTableStat(UniqueAddressTableStat):
       "Recipient",
       "recipient")
 
+  def _GetAddressIds(self, message_info):
+    if message_info.is_from_me:
+      return message_info.GetRecipientIds()
+    else:
+      return []
+
   def _GetAddresses(self, message_info):
     if message_info.is_from_me:
       return message_info.GetRecipients()
@@ -350,6 +509,12 @@ class MeSenderTableStat(UniqueAddressTableStat):
         "Sender",
         "sender")
 
+  def _GetAddressIds(self, message_info):
+    if message_info.is_to_me:
+      return [message_info.GetSenderId()]
+    else:
+      return []
+
   def _GetAddresses(self, message_info):
     if message_info.is_to_me:
       return [message_info.GetSender()]
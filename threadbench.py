@@ -0,0 +1,62 @@
+#!/usr/bin/python
+
+# Times threading on synthetic corpora of growing size, with thread() (one
+# Container per message) and thread_forest() (flat arrays). Replies quote
+# the references of a recent message, some messages reference IDs that
+# are never seen, and the messages are threaded newest first, so that
+# replies come before their parents. The time per message should stay
+# about the same from one size to the next.
+#
+# To run:
+# ./threadbench.py [message_count ...]
+# The counts default to 10000, 100000, 1000000 and 2000000.
+
+import random
+import sys
+import time
+
+import jwzthreading
+
+def MakeMessages(count):
+  random.seed(count)
+  messages = []
+  for i in xrange(count):
+    message = jwzthreading.Message()
+    message.message_id = "m%d@example.com" % i
+    if messages and random.random() < 0.6:
+      parent = messages[random.randint(max(0, i - 2000), i - 1)]
+      message.references = (list(parent.references) +
+                            [parent.message_id])[-10:]
+      message.subject = "Re: " + parent.normalized_subject
+    else:
+      if random.random() < 0.1:
+        message.references = ["missing%d@example.com" % random.randint(0, count)]
+      message.subject = "Topic %d" % i
+    message.subject, message.normalized_subject = \
+        jwzthreading.normalize_subject(message.subject)
+    messages.append(message)
+
+  messages.reverse()
+  return messages
+
+def Time(label, count, function):
+  start = time.time()
+  result = function()
+  elapsed = time.time() - start
+  print "%-16s n=%-8d %7.2fs %6.2fus/message" % (
+      label, count, elapsed, elapsed * 1e6 / count)
+  sys.stdout.flush()
+  return result
+
+counts = [int(c) for c in sys.argv[1:]] or [10000, 100000, 1000000, 2000000]
+
+for count in counts:
+  messages = MakeMessages(count)
+
+  subject_table = Time("thread", count,
+      lambda: jwzthreading.thread(messages))
+  forest = Time("thread_forest", count,
+      lambda: jwzthreading.thread_forest(messages))
+  assert len(subject_table) == len(forest.subject_table)
+
+  del subject_table, forest
@@ -0,0 +1,115 @@
+#!/usr/bin/python
+
+# Checks that bringing a ThreadState up to date gives the same threads as
+# threading every message again. Random message lists are threaded in two
+# or three updates, saved and loaded in between, and compared with
+# thread_forest() on the last list: the subjects, the shape of every
+# thread, the order of children and the message at each node. Each run
+# sees the messages of the runs before it followed by new ones, except
+# that some cases delete messages of earlier runs, and others change a
+# filter between runs so that messages drop out and come back.
+# Message-IDs are drawn from a small pool, so that references point at
+# each other, form loops and go missing, and many messages share their
+# Message-ID with an earlier one.
+#
+# To run:
+# ./threadcheck.py [case_count [seed]]
+# The count defaults to 1000, the seed to 0.
+
+import cPickle
+import random
+import sys
+
+import jwzthreading
+
+def MakeMessages(count):
+  id_count = max(2, count * 2 / 3)
+  subjects = ["S%d" % i for i in xrange(max(1, count / 3))]
+  messages = []
+  for i in xrange(count):
+    message = jwzthreading.Message()
+    message.message_id = "m%d" % random.randint(0, id_count - 1)
+    message.references = ["m%d" % random.randint(0, id_count)
+                          for j in xrange(random.randint(0, 3))]
+    message.subject = random.choice(["", "Re: ", "Re: Re: "]) + \
+        random.choice(subjects)
+    messages.append(message)
+  return messages
+
+def Describe(forest, messages):
+  """The threads of forest, by subject, as nested (message, children)"""
+  def DescribeNode(node):
+    index = forest.message[node]
+    message = index != -1 and (index, messages[index].subject) or None
+    return (message, [DescribeNode(child) for child in forest.children(node)])
+
+  return dict((subject, DescribeNode(node))
+              for subject, node in forest.subject_table.iteritems())
+
+def CheckCase(runs):
+  """Threads each message list of runs in turn, updating one ThreadState"""
+  state = jwzthreading.ThreadState()
+  for messages in runs:
+    forest = state.update(messages)
+    # As if saved and loaded again between runs
+    state = cPickle.loads(cPickle.dumps(state, cPickle.HIGHEST_PROTOCOL))
+  incremental = Describe(forest, runs[-1])
+
+  fresh = Describe(jwzthreading.thread_forest(runs[-1]), runs[-1])
+  return incremental == fresh, incremental, fresh
+
+def MakeAppendRuns(messages):
+  """Each run sees the messages of the runs before it, then new ones"""
+  cuts = sorted(random.randint(0, len(messages))
+                for i in xrange(random.randint(1, 2)))
+  return [messages[:cut] for cut in cuts + [len(messages)]]
+
+def MakeDeleteRuns(messages):
+  """Like MakeAppendRuns, but some messages of earlier runs are deleted"""
+  runs = []
+  seen = 0
+  for run in MakeAppendRuns(messages):
+    old = [message for message in runs and runs[-1] or []
+           if random.random() < 0.8]
+    runs.append(old + run[seen:])
+    seen = len(run)
+  return runs
+
+def MakeFilterRuns(messages):
+  """
+  Like MakeAppendRuns, with a filter (by subject) that changes from run to
+  run, so that messages drop out and come back
+  """
+  subjects = list(set(message.subject for message in messages))
+  runs = []
+  for run in MakeAppendRuns(messages):
+    filtered = set(random.sample(subjects,
+                                 random.randint(0, len(subjects) / 3)))
+    runs.append([message for message in run
+                 if message.subject not in filtered])
+  return runs
+
+case_count = len(sys.argv) > 1 and int(sys.argv[1]) or 1000
+random.seed(len(sys.argv) > 2 and int(sys.argv[2]) or 0)
+
+failures = 0
+for case in xrange(case_count):
+  messages = MakeMessages(random.randint(1, 40))
+  make_runs = random.choice([MakeAppendRuns, MakeDeleteRuns, MakeFilterRuns])
+  runs = make_runs(messages)
+
+  same, incremental, fresh = CheckCase(runs)
+  if not same:
+    failures += 1
+    if failures <= 3:
+      print "Case %d, %s:" % (case, make_runs.__name__)
+      for i, run in enumerate(runs):
+        print "  Run %d:" % (i + 1)
+        for message in run:
+          print "    %s refs=%s %r" % (message.message_id, message.references,
+                                       message.subject)
+      print "  incremental: %r" % incremental
+      print "  fresh:       %r" % fresh
+
+print "%d/%d cases differ" % (failures, case_count)
+sys.exit(failures and 1 or 0)